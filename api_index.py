@@ -0,0 +1,50 @@
+from dataset import Dataset
+
+
+class DataIndex(object):
+    '''
+    The data.json dataset with the lookups the API routes need, built once at load time
+
+    Attributes:
+        data (Dataset): the data from the data.json file
+        center_to_state (dict): center_id -> state_id
+        dates (list): the sorted dates of all states
+    '''
+
+    def __init__(self, data):
+        if not isinstance(data, Dataset):
+            data = Dataset.from_dict(data)
+        self.data = data
+        self.center_to_state = {}
+
+        for state_id, state in zip(data.state_ids, data.states):
+            # The first state listing a center wins, the same as scanning the states in order
+            for center_id in state['centers']:
+                self.center_to_state.setdefault(center_id, state_id)
+
+        self.dates = data.dates
+
+    def get_state(self, state_id):
+        '''
+        Get the data of a state, or an empty dictionary if the state_id is unknown
+        '''
+        return self.data.get(state_id, {})
+
+    def get_center(self, center_id):
+        '''
+        Get the data of the state where the center is located, or an empty dictionary
+        '''
+        state_id = self.center_to_state.get(center_id)
+        if state_id is None:
+            return {}
+        return self.data[state_id]
+
+    def get_date(self, date):
+        '''
+        Get the data of every state at a date, or an empty dictionary
+
+        Returns:
+            states (dict): state_id -> {'state_name': str, 'data': dict}
+        '''
+        return {state_id: {'state_name': self.data[state_id]['state_name'], 'data': record}
+                for state_id, record in self.data.date_records(date).items()}
@@ -1,17 +1,148 @@
-import sys
-from flask import Flask, render_template
-import json
+import os
+from flask import Flask, Response, g, render_template, request
+from api_index import DataIndex
+from response_cache import ResponseCache, dump_json
+from data_reloader import DataReloader
+from data_file import DATA_PATH, load_data
+from results_store import STORE_DIR, ResultsStore, open_store
+from series_index import SERIES_FIELDS, SeriesIndex
+from date_snapshots import SnapshotPublisher
+from geo_index import load_geo
+from request_metrics import STATIC, RequestMetrics, WsgiMetrics, parse_thresholds
 
 # create web app's instance
 app = Flask(__name__, static_url_path='', static_folder='build')
 # CORS(app)
 
-# Load json data
-with open('data.json', 'r') as f:
-    data = json.load(f)
+# Record the latency, size and status of every request, summed over the workers on /metrics
+metrics = RequestMetrics(flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 5)),
+                         slow_ms=float(os.environ.get('SLOW_REQUEST_MS', 1000)),
+                         slow_routes=parse_thresholds(os.environ.get('SLOW_REQUEST_ROUTES')))
+app.wsgi_app = WsgiMetrics(app.wsgi_app, metrics)
+
+
+def build_cache(raw):
+    '''
+    Build the lookups and the pre-serialized responses for the routes
+
+    Args:
+        raw (bytes): the content of data.json
+
+    Returns:
+        cache (ResponseCache): the cached responses
+    '''
+    # Load the arrays of the new version once, saving them first if they are missing
+    data = load_data(DATA_PATH, raw)
+    return ResponseCache(DataIndex(data))
+
+
+# Load json data, and reload it in the background whenever data.json changes
+reloader = DataReloader(DATA_PATH, build_cache, interval=float(os.environ.get('DATA_RELOAD_INTERVAL', 5)))
+
+
+def build_series(raw):
+    '''
+    Build the series of the scored results for /center/<center_id>/series
+
+    Args:
+        raw (bytes): the content of the index of the results store, replaced last when the store is written
+    '''
+    return SeriesIndex(ResultsStore(STORE_DIR))
+
+
+# Build the results store from the csv files if it is missing (under gunicorn the master has already
+# built it, see gunicorn.conf.py), and reload it whenever it is written
+open_store(STORE_DIR)
+series_reloader = DataReloader(os.path.join(STORE_DIR, 'index.json'), build_series,
+                               interval=float(os.environ.get('DATA_RELOAD_INTERVAL', 5)))
+
+
+# Materialize the /date/<date> snapshots of the current versions at startup, and again in the
+# background whenever the data or the results are reloaded
+publisher = SnapshotPublisher(reloader, series_reloader)
+
+# Load the geocoded centers, None if they have not been geocoded
+geo = load_geo()
+
+# the default number of centers of /centers/nearest
+NEAREST_CENTERS = 5
+
+# the answer of the geo routes when the centers have not been geocoded
+GEO_MISSING = 'The centers have not been geocoded, run python geo_index.py'
+
+
+def parse_point(args):
+    '''
+    Get the point of a query, from lat= and lng= or from zip=
+
+    Returns:
+        point (tuple): (lat, lng), None if it is missing, invalid or an unknown zip code
+    '''
+    if geo is None:
+        return None
+    if args.get('zip') is not None:
+        return geo.locate(args['zip'])
+    try:
+        lat, lng = float(args['lat']), float(args['lng'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+
+def add_risk_levels(centers, series):
+    '''
+    Add the last risk level of its state, and its date, to each center
+
+    The risk level is always the state's (risk_resolution 'state'), even when the centers are
+    scored against their counties in results/centers/<date>.csv
+    '''
+    for center in centers:
+        latest = series.latest(center['state_id'])
+        if latest is not None:
+            center['date'], center['risk_level'] = latest
+            center['risk_resolution'] = 'state'
+    return centers
+
+
+@app.before_request
+def label_route():
+    # The route of the request for the metrics, the static files under one label (and the unknown
+    # urls, which match the static files too, under UNMATCHED once they are answered 404)
+    if request.url_rule is not None:
+        request.environ['metrics.route'] = STATIC if request.endpoint == 'static' else request.url_rule.rule
+
+
+@app.before_request
+def pin_data():
+    # Make sure this worker is watching data.json
+    reloader.ensure_started()
+    series_reloader.ensure_started()
+    # Use the same versions of the data, the results and their snapshots for the whole request
+    g.loaded, g.series, g.snapshots = publisher.current
+
+
+@app.after_request
+def add_data_version(response):
+    loaded = g.get('loaded')
+    if loaded is not None:
+        response.headers['X-Data-Version'] = loaded.version
+    return response
+
+
+def send_cached(cached):
+    '''
+    Send a cached response in the best accepted encoding, or 304 if the client has it
+    '''
+    body, encoding, etag = cached.select(request.headers.get('Accept-Encoding'))
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+    if cached.not_modified(request.headers.get('If-None-Match')):
+        return Response(status=304, headers=headers)
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return Response(body, mimetype='application/json', headers=headers)
 
-# Get the last date in the data
-last_date = list(data['1']['dates'].keys())[-1]
 
 # Create a route for the home page
 @app.route('/')
@@ -22,56 +153,133 @@ def home():
 # Get the whole data
 @app.route('/data')
 def get_data():
-    return data
+    '''
+    Stream newline-delimited JSON for Accept: application/x-ndjson or ?stream=1
+    query: per=state|date, start=YYYY-MM-DD, end=YYYY-MM-DD, fields=new_cases,new_deaths,...
+    '''
+    if request.args.get('stream') != '1' and 'application/x-ndjson' not in request.headers.get('Accept', ''):
+        response = send_cached(g.loaded.value.data)
+        # The representation depends on the Accept header too
+        response.headers['Vary'] = 'Accept, Accept-Encoding'
+        return response
+
+    per = request.args.get('per', 'state')
+    if per not in ('state', 'date'):
+        return "Invalid Query"
+    fields = request.args.get('fields')
+    lines = g.loaded.value.iter_ndjson(per, request.args.get('start'), request.args.get('end'),
+                                       fields.split(',') if fields else None)
+    return Response(lines, mimetype='application/x-ndjson', headers={'Vary': 'Accept'})
 
 # Get the data where the posted center_id is located
 @app.route('/center/<center_id>')
 def get_center_data(center_id):
-    # Iterate through each state in the data
-    for state_id, state_data in data.items():
-        # Iterate through each center in the state
-        for c_id, c_data in state_data['centers'].items():
-            # If the center_id matches, return the state data
-            if c_id == center_id:
-                return data[state_id]
+    # Look up the state of the center, or return an empty dictionary
+    return send_cached(g.loaded.value.get_center(center_id))
+
+# Get the risk level and features of the center from start to end
+@app.route('/center/<center_id>/series')
+def get_center_series(center_id):
+    '''
+    query: start=YYYY-MM-DD, end=YYYY-MM-DD, fields=risk_level,7d_rolling_avg_new_cases_per_100k,...
+    '''
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else SERIES_FIELDS
+    if any(field not in SERIES_FIELDS for field in fields):
+        return "Invalid Fields"
 
-    # If no center_id matches, return an empty dictionary
-    return {}
+    # Look up the state of the center: the API serves the state results, the county results of
+    # cal_risk_level.py --counties are only written to results/centers/<date>.csv
+    state_id = g.loaded.value.index.center_to_state.get(center_id)
+    series = g.series.value.get_series(state_id, request.args.get('start'), request.args.get('end'), fields)
+    if series is None:
+        series = {}
+    else:
+        series = dict(center_id=center_id, state_id=state_id, risk_resolution='state', **series)
+    return Response(dump_json(series), mimetype='application/json')
+
+# Get the centers, states and dates posted in one request
+@app.route('/batch', methods=['POST'])
+def get_batch_data():
+    '''
+    body: {"center_ids": [...], "state_ids": [...], "dates": ["YYYY-MM-DD", ...]}, every list is optional
+    '''
+    query = request.get_json(silent=True)
+    if not isinstance(query, dict) or not all(isinstance(query.get(key, []), list)
+                                              for key in ('center_ids', 'state_ids', 'dates')):
+        return "Invalid Query"
+    ids = {key: [str(id_) for id_ in query.get(key, [])] for key in ('center_ids', 'state_ids', 'dates')}
+
+    # Resolve the ids against the cached responses of this version of the data, and stream the result
+    return Response(g.loaded.value.iter_batch(g.snapshots, **ids), mimetype='application/json')
 
 # Get the data where the posted date is located
 @app.route('/date/<date>', methods=['GET'])
 def get_date_data(date):
     '''
-    date format: YYYY-MM-DD
+    date format: YYYY-MM-DD, or latest
     '''
-    if date > last_date or date < '2020-03-13':
+    date = g.snapshots.resolve(date)
+    if date is None:
         return "Invalid Date"
 
-    # Iterate through each state in the data
-    new_dict = {}
-    for state_id, state_data in data.items():
-        # Iterate through each center in the state
-        for d_id, d_data in state_data['dates'].items():
-            # If the date matches, return the state data
-            if d_id == date:
-                new_dict[state_id] = {
-                    "state_name": state_data['state_name'],
-                    "data": d_data
-                }
+    # Send the snapshot of every state at the date
+    return send_cached(g.snapshots.get(date))
+
+# Get the data of every state from the start date to the end date
+@app.route('/date/<start>/<end>', methods=['GET'])
+def get_date_range_data(start, end):
+    '''
+    date format: YYYY-MM-DD, or latest
+    '''
+    start = g.snapshots.resolve(start)
+    end = g.snapshots.resolve(end)
+    if start is None or end is None or start > end:
+        return "Invalid Date"
 
-    return new_dict
+    # Stream the snapshots of the dates
+    return Response(g.snapshots.iter_range(start, end), mimetype='application/json')
 
 # Get the data where the posted state_id is located
 @app.route('/state/<state_id>')
 def get_state_data(state_id):
-    # Iterate through each state in the data
-    for s_id, s_data in data.items():
-        # If the state_id matches, return the state data
-        if s_id == state_id:
-            return data[state_id]
-
-    # If no state_id matches, return an empty dictionary
-    return {}
+    # Look up the state, or return an empty dictionary
+    return send_cached(g.loaded.value.get_state(state_id))
+
+# Get the centers within a distance of a point or a zip code, nearest first
+@app.route('/centers/within')
+def get_centers_within():
+    '''
+    query: lat=..&lng=.. or zip=XXXXX, radius=miles
+    '''
+    if geo is None:
+        return Response(GEO_MISSING, status=503, mimetype='text/plain')
+    point = parse_point(request.args)
+    radius = request.args.get('radius', type=float)
+    if point is None or radius is None or not radius >= 0:
+        return "Invalid Query"
+    return Response(dump_json(add_risk_levels(geo.within(*point, radius), g.series.value)),
+                    mimetype='application/json')
+
+# Get the centers nearest to a point or a zip code
+@app.route('/centers/nearest')
+def get_centers_nearest():
+    '''
+    query: lat=..&lng=.. or zip=XXXXX, k=number of centers (5 by default)
+    '''
+    if geo is None:
+        return Response(GEO_MISSING, status=503, mimetype='text/plain')
+    point = parse_point(request.args)
+    k = request.args.get('k', NEAREST_CENTERS, type=int)
+    if point is None or k < 1:
+        return "Invalid Query"
+    return Response(dump_json(add_risk_levels(geo.nearest(*point, k), g.series.value)),
+                    mimetype='application/json')
+
+# Get the request metrics of every worker, in the Prometheus text format
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 if __name__ == "__main__":
     app.run()
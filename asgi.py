@@ -0,0 +1,211 @@
+'''
+The API on an event loop, for the ASGI workers of uvicorn
+
+The routes are the same as app.py, and they share its data: the same reloaders build the
+cached responses, the series and the /date/<date> snapshots once per process in their
+threads, and every request on the event loop only reads the published versions. The cached bodies are sent without blocking the loop, and the streamed
+responses are generated in the thread pool, so a slow /data download never holds up
+the cheap lookups.
+
+Run it with
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+or
+    uvicorn asgi:app
+'''
+import json
+import os
+import re
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from response_cache import dump_json
+from series_index import SERIES_FIELDS
+from request_metrics import STATIC, AsgiMetrics
+from app import GEO_MISSING, NEAREST_CENTERS, add_risk_levels, geo, metrics, parse_point, publisher, reloader, series_reloader
+
+
+def send_cached(request, cached, loaded, vary='Accept-Encoding'):
+    '''
+    Send a cached response in the best accepted encoding, or 304 if the client has it
+    '''
+    body, encoding, etag = cached.select(request.headers.get('Accept-Encoding'))
+    headers = {'ETag': etag, 'Vary': vary, 'X-Data-Version': loaded.version}
+    if cached.not_modified(request.headers.get('If-None-Match')):
+        return Response(status_code=304, headers=headers)
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return Response(body, media_type='application/json', headers=headers)
+
+
+def send_text(text, loaded):
+    return PlainTextResponse(text, headers={'X-Data-Version': loaded.version})
+
+
+async def home(request):
+    return FileResponse(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'index.html'))
+
+
+async def get_data(request):
+    '''
+    Stream newline-delimited JSON for Accept: application/x-ndjson or ?stream=1
+    query: per=state|date, start=YYYY-MM-DD, end=YYYY-MM-DD, fields=new_cases,new_deaths,...
+    '''
+    loaded = publisher.current.loaded
+    if request.query_params.get('stream') != '1' and 'application/x-ndjson' not in request.headers.get('Accept', ''):
+        return send_cached(request, loaded.value.data, loaded, vary='Accept, Accept-Encoding')
+
+    per = request.query_params.get('per', 'state')
+    if per not in ('state', 'date'):
+        return send_text('Invalid Query', loaded)
+    fields = request.query_params.get('fields')
+    # The lines are generated in the thread pool, one at a time
+    lines = loaded.value.iter_ndjson(per, request.query_params.get('start'), request.query_params.get('end'),
+                                     fields.split(',') if fields else None)
+    return StreamingResponse(lines, media_type='application/x-ndjson',
+                             headers={'Vary': 'Accept', 'X-Data-Version': loaded.version})
+
+
+async def get_center_data(request):
+    loaded = publisher.current.loaded
+    return send_cached(request, loaded.value.get_center(request.path_params['center_id']), loaded)
+
+
+async def get_center_series(request):
+    '''
+    query: start=YYYY-MM-DD, end=YYYY-MM-DD, fields=risk_level,7d_rolling_avg_new_cases_per_100k,...
+    '''
+    loaded, series_loaded, _ = publisher.current
+    center_id = request.path_params['center_id']
+    fields = request.query_params.get('fields')
+    fields = fields.split(',') if fields else SERIES_FIELDS
+    if any(field not in SERIES_FIELDS for field in fields):
+        return send_text('Invalid Fields', loaded)
+
+    # Look up the state of the center: the API serves the state results, the county results of
+    # cal_risk_level.py --counties are only written to results/centers/<date>.csv
+    state_id = loaded.value.index.center_to_state.get(center_id)
+    series = series_loaded.value.get_series(state_id, request.query_params.get('start'),
+                                            request.query_params.get('end'), fields)
+    if series is None:
+        series = {}
+    else:
+        series = dict(center_id=center_id, state_id=state_id, risk_resolution='state', **series)
+    return Response(dump_json(series), media_type='application/json', headers={'X-Data-Version': loaded.version})
+
+
+async def get_batch_data(request):
+    '''
+    body: {"center_ids": [...], "state_ids": [...], "dates": ["YYYY-MM-DD", ...]}, every list is optional
+    '''
+    loaded, _, snapshots = publisher.current
+    try:
+        query = json.loads(await request.body())
+    except ValueError:
+        query = None
+    if not isinstance(query, dict) or not all(isinstance(query.get(key, []), list)
+                                              for key in ('center_ids', 'state_ids', 'dates')):
+        return send_text('Invalid Query', loaded)
+    ids = {key: [str(id_) for id_ in query.get(key, [])] for key in ('center_ids', 'state_ids', 'dates')}
+    return StreamingResponse(loaded.value.iter_batch(snapshots, **ids), media_type='application/json',
+                             headers={'X-Data-Version': loaded.version})
+
+
+async def get_date_data(request):
+    '''
+    date format: YYYY-MM-DD, or latest
+    '''
+    loaded, _, snapshots = publisher.current
+    date = snapshots.resolve(request.path_params['date'])
+    if date is None:
+        return send_text('Invalid Date', loaded)
+    return send_cached(request, snapshots.get(date), loaded)
+
+
+async def get_date_range_data(request):
+    '''
+    date format: YYYY-MM-DD, or latest
+    '''
+    loaded, _, snapshots = publisher.current
+    start = snapshots.resolve(request.path_params['start'])
+    end = snapshots.resolve(request.path_params['end'])
+    if start is None or end is None or start > end:
+        return send_text('Invalid Date', loaded)
+    return StreamingResponse(snapshots.iter_range(start, end), media_type='application/json',
+                             headers={'X-Data-Version': loaded.version})
+
+
+async def get_state_data(request):
+    loaded = publisher.current.loaded
+    return send_cached(request, loaded.value.get_state(request.path_params['state_id']), loaded)
+
+
+async def get_centers_within(request):
+    '''
+    query: lat=..&lng=.. or zip=XXXXX, radius=miles
+    '''
+    loaded, series_loaded, _ = publisher.current
+    if geo is None:
+        return PlainTextResponse(GEO_MISSING, status_code=503, headers={'X-Data-Version': loaded.version})
+    point = parse_point(request.query_params)
+    try:
+        radius = float(request.query_params['radius'])
+    except (KeyError, ValueError):
+        radius = None
+    if point is None or radius is None or not radius >= 0:
+        return send_text('Invalid Query', loaded)
+    centers = add_risk_levels(geo.within(*point, radius), series_loaded.value)
+    return Response(dump_json(centers), media_type='application/json', headers={'X-Data-Version': loaded.version})
+
+
+async def get_centers_nearest(request):
+    '''
+    query: lat=..&lng=.. or zip=XXXXX, k=number of centers (5 by default)
+    '''
+    loaded, series_loaded, _ = publisher.current
+    if geo is None:
+        return PlainTextResponse(GEO_MISSING, status_code=503, headers={'X-Data-Version': loaded.version})
+    point = parse_point(request.query_params)
+    try:
+        k = int(request.query_params.get('k', NEAREST_CENTERS))
+    except ValueError:
+        k = NEAREST_CENTERS
+    if point is None or k < 1:
+        return send_text('Invalid Query', loaded)
+    centers = add_risk_levels(geo.nearest(*point, k), series_loaded.value)
+    return Response(dump_json(centers), media_type='application/json', headers={'X-Data-Version': loaded.version})
+
+
+async def get_metrics(request):
+    return Response(metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+def start_reloaders():
+    # Watch data.json and the results store from this worker
+    reloader.ensure_started()
+    series_reloader.ensure_started()
+
+
+routes = [
+    Route('/', home),
+    Route('/data', get_data),
+    Route('/center/{center_id}', get_center_data),
+    Route('/center/{center_id}/series', get_center_series),
+    Route('/batch', get_batch_data, methods=['POST']),
+    Route('/date/{date}', get_date_data),
+    Route('/date/{start}/{end}', get_date_range_data),
+    Route('/state/{state_id}', get_state_data),
+    Route('/centers/within', get_centers_within),
+    Route('/centers/nearest', get_centers_nearest),
+    Route('/metrics', get_metrics),
+]
+# The static files Flask serves from the build folder
+if os.path.isdir('build'):
+    routes.append(Mount('/', StaticFiles(directory='build')))
+
+# Label the requests with the same routes as app.py, e.g. /center/<center_id>
+route_labels = {route.endpoint: re.sub(r'\{(\w+)\}', r'<\1>', route.path) for route in routes if isinstance(route, Route)}
+route_labels.update({route.app: STATIC for route in routes if isinstance(route, Mount)})
+app = Starlette(routes=routes, on_startup=[start_reloaders],
+                middleware=[Middleware(AsgiMetrics, metrics=metrics, routes=route_labels)])
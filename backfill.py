@@ -0,0 +1,227 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import features
+import risk
+from data_file import load_data
+from results_store import ResultsStore, results_frame, split_frame, write_csvs
+
+# the number of previous records the 7d rolling windows look back
+LOOKBACK = 6
+
+# the number of chunks per worker, more chunks balance the load better
+CHUNKS_PER_WORKER = 4
+
+# the arrays of the source data, attached from shared memory in each worker
+_shared = {}
+
+
+def share_arrays(arrays):
+    '''
+    Copy arrays into shared memory blocks
+
+    Args:
+        arrays (dict): name -> np.ndarray
+
+    Returns:
+        blocks (list): the SharedMemory blocks, to be unlinked when done
+        specs (dict): name -> (block name, shape, dtype), to attach the arrays in the workers
+    '''
+    blocks = []
+    specs = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def init_worker(specs, states, results_dir):
+    '''
+    Attach the shared arrays in a worker process
+    '''
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        # keep the block open for as long as the array is used
+        _shared[f'_{name}_block'] = block
+    _shared['states'] = states
+    _shared['results_dir'] = results_dir
+
+
+def score_chunk(lo, hi):
+    '''
+    Calculate the features and the risk level of the dates in columns lo to hi, and write their csv files
+
+    Returns:
+        dates (list): the dates written
+        chunk_features (dict): feature -> (n_states, n_dates) values
+        risk_level (np.ndarray): (n_states, n_dates) the risk levels
+    '''
+    dates = _shared['dates']
+    cols = np.arange(lo, hi)[_shared['keep'][lo:hi]]
+    chunk_dates = dates[cols].tolist()
+    if not chunk_dates:
+        return chunk_dates, {}, None
+
+    rows = _shared['rows']
+    population = _shared['population2021'][rows][:, None]
+    # The position of each date among the records of its state
+    rank = _shared['rank'][np.ix_(rows, cols)]
+    # Slice the records of the chunk with the lookback of the rolling windows
+    start = max(int(rank.min()) - LOOKBACK, 0)
+    stop = int(rank.max()) + 1
+    daily_new_cases_per_100k = _shared['new_cases'][rows, start:stop] / population * 100000
+    daily_new_deaths_per_100k = _shared['new_deaths'][rows, start:stop] / population * 100000
+    avg_cases, avg_deaths = features.rolling_features(daily_new_cases_per_100k, daily_new_deaths_per_100k)
+
+    def take(values):
+        return np.take_along_axis(values, rank - start, axis=1)
+
+    chunk_features = {
+        'daily_new_cases_per_100k': take(daily_new_cases_per_100k),
+        '7d_rolling_avg_new_cases_per_100k': take(avg_cases),
+        'daily_new_deaths_per_100k': take(daily_new_deaths_per_100k),
+        '7d_rolling_avg_new_deaths_per_100k': take(avg_deaths),
+        'daily_percentage_of_people_who_received_at_least_one_dose':
+            _shared['People_at_least_one_dose'][np.ix_(rows, cols)] / population * 100,
+        'daily_percentage_of_people_who_are_fully_vaccinated':
+            _shared['People_fully_vaccinated'][np.ix_(rows, cols)] / population * 100,
+    }
+    risk_level = risk.score(chunk_features)
+
+    # Write the csv files of the chunk
+    df = results_frame(_shared['states'], chunk_dates, chunk_features, risk_level)
+    write_csvs(df, chunk_dates, _shared['results_dir'])
+
+    return chunk_dates, chunk_features, risk_level
+
+
+def prepare(data, start=None, end=None):
+    '''
+    Build the arrays the workers need from the data of data.json
+
+    Args:
+        data (dict or Dataset): the data from the data.json file
+        start (str): the first date to backfill (YYYY-MM-DD), the first date if None
+        end (str): the last date to backfill (YYYY-MM-DD), the last date if None
+
+    Returns:
+        arrays (dict): name -> np.ndarray, to be shared with the workers
+        states (list): the state information of the states with records
+    '''
+    matrix = features.build_matrix(data)
+    present = matrix['present']
+    order, counts = features.compact_order(present)
+
+    # The records of each state moved to the left, as calculate_features does
+    arrays = {
+        'dates': matrix['dates'],
+        'population2021': matrix['population2021'],
+        'People_at_least_one_dose': matrix['People_at_least_one_dose'],
+        'People_fully_vaccinated': matrix['People_fully_vaccinated'],
+        'new_cases': np.take_along_axis(matrix['new_cases'], order, axis=1),
+        'new_deaths': np.take_along_axis(matrix['new_deaths'], order, axis=1),
+        'rank': (np.cumsum(present, axis=1) - 1).astype(np.int64),
+    }
+
+    # Leave out the last record of each state (today)
+    present = present.copy()
+    with_records = np.nonzero(counts)[0]
+    present[with_records, order[with_records, counts[with_records] - 1]] = False
+
+    # Save the dates in the range that every state with records has a record for
+    rows = present.any(axis=1).nonzero()[0]
+    keep = present[rows].all(axis=0)
+    if start is not None:
+        keep &= matrix['dates'] >= start
+    if end is not None:
+        keep &= matrix['dates'] <= end
+    arrays['keep'] = keep
+    arrays['rows'] = rows
+
+    states = []
+    for row in rows:
+        state_id = matrix['state_ids'][row]
+        states.append({
+            'state_id': state_id,
+            'state_name': data[state_id]['state_name'],
+            'state_abbr': data[state_id]['state_abbr'],
+            'population2021': data[state_id]['population2021'],
+        })
+    return arrays, states
+
+
+def backfill(data, start=None, end=None, workers=None, results_dir='results', write_store=True):
+    '''
+    Recompute the results of a range of dates in a process pool
+
+    The source arrays are built once and shared with the workers through shared memory.
+    The range is split into chunks of dates, each worker calculates its chunks with the
+    lookback of the rolling windows and writes their csv files, and the results store is
+    written once at the end.
+
+    Returns:
+        dates (list): the dates written, as 'YYYY-MM-DD' in order
+    '''
+    workers = workers or os.cpu_count()
+    arrays, states = prepare(data, start, end)
+    cols = np.nonzero(arrays['keep'])[0]
+    if not len(cols):
+        print('> No dates to backfill')
+        return []
+
+    # Split the columns of the range into chunks
+    n_chunks = min(len(cols), workers * CHUNKS_PER_WORKER)
+    bounds = [(int(chunk[0]), int(chunk[-1]) + 1) for chunk in np.array_split(cols, n_chunks)]
+    print(f'> Backfilling {len(cols)} dates in {n_chunks} chunks with {workers} workers')
+
+    blocks, specs = share_arrays(arrays)
+    frames = {}
+    dates = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(specs, states, results_dir)) as executor:
+            futures = [executor.submit(score_chunk, lo, hi) for lo, hi in bounds]
+            for future in futures:
+                chunk_dates, chunk_features, risk_level = future.result()
+                dates.extend(chunk_dates)
+                if chunk_dates and write_store:
+                    df = results_frame(states, chunk_dates, chunk_features, risk_level)
+                    frames.update(split_frame(df, chunk_dates))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    if write_store:
+        print('> Writing the results store')
+        ResultsStore().write(frames)
+    return dates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute the historical risk results in parallel')
+    parser.add_argument('--start', help='the first date to backfill (YYYY-MM-DD)')
+    parser.add_argument('--end', help='the last date to backfill (YYYY-MM-DD)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='the number of worker processes')
+    parser.add_argument('--data', default='data.json', help='the data.json file to read')
+    parser.add_argument('--results', default='results', help='the folder to write the csv files to')
+    parser.add_argument('--no-store', action='store_true', help='only write the csv files')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    print('Reading data...')
+    data = load_data(args.data)
+    print('Backfilling...')
+    dates = backfill(data, args.start, args.end, args.workers, args.results, not args.no_store)
+    print(f'Done! {len(dates)} dates in {time.time() - start_time:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
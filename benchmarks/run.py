@@ -0,0 +1,337 @@
+'''
+Benchmark the hot paths of the pipeline and the API on synthetic data, offline
+
+Each run generates the upstream sources at a scale of the current size, serves them from a
+local HTTP server, keeps the reference tables in SQLite, and runs every stage in a
+temporary folder: fetching, preprocessing, writing and loading data.json and its arrays, the features,
+the scoring, init_calculate, the daily calculation, the API startup, the API routes and the
+overhead of the request metrics. With --counties, the county file is fetched, saved and used
+for the daily calculation as well.
+The time and the peak RSS of each stage are saved as JSON, to compare runs.
+
+Usage (from the repository root):
+    python benchmarks/run.py --scale 1 10 [--date-scale 1] [--counties] [--out results.json] [--compare base.json]
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The API reloads data.json only when asked to in the benchmark
+os.environ.setdefault('DATA_RELOAD_INTERVAL', '1e9')
+
+import calculate_risk_daily
+import county_data
+import data_file
+import fetch_data
+import geo_index
+import init_calculate
+import risk
+from instrumentation import RssSampler, rss_bytes
+from request_metrics import RequestMetrics, WsgiMetrics
+from standins import reference_db, serve_files
+from synthetic import (BASE_CENTERS, BASE_COUNTIES, BASE_DATES, BASE_STATES, make_centers_geo, make_county_sources,
+                       make_sources)
+
+# the folder of the benchmark results
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# the number of requests timed for each route
+ROUTE_REQUESTS = 200
+LARGE_ROUTE_REQUESTS = 10
+# the number of requests timed with and without the request metrics
+METRICS_REQUESTS = 50000
+
+
+class Stages(object):
+    '''
+    The time and the memory of each stage of a run
+    '''
+
+    def __init__(self):
+        self.results = {}
+
+    @contextmanager
+    def stage(self, name, **counts):
+        print(f'> {name}...')
+        start_rss = rss_bytes()
+        with RssSampler(interval=0.005) as sampler:
+            start = time.perf_counter()
+            yield counts
+            seconds = time.perf_counter() - start
+        self.results[name] = dict(seconds=round(seconds, 4), peak_rss_mb=round(sampler.peak / 2 ** 20, 1),
+                                  rss_growth_mb=round((sampler.peak - start_rss) / 2 ** 20, 1), **counts)
+        print(f'  {seconds:.3f}s, peak RSS {sampler.peak / 2 ** 20:.0f} MB')
+
+
+def time_requests(client, method, paths, n, body=None):
+    '''
+    Time n requests to the API, cycling through the paths
+
+    Returns:
+        timings (dict): the number of requests and the mean, p50 and p99 latency in ms
+    '''
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        response = client.open(paths[i % len(paths)], method=method, json=body)
+        response.get_data()
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, paths[i % len(paths)]
+    return {
+        'requests': n,
+        'mean_ms': round(float(np.mean(latencies)), 3),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+    }
+
+
+def bench_routes(data):
+    '''
+    Time the routes of the API on the data.json of the current folder
+    '''
+    import app as api
+    client = api.app.test_client()
+    state_ids = list(data)
+    center_ids = [center_id for state_data in data.values() for center_id in state_data['centers']]
+    dates = api.reloader.current.value.index.dates
+    return {
+        '/state/<state_id>': time_requests(client, 'GET', [f'/state/{s}' for s in state_ids], ROUTE_REQUESTS),
+        '/center/<center_id>': time_requests(client, 'GET', [f'/center/{c}' for c in center_ids], ROUTE_REQUESTS),
+        '/center/<center_id>/series': time_requests(
+            client, 'GET', [f'/center/{c}/series?start={dates[len(dates) // 2]}' for c in center_ids], ROUTE_REQUESTS),
+        # Every date in sequence, like a map animation
+        '/date/<date>': time_requests(client, 'GET', [f'/date/{d}' for d in dates], max(ROUTE_REQUESTS, len(dates))),
+        '/date/latest': time_requests(client, 'GET', ['/date/latest'], ROUTE_REQUESTS),
+        '/data': time_requests(client, 'GET', ['/data'], LARGE_ROUTE_REQUESTS),
+        '/data?stream=1': time_requests(client, 'GET', ['/data?stream=1'], LARGE_ROUTE_REQUESTS),
+        '/centers/within': time_requests(
+            client, 'GET', [f'/centers/within?lat={lat}&lng=-95&radius=100' for lat in range(30, 46)], ROUTE_REQUESTS),
+        '/centers/nearest': time_requests(
+            client, 'GET', [f'/centers/nearest?lat={lat}&lng=-95&k=5' for lat in range(30, 46)], ROUTE_REQUESTS),
+        'POST /batch': time_requests(client, 'POST', ['/batch'], LARGE_ROUTE_REQUESTS,
+                                     body={'center_ids': center_ids}),
+    }
+
+
+def bench_metrics_overhead(n=METRICS_REQUESTS):
+    '''
+    Time the request metrics middleware around an app that sends a small cached body
+
+    Returns:
+        timings (dict): the time per request without and with the middleware, and the difference, in µs
+    '''
+    body = [b'{}\n']
+
+    def bare_app(environ, start_response):
+        environ['metrics.route'] = '/state/<state_id>'
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return body
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    # Never log the requests as slow, and flush to the temporary folder of the run
+    metrics = RequestMetrics(directory=os.path.join(os.getcwd(), 'metrics'), slow_ms=float('inf'))
+    timings = {}
+    for name, wsgi_app in [('bare_us', bare_app), ('metered_us', WsgiMetrics(bare_app, metrics))]:
+        start = time.perf_counter()
+        for _ in range(n):
+            response = wsgi_app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/state/1'}, start_response)
+            for chunk in response:
+                pass
+            if hasattr(response, 'close'):
+                response.close()
+        timings[name] = round((time.perf_counter() - start) / n * 1e6, 3)
+    timings['overhead_us'] = round(timings['metered_us'] - timings['bare_us'], 3)
+    return timings
+
+
+def start_api():
+    '''
+    Load the API on the data.json of the current folder, importing it the first time
+    '''
+    if 'app' not in sys.modules:
+        import app as api
+    else:
+        api = sys.modules['app']
+        api.reloader.check()
+        api.series_reloader.check()
+        api.publisher.publish()
+
+
+def run_scale(scale, date_scale, seed=0, counties=False):
+    '''
+    Run every stage on synthetic data at a scale
+
+    Args:
+        scale (float): the scale of the states, the centers and the counties
+        date_scale (float): the scale of the dates
+        counties (bool): also run the county-level stages
+
+    Returns:
+        run (dict): the shape of the data and the results of each stage
+    '''
+    n_states = int(BASE_STATES * scale)
+    n_dates = int(BASE_DATES * date_scale)
+    n_centers = int(BASE_CENTERS * scale)
+    n_counties = int(BASE_COUNTIES * scale) if counties else 0
+    print(f'Scale {scale}: {n_states} states x {n_dates} dates, {n_centers} centers, {n_counties} counties')
+    stages = Stages()
+
+    with stages.stage('generate') as counts:
+        sources = make_sources(n_states, n_dates, n_centers, seed)
+        counts['csv_bytes'] = len(sources['covid_csv']) + len(sources['vaccination_csv'])
+    county_sources = {'counties': None}
+    if counties:
+        with stages.stage('generate_counties') as counts:
+            county_sources = make_county_sources(sources['states'], sources['locations'], n_dates, n_counties, seed)
+            counts['csv_bytes'] = len(county_sources['counties_csv'])
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            sources['locations'].to_csv('centers.csv', index=False)
+            make_centers_geo(sources['locations'], seed).to_csv(geo_index.CENTERS_GEO_PATH, index=False)
+            files = {'/us-states.csv': sources['covid_csv'], '/vaccinations.csv': sources['vaccination_csv']}
+            with serve_files(files) as base_url:
+                with stages.stage('fetch') as counts:
+                    covid_df = fetch_data.fetch_data(f'{base_url}/us-states.csv', f'{base_url}/vaccinations.csv')
+                    counts['rows'] = len(covid_df)
+
+            conn = reference_db(sources['states'], sources['locations'], county_sources['counties'])
+            with stages.stage('preprocess') as counts:
+                data = fetch_data.preprocess(covid_df, conn)
+                counts['records'] = sum(len(state_data['dates']) for state_data in data.values())
+            del covid_df, sources
+
+            with stages.stage('write_data') as counts:
+                data_file.write_data(data)
+                counts['json_bytes'] = os.path.getsize(data_file.DATA_PATH)
+            with stages.stage('load_data_json'):
+                with open(data_file.DATA_PATH, 'rb') as f:
+                    json.loads(f.read())
+            with stages.stage('load_data'):
+                data = data_file.parse_data()
+            # The jobs and the API read the memory-mapped arrays instead
+            with stages.stage('load_dataset') as counts:
+                data = data_file.load_dataset()
+                counts['array_bytes'] = data.cube.nbytes + data.present.nbytes
+
+            init_calculate.data = data
+            with stages.stage('features') as counts:
+                result, dates = init_calculate.calculate_features()
+                counts['dates'] = len(dates)
+            with stages.stage('score'):
+                risk.score(result)
+            del result
+            with stages.stage('init_calculate') as counts:
+                init_calculate.main()
+                counts['files'] = len(dates)
+
+            # The first day rebuilds the rolling window, the next one moves the checkpoint
+            with stages.stage('daily_rebuild'):
+                window = calculate_risk_daily.calculate_risk_by_date(dates[-2])[2]
+                window.save()
+            with stages.stage('daily'):
+                calculate_risk_daily.calculate_risk_by_date(dates[-1])
+
+            if counties:
+                with serve_files({'/us-counties.csv': county_sources['counties_csv']}) as base_url:
+                    with stages.stage('fetch_counties') as counts:
+                        county_df, records = county_data.fetch_counties(conn, f'{base_url}/us-counties.csv')
+                        counts['rows'] = len(records)
+                del county_sources
+                with stages.stage('write_counties'):
+                    county_data.write_counties(county_df, records)
+                with stages.stage('daily_counties'):
+                    calculate_risk_daily.calculate_risk_by_date(dates[-1], county_data.load_counties())
+
+            with stages.stage('api_startup'):
+                start_api()
+            with stages.stage('api_routes') as counts:
+                counts['routes'] = bench_routes(data)
+            with stages.stage('api_metrics') as counts:
+                counts.update(bench_metrics_overhead())
+                print(f'  request metrics overhead: {counts["overhead_us"]:.1f} µs per request')
+        finally:
+            os.chdir(cwd)
+
+    return {
+        'scale': scale,
+        'date_scale': date_scale,
+        'shape': {'states': n_states, 'dates': n_dates, 'centers': n_centers, 'counties': n_counties},
+        'stages': stages.results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(runs, base_path):
+    '''
+    Print the time of each stage against a previous run of the same scale
+    '''
+    with open(base_path, 'r') as f:
+        base = {(run['scale'], run['date_scale']): run for run in json.load(f)['runs']}
+    for run in runs:
+        base_run = base.get((run['scale'], run['date_scale']))
+        if base_run is None:
+            continue
+        print(f'Scale {run["scale"]} against {base_path}')
+        print(f'  {"stage":<18}{"base s":>10}{"now s":>10}{"ratio":>8}')
+        for name, result in run['stages'].items():
+            if name in base_run['stages']:
+                before = base_run['stages'][name]['seconds']
+                ratio = result['seconds'] / before if before else float('nan')
+                print(f'  {name:<18}{before:>10.3f}{result["seconds"]:>10.3f}{ratio:>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, nargs='+', default=[1], help='the scales of the states and the centers')
+    parser.add_argument('--date-scale', type=float, default=1, help='the scale of the dates')
+    parser.add_argument('--counties', action='store_true', help='also run the county-level stages')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the synthetic data')
+    parser.add_argument('--out', help='the JSON file to write, benchmarks/results/<timestamp>.json by default')
+    parser.add_argument('--compare', help='a previous JSON file to compare the stage times with')
+    args = parser.parse_args()
+
+    runs = [run_scale(scale, args.date_scale, args.seed, args.counties) for scale in args.scale]
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'runs': runs,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f'{datetime.datetime.now():%Y%m%d-%H%M%S}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Saved {out}')
+
+    if args.compare:
+        compare(runs, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+Offline stand-ins for the HTTP sources and the PostgreSQL reference tables
+'''
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from reference_data import REFERENCE_TABLES
+
+
+@contextmanager
+def serve_files(files, etags=None, failures=None, delay=0.0, log=None):
+    '''
+    Serve some files from memory on a local HTTP server
+
+    Args:
+        files (dict): path (e.g. '/us-states.csv') -> bytes
+        etags (dict): path -> ETag, sent with the file and answered with 304 Not Modified to a
+            request with the same If-None-Match, optional
+        failures (dict): path -> the number of requests answered with 503 before the file is served, optional
+        delay (float): seconds to wait before answering each request
+        log (list): (path, status, start, end) is appended for each request, with perf_counter times, optional
+
+    Yields:
+        base_url (str): the url of the server, e.g. http://127.0.0.1:port
+    '''
+    etags = etags or {}
+    failures = dict(failures or {})
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = time.perf_counter()
+            time.sleep(delay)
+            status = self.answer()
+            if log is not None:
+                log.append((self.path, status, start, time.perf_counter()))
+
+        def answer(self):
+            body = files.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return 404
+            with lock:
+                failing = failures.get(self.path, 0) > 0
+                if failing:
+                    failures[self.path] -= 1
+            if failing:
+                self.send_error(503)
+                return 503
+            etag = etags.get(self.path)
+            if etag is not None and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return 304
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(len(body)))
+            if etag is not None:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+            return 200
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def reference_db(states_df, locations_df, counties_df=None):
+    '''
+    Create an in-memory SQLite database with the reference tables, under the same yfz schema
+
+    The counties table is only created if counties_df is given
+
+    Returns:
+        conn (sqlite3.Connection): a DB-API connection reference_data can read from
+    '''
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.execute("ATTACH DATABASE ':memory:' AS yfz")
+    tables = [('states', states_df), ('locations', locations_df)]
+    if counties_df is not None:
+        tables.append(('counties', counties_df))
+    for name, df in tables:
+        table = REFERENCE_TABLES[name]
+        columns = table['columns']
+        conn.execute(f"CREATE TABLE {table['table']} ({', '.join(columns)})")
+        conn.executemany(f"INSERT INTO {table['table']} VALUES ({', '.join('?' * len(columns))})",
+                         df[columns].to_dict('split')['data'])
+    conn.commit()
+    return conn
+
+
+class StandinPool(object):
+    '''
+    A stand-in of the psycopg2 pool, handing out a single SQLite connection
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.borrowed = 0
+        self.returned = 0
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            self.borrowed += 1
+        return self.conn
+
+    def putconn(self, conn):
+        with self.lock:
+            self.returned += 1
@@ -0,0 +1,171 @@
+'''
+Synthetic stand-ins for the upstream sources, sized like the real ones times a scale
+
+The base size is the current production size: 56 states, about 1000 dates, 250
+fulfillment centers and 3200 counties. Every dimension can be scaled on its own.
+'''
+import datetime
+import numpy as np
+import pandas as pd
+
+# the current size of the data
+BASE_STATES = 56
+BASE_DATES = 1000
+BASE_CENTERS = 250
+BASE_COUNTIES = 3200
+
+# the first date of the covid data and of the vaccination data
+FIRST_DATE = datetime.date(2020, 1, 21)
+FIRST_VACCINATION_DATE = datetime.date(2020, 12, 14)
+
+
+def make_sources(n_states=BASE_STATES, n_dates=BASE_DATES, n_centers=BASE_CENTERS, seed=0):
+    '''
+    Generate the two upstream csv files and the two reference tables
+
+    Each state starts reporting on one of its first 50 days and then reports every day, with
+    growing cumulative cases, deaths and vaccinations.
+
+    Args:
+        n_states (int): the number of states
+        n_dates (int): the number of dates
+        n_centers (int): the number of fulfillment centers, spread over the states
+        seed (int): the seed of the random numbers
+
+    Returns:
+        sources (dict): {
+            'covid_csv': bytes, the same columns as the nytimes us-states.csv,
+            'vaccination_csv': bytes, the same columns as the govex vaccine time series,
+            'states': pandas dataframe, the rows of yfz.states,
+            'locations': pandas dataframe, the rows of yfz.locations,
+        }
+    '''
+    rng = np.random.default_rng(seed)
+    state_ids = np.arange(1, n_states + 1)
+    state_names = np.array([f'State {state_id}' for state_id in state_ids])
+    population = rng.integers(500000, 40000000, n_states)
+    dates = pd.date_range(FIRST_DATE, periods=n_dates).strftime('%Y-%m-%d').to_numpy()
+
+    # The (state x date) cumulative figures, from the first date each state reports
+    first = rng.integers(0, min(50, n_dates), n_states)
+    reporting = np.arange(n_dates)[None, :] >= first[:, None]
+    cases = np.cumsum(rng.poisson(population[:, None] / 20000, (n_states, n_dates)) * reporting, axis=1)
+    deaths = np.cumsum(rng.poisson(population[:, None] / 2000000, (n_states, n_dates)) * reporting, axis=1)
+    vaccinating = dates >= FIRST_VACCINATION_DATE.isoformat()
+    one_dose = np.minimum(np.cumsum(rng.poisson(population[:, None] / 500, (n_states, n_dates)) * vaccinating,
+                                    axis=1), population[:, None])
+    fully_vaccinated = np.minimum(one_dose, np.cumsum(rng.poisson(population[:, None] / 600, (n_states, n_dates))
+                                                      * vaccinating, axis=1))
+
+    # The csv files have one row per date and state, ordered by date
+    date_pos, state_pos = np.nonzero(reporting.T)
+    covid_df = pd.DataFrame({
+        'date': dates[date_pos],
+        'state': state_names[state_pos],
+        'fips': state_ids[state_pos],
+        'cases': cases[state_pos, date_pos],
+        'deaths': deaths[state_pos, date_pos],
+    })
+    date_pos, state_pos = np.nonzero(np.broadcast_to(vaccinating[:, None], (n_dates, n_states)))
+    vaccination_df = pd.DataFrame({
+        'Date': dates[date_pos],
+        'UID': 84000000 + state_ids[state_pos],
+        'Province_State': state_names[state_pos],
+        'Country_Region': 'US',
+        'Doses_admin': one_dose[state_pos, date_pos] + fully_vaccinated[state_pos, date_pos],
+        'People_at_least_one_dose': one_dose[state_pos, date_pos],
+        'People_fully_vaccinated': fully_vaccinated[state_pos, date_pos],
+        'Total_additional_doses': '',
+    })
+
+    states_df = pd.DataFrame({
+        'state_id': state_ids,
+        'state_name': state_names,
+        'state_fips': state_ids,
+        'state_abbr': [f'S{state_id}' for state_id in state_ids],
+        'population2020': population - rng.integers(0, 10000, n_states),
+        'population2021': population,
+    })
+    center_ids = np.arange(1, n_centers + 1)
+    locations_df = pd.DataFrame({
+        'center_id': center_ids,
+        'center_name': [f'#C{center_id}' for center_id in center_ids],
+        'county_id': rng.integers(1, 3000, n_centers),
+        'state_id': rng.choice(state_ids, n_centers),
+        'zip_code': rng.integers(1000, 99999, n_centers),
+    })
+
+    return {
+        'covid_csv': covid_df.to_csv(index=False).encode('utf-8'),
+        'vaccination_csv': vaccination_df.to_csv(index=False).encode('utf-8'),
+        'states': states_df,
+        'locations': locations_df,
+    }
+
+
+def make_county_sources(states_df, locations_df, n_dates=BASE_DATES, n_counties=BASE_COUNTIES, seed=0):
+    '''
+    Generate the county csv file and the counties reference table
+
+    Each county starts reporting on one of its first 80 days and then reports every day.
+    The counties of the centers are counties of the table.
+
+    Args:
+        states_df (pandas dataframe): the rows of yfz.states
+        locations_df (pandas dataframe): the rows of yfz.locations
+        n_dates (int): the number of dates
+        n_counties (int): the number of counties
+        seed (int): the seed of the random numbers
+
+    Returns:
+        sources (dict): {
+            'counties_csv': bytes, the same columns as the nytimes us-counties.csv,
+            'counties': pandas dataframe, the rows of yfz.counties,
+        }
+    '''
+    rng = np.random.default_rng(seed + 1)
+    county_ids = np.arange(1, n_counties + 1)
+    state_pos = rng.integers(0, len(states_df), n_counties)
+    # The centers are in counties of their state
+    centers = locations_df[locations_df['county_id'] <= n_counties]
+    state_pos[centers['county_id'].to_numpy() - 1] = pd.Index(states_df['state_id']).get_indexer(centers['state_id'])
+    fips = 1000 + county_ids
+    population = rng.integers(1000, 2000000, n_counties)
+    dates = pd.date_range(FIRST_DATE, periods=n_dates).strftime('%Y-%m-%d').to_numpy()
+
+    first = rng.integers(0, min(80, n_dates), n_counties)
+    reporting = np.arange(n_dates)[None, :] >= first[:, None]
+    cases = np.cumsum(rng.poisson(population[:, None] / 20000, (n_counties, n_dates)) * reporting, axis=1)
+    deaths = np.cumsum(rng.poisson(population[:, None] / 2000000, (n_counties, n_dates)) * reporting, axis=1)
+
+    date_pos, county_pos = np.nonzero(reporting.T)
+    county_names = np.array([f'County {county_id}' for county_id in county_ids])
+    counties_df = pd.DataFrame({
+        'date': dates[date_pos],
+        'county': county_names[county_pos],
+        'state': states_df['state_name'].to_numpy()[state_pos][county_pos],
+        'fips': fips[county_pos],
+        'cases': cases[county_pos, date_pos],
+        'deaths': deaths[county_pos, date_pos],
+    })
+    return {
+        'counties_csv': counties_df.to_csv(index=False).encode('utf-8'),
+        'counties': pd.DataFrame({
+            'county_id': county_ids,
+            'county_name': county_names,
+            'county_fips': fips,
+            'state_id': states_df['state_id'].to_numpy()[state_pos],
+            'population2021': population,
+        }),
+    }
+
+
+def make_centers_geo(locations_df, seed=0):
+    '''
+    Place the centers at random points of the contiguous US, for centers_geo.csv
+
+    Returns:
+        centers_df (pandas dataframe): the locations with lat and lng columns
+    '''
+    rng = np.random.default_rng(seed)
+    return locations_df.assign(lat=rng.uniform(25, 49, len(locations_df)), lng=rng.uniform(-124, -67, len(locations_df)))
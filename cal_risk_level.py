@@ -1,42 +1,65 @@
+import argparse
 import os
 import datetime
+import instrumentation
 from calculate_risk_daily import calculate_risk_by_date
+from county_data import COUNTY_PATH, load_counties
+from results_store import open_store
 
 
 def get_last_date():
     '''
-    Get the last date in the results folder
+    Get the last date in the results store
 
     Returns:
-        last_date (str): the last date in the results folder
+        last_date (str): the last date in the results store
     '''
-    # Get the list of files in the results folder
-    files = os.listdir('results')
-    # Get the last date
-    last_date = sorted(files)[-1][:-4]
-    return last_date
+    return open_store().latest_date()
 
 
-def main():
+def main(counties=False):
     '''
     Update the csv in the results folder
     - Add yesterday's result
     - Update the day before yesterday's result
 
-    CSV files in the results folder are named as <YYYY-MM-DD>.csv
+    The results are saved to the results store (results/store), and as csv files
+    in the results folder named as <YYYY-MM-DD>.csv. The rolling window of the 7d
+    averages is checkpointed next to the store (results/store/rolling.npz).
+
+    Args:
+        counties (bool): score each center against its county, from counties.npz
     '''
     # Get the risk dataframe of yesterday
     yesterday = (datetime.datetime.now() - datetime.timedelta(days=2)).strftime('%Y-%m-%d')
     print(f'Calculating the risk level for {yesterday}')
-    df_yesterday, centers_df = calculate_risk_by_date(yesterday)
+    with instrumentation.stage('calculate'):
+        df_yesterday, centers_df, window = calculate_risk_by_date(yesterday, load_counties() if counties else None)
+    instrumentation.count('dates_scored', 1)
+    instrumentation.count('rows_scored', len(df_yesterday) + len(centers_df))
 
-    # Save the result to the results folder
-    df_yesterday.to_csv(f'./results/{yesterday}.csv', index=False)
-    # if the folder does not exist, create it
-    if not os.path.exists('./results/centers'):
-        os.makedirs('./results/centers')
-    centers_df.to_csv(f'./results/centers/{yesterday}.csv', index=False)
+    # Save the result to the results store
+    with instrumentation.stage('write_store'):
+        open_store().write({yesterday: df_yesterday})
+    with instrumentation.stage('write_csvs'):
+        # Save the result to the results folder as well, for compatibility
+        df_yesterday.to_csv(f'./results/{yesterday}.csv', index=False)
+        # if the folder does not exist, create it
+        if not os.path.exists('./results/centers'):
+            os.makedirs('./results/centers')
+        centers_df.to_csv(f'./results/centers/{yesterday}.csv', index=False)
+        # Checkpoint the rolling window for the next run
+        window.save()
+    instrumentation.count('files_written', 3)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Calculate the risk level of the day before yesterday")
+    parser.add_argument('--counties', action='store_true',
+                        help=f'score each center against its county, from {COUNTY_PATH} (see county_data.py)')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    if args.counties and not os.path.exists(COUNTY_PATH):
+        parser.error(f'no {COUNTY_PATH}, run python county_data.py first')
+    with instrumentation.job('cal_risk_level', args):
+        main(counties=args.counties)
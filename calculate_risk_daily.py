@@ -1,86 +1,35 @@
-import json
-import datetime
+import numpy as np
 import pandas as pd
+import risk
+from county_data import county_features
+from data_file import load_data
+from rolling_window import load_window
 
-def calculate_risk_level(state_data):
-    '''
-    Calculating the risk level by metrics
+# the features of the state given to each center
+CENTER_FEATURES = ['7d_rolling_avg_new_cases_per_100k', '7d_rolling_avg_new_deaths_per_100k',
+                   'daily_percentage_of_people_who_received_at_least_one_dose',
+                   'daily_percentage_of_people_who_are_fully_vaccinated']
 
-    Input: 
-        state_data: the calculated features for a state at a certain date
+# the features a center takes from its county in the county mode
+COUNTY_FEATURES = ['7d_rolling_avg_new_cases_per_100k', '7d_rolling_avg_new_deaths_per_100k']
 
-    Returns:
-        risk_level (1-4)
-    '''
-    # Get the features
-    seven_day_rolling_avg_new_cases_per_100k = state_data['7d_rolling_avg_new_cases_per_100k']
-    seven_day_rolling_avg_new_deaths_per_100k = state_data['7d_rolling_avg_new_deaths_per_100k']
-    daily_percentage_of_people_who_received_at_least_one_dose = state_data[
-        'daily_percentage_of_people_who_received_at_least_one_dose']
-    daily_percentage_of_people_who_are_fully_vaccinated = state_data[
-        'daily_percentage_of_people_who_are_fully_vaccinated']
-
-    # Calculate the risk level by 7d rolling average of new_cases per 100,000 people
-    if seven_day_rolling_avg_new_cases_per_100k < 3:
-        risk_level_by_new_cases = 1
-    elif seven_day_rolling_avg_new_cases_per_100k < 10:
-        risk_level_by_new_cases = 2
-    elif seven_day_rolling_avg_new_cases_per_100k < 20:
-        risk_level_by_new_cases = 3
-    else:
-        risk_level_by_new_cases = 4
-
-    # Calculate the risk level by 7d rolling average of new_deaths per 100,000 people
-    if seven_day_rolling_avg_new_deaths_per_100k < 0.1:
-        risk_level_by_new_deaths = 1
-    elif seven_day_rolling_avg_new_deaths_per_100k < 0.3:
-        risk_level_by_new_deaths = 2
-    elif seven_day_rolling_avg_new_deaths_per_100k < 0.6:
-        risk_level_by_new_deaths = 3
-    else:
-        risk_level_by_new_deaths = 4
-
-    # Calculate the risk level by daily percentage of people who received at least one dose
-    if daily_percentage_of_people_who_received_at_least_one_dose < 40:
-        risk_level_by_vaccination = 2
-    elif daily_percentage_of_people_who_received_at_least_one_dose < 60:
-        risk_level_by_vaccination = 1.5
-    elif daily_percentage_of_people_who_received_at_least_one_dose < 90:
-        risk_level_by_vaccination = 1
-    else:
-        risk_level_by_vaccination = 0.5
-
-    # Calculate the risk level by daily percentage of people who are fully vaccinated
-    if daily_percentage_of_people_who_are_fully_vaccinated < 20:
-        risk_level_by_vaccination += 2
-    elif daily_percentage_of_people_who_are_fully_vaccinated < 40:
-        risk_level_by_vaccination += 1.5
-    elif daily_percentage_of_people_who_are_fully_vaccinated < 60:
-        risk_level_by_vaccination += 1
-    else:
-        risk_level_by_vaccination += 0.5
-
-    # Calculate the risk level
-    # weights for each metric
-    w_case = 0.6
-    w_death = 0.2
-    w_vaccination = 0.2
-    risk_level = w_case * risk_level_by_new_cases + w_death * \
-        risk_level_by_new_deaths + w_vaccination * risk_level_by_vaccination
-
-    return int(risk_level)
-
-def calculate_risk_by_date(date):
+def calculate_risk_by_date(date, counties=None):
     '''
     Calculate the risk level csv for a given date 
 
     Input:
         date: 'YYYY-MM-DD'
+        counties (dict): the county matrices of county_data.load_counties, to score each center
+            against the cases and deaths of its own county instead of its state's, optional
+
+    Returns:
+        df (pandas dataframe): the risk level of each state
+        centers_df (pandas dataframe): the risk level of each center
+        window (RollingWindow): the rolling window moved to the date, to be checkpointed with the results
     '''
 
     # Read the newly updated data.json
-    with open('data.json', 'r') as f:
-        data = json.load(f)
+    data = load_data()
 
     # Create a dictionary to store the risk level for each state
     result = {}
@@ -107,30 +56,16 @@ def calculate_risk_by_date(date):
 
     # Calculate the 7d rolling average of new_cases and new_deaths per 100,000 people as record as 
     # 7d_rolling_avg_new_cases_per_100k and 7d_rolling_avg_new_deaths_per_100k
-    # Read in the results from the previous seven days in the results folder
+    # Move the rolling window of the previous six days to the date
     print('> Calculating the 7d rolling average of new_cases and new_deaths per 100,000 people...')
-    for state_id in result:
-        result[state_id]['7d_rolling_avg_new_cases_per_100k'] = result[state_id]['daily_new_cases_per_100k']
-        result[state_id]['7d_rolling_avg_new_deaths_per_100k'] = result[state_id]['daily_new_deaths_per_100k']
-
-    for i in range(1, 7):
-        # Calculate the date of the previous day
-        prev_date = (datetime.datetime.strptime(date, '%Y-%m-%d') - datetime.timedelta(days=i)).strftime('%Y-%m-%d')
-        # Read in the risk level csv from the previous day
-        prev_df = pd.read_csv(f'results/{prev_date}.csv')
-        # Iterate through each row in the risk level csv
-        for index, row in prev_df.iterrows():
-            # Get the state_id
-            state_id = str(row['state_id'])
-            # Add the new_cases_per_100k to the result dictionary
-            result[state_id]['7d_rolling_avg_new_cases_per_100k'] += row['daily_new_cases_per_100k']
-            # Add the new_deaths_per_100k to the result dictionary
-            result[state_id]['7d_rolling_avg_new_deaths_per_100k'] += row['daily_new_deaths_per_100k']
-    
-    # average the 7d_rolling_avg_new_deaths_per_100k
-    for state_id in result:
-        result[state_id]['7d_rolling_avg_new_cases_per_100k'] /= 7
-        result[state_id]['7d_rolling_avg_new_deaths_per_100k'] /= 7
+    window = load_window(data, date)
+    window.push(date,
+                [result[state_id]['daily_new_cases_per_100k'] for state_id in window.state_ids],
+                [result[state_id]['daily_new_deaths_per_100k'] for state_id in window.state_ids])
+    avg_cases, avg_deaths = window.averages()
+    for state_id, avg_new_cases, avg_new_deaths in zip(window.state_ids, avg_cases, avg_deaths):
+        result[state_id]['7d_rolling_avg_new_cases_per_100k'] = float(avg_new_cases)
+        result[state_id]['7d_rolling_avg_new_deaths_per_100k'] = float(avg_new_deaths)
 
     # Calculate the daily percentage of people who received at least one dose and the daily percentage of people who are fully vaccinated
     # and save them as daily_percentage_of_people_who_received_at_least_one_dose and daily_percentage_of_people_who_are_fully_vaccinated
@@ -163,25 +98,32 @@ def calculate_risk_by_date(date):
         lambda state_id: data[state_id]['population2021'])
     # Calculate the risk level
     print('> Calculating the risk level...')
-    df['risk_level'] = df.apply(calculate_risk_level, axis=1)
+    df['risk_level'] = risk.score(df)
     # Reorder the columns
     df = df[['state_id', 'state_name', 'state_abbr', 'risk_level', 'population2021', 'daily_new_cases_per_100k', '7d_rolling_avg_new_cases_per_100k', 'daily_new_deaths_per_100k',
                 '7d_rolling_avg_new_deaths_per_100k', 'daily_percentage_of_people_who_received_at_least_one_dose', 'daily_percentage_of_people_who_are_fully_vaccinated']]
 
-    # State_id to risk level mapping
-    state_id_to_risk_level = df[['state_id', 'risk_level']].set_index('state_id').to_dict()['risk_level']
     # Give another table containing the risk level for centers given the risk level of the state
     print('> Calculating the risk level for centers...')
     # read in the centers data at center.csv
     centers_df = pd.read_csv('centers.csv')
-    centers_df['risk_level'] = centers_df['state_id'].apply(lambda x: state_id_to_risk_level.get(str(int(x))))
-    centers_df['state_abbr'] = centers_df['state_id'].apply(lambda x: data[str(int(x))]['state_abbr'])
-    centers_df['7d_rolling_avg_new_cases_per_100k'] = centers_df['state_id'].apply(lambda x: result[str(int(x))]['7d_rolling_avg_new_cases_per_100k'])
-    centers_df['7d_rolling_avg_new_deaths_per_100k'] = centers_df['state_id'].apply(lambda x: result[str(int(x))]['7d_rolling_avg_new_deaths_per_100k'])
-    centers_df['daily_percentage_of_people_who_received_at_least_one_dose'] = centers_df['state_id'].apply(lambda x: result[str(int(x))]['daily_percentage_of_people_who_received_at_least_one_dose'])
-    centers_df['daily_percentage_of_people_who_are_fully_vaccinated'] = centers_df['state_id'].apply(lambda x: result[str(int(x))]['daily_percentage_of_people_who_are_fully_vaccinated'])
-
-    return df, centers_df
-
-
-    
\ No newline at end of file
+    centers_df['risk_level'] = risk.score_centers(centers_df['state_id'], df['state_id'], df['risk_level'])
+    # Look up the row of each center's state once, and take every column from it
+    state_rows = df.index.get_indexer(centers_df['state_id'].astype(int).astype(str))
+    centers_df['state_abbr'] = df['state_abbr'].to_numpy()[state_rows]
+    for column in CENTER_FEATURES:
+        centers_df[column] = df[column].to_numpy()[state_rows]
+
+    if counties is not None:
+        # Give each center the cases and deaths of its county, and the vaccination of its state
+        # (the county file has no vaccination), the centers of a county without a record keep their state's
+        print('> Calculating the risk level for centers from their counties...')
+        county_df = county_features(counties, date)
+        county_rows = county_df.index.get_indexer(centers_df['county_id'].astype(np.int64))
+        found = county_rows >= 0
+        for column in COUNTY_FEATURES:
+            centers_df.loc[found, column] = county_df[column].to_numpy()[county_rows[found]]
+        centers_df['risk_level'] = risk.score(centers_df)
+        centers_df['risk_resolution'] = np.where(found, 'county', 'state')
+
+    return df, centers_df, window
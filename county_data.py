@@ -0,0 +1,220 @@
+'''
+The county-level cases and deaths of the centers, from the NYT us-counties.csv
+
+The county file is about 100 times the size of the state file, so it is never held whole:
+it is parsed a block of rows at a time, keeping only the date, fips, cases and deaths
+columns, and each block is reduced right away to the counties with a center, as integer
+columns. The counties are saved as (county x date) int32 matrices in counties.npz, for
+    python cal_risk_level.py --counties
+
+Usage:
+    python county_data.py
+'''
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import instrumentation
+from features import compact, compact_order, scatter
+from fetch_data import commit_fetch, create_session, fetch_csv
+from reference_data import connection, load_reference_table
+from rolling_window import WINDOW
+
+# the upstream source of the county cases and deaths
+COUNTY_URL = 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv'
+
+# the columns used from the source and their types, the county and state names are never parsed
+COUNTY_COLUMNS = {
+    'date': str,
+    'fips': 'float64',
+    'cases': 'float64',
+    'deaths': 'float64',
+}
+
+# the county matrices of the centers
+COUNTY_PATH = 'counties.npz'
+
+# the day numbers of the dates count from this day
+EPOCH = np.datetime64('2020-01-01', 'D')
+
+# the features of a county at a date
+COUNTY_FEATURES = ['daily_new_cases_per_100k', '7d_rolling_avg_new_cases_per_100k', 'daily_new_deaths_per_100k',
+                   '7d_rolling_avg_new_deaths_per_100k']
+
+# the county fips codes are 5 digits
+MAX_FIPS = 100000
+
+
+def fips_lookup(county_df):
+    '''
+    Build the lookup from a county fips code to the row of the county
+
+    Returns:
+        lookup (np.ndarray): (MAX_FIPS,) int32, the row of each fips code, -1 for the other counties
+    '''
+    lookup = np.full(MAX_FIPS, -1, dtype=np.int32)
+    lookup[county_df['county_fips'].to_numpy(dtype=np.int64)] = np.arange(len(county_df), dtype=np.int32)
+    return lookup
+
+
+def compact_chunk(chunk, lookup):
+    '''
+    Reduce a block of rows of us-counties.csv to the counties of the lookup, as integer columns
+
+    Args:
+        chunk (pandas dataframe): the COUNTY_COLUMNS of a block of rows
+        lookup (np.ndarray): see fips_lookup
+
+    Returns:
+        records (pandas dataframe): row, day (the days since EPOCH), cases and deaths, all int32
+    '''
+    # New York City and a few other areas have no fips code
+    fips = chunk['fips'].to_numpy()
+    known = (fips >= 0) & (fips < MAX_FIPS)
+    rows = np.full(len(chunk), -1, dtype=np.int32)
+    rows[known] = lookup[fips[known].astype(np.int64)]
+    keep = rows >= 0
+    days = chunk['date'].to_numpy()[keep].astype('datetime64[D]') - EPOCH
+    return pd.DataFrame({
+        'row': rows[keep],
+        'day': days.astype(np.int32),
+        'cases': np.nan_to_num(chunk['cases'].to_numpy()[keep]).astype(np.int32),
+        'deaths': np.nan_to_num(chunk['deaths'].to_numpy()[keep]).astype(np.int32),
+    })
+
+
+def fetch_counties(conn=None, url=COUNTY_URL):
+    '''
+    Fetch the cumulative cases and deaths of the counties with a center
+
+    Args:
+        conn: a DB-API connection, a pooled connection is used if not given
+        url (str): the url of the county csv
+
+    Returns:
+        county_df (pandas dataframe): the rows of yfz.counties of the counties with a center
+        records (pandas dataframe): see compact_chunk
+    '''
+    if conn is None:
+        with connection() as conn:
+            return fetch_counties(conn, url)
+
+    # Only the counties with a center are kept
+    center_df = load_reference_table('locations', conn)
+    county_df = load_reference_table('counties', conn)
+    county_df = county_df[county_df['county_id'].isin(center_df['county_id'])].reset_index(drop=True)
+    lookup = fips_lookup(county_df)
+
+    print(f'> Fetching the cases and deaths of {len(county_df)} counties')
+    records, _ = fetch_csv(url, COUNTY_COLUMNS, 'counties', create_session(),
+                           transform=lambda chunk: compact_chunk(chunk, lookup))
+    return county_df, records
+
+
+def write_counties(county_df, records, path=COUNTY_PATH):
+    '''
+    Save the (county x date) matrices of the cumulative cases and deaths, replacing the file atomically
+    '''
+    first = int(records['day'].min()) if len(records) else 0
+    n_days = int(records['day'].max()) - first + 1 if len(records) else 0
+    rows = records['row'].to_numpy()
+    cols = records['day'].to_numpy() - first
+    present = np.zeros((len(county_df), n_days), dtype=bool)
+    cases = np.zeros((len(county_df), n_days), dtype=np.int32)
+    deaths = np.zeros((len(county_df), n_days), dtype=np.int32)
+    present[rows, cols] = True
+    cases[rows, cols] = records['cases'].to_numpy()
+    deaths[rows, cols] = records['deaths'].to_numpy()
+    dates = (EPOCH + first + np.arange(n_days)).astype(str)
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, county_ids=county_df['county_id'].to_numpy(dtype=np.int64),
+                 population2021=county_df['population2021'].to_numpy(dtype=np.float64),
+                 dates=dates, present=present, cases=cases, deaths=deaths)
+    os.replace(tmp_path, path)
+
+
+def load_counties(path=COUNTY_PATH):
+    '''
+    Load the county matrices saved by write_counties
+
+    Returns:
+        {
+            'county_ids': np.ndarray (n_counties,),
+            'population2021': np.ndarray (n_counties,),
+            'dates': np.ndarray (n_dates,), every date from the first to the last one,
+            'present': np.ndarray (n_counties, n_dates), bool,
+            'cases': np.ndarray (n_counties, n_dates), int32, cumulative,
+            'deaths': ...,
+        }
+    '''
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def county_features(counties, date):
+    '''
+    Calculate the cases and deaths features of the counties at a date, the same way as the daily
+    job calculates the states' (see rolling_window.RollingWindow.averages)
+
+    Args:
+        counties (dict): see load_counties
+        date (str): 'YYYY-MM-DD'
+
+    Returns:
+        df (pandas dataframe): the daily and 7d rolling new cases and new deaths per 100,000
+            people, indexed by county_id, for the counties with a record at the date
+    '''
+    present = counties['present']
+    order, _ = compact_order(present)
+    population = np.asarray(counties['population2021'], dtype=np.float64)[:, None]
+
+    col = int(np.searchsorted(counties['dates'], date))
+    if col == len(counties['dates']) or counties['dates'][col] != date:
+        return pd.DataFrame(columns=COUNTY_FEATURES, index=pd.Index([], name='county_id'))
+
+    # Make cases and deaths from cumulative to daily over each county's own records,
+    # the first record keeps its cumulative value
+    daily_new_cases_per_100k = scatter(np.diff(compact(counties['cases'], order), axis=1, prepend=0), order) \
+        / population * 100000
+    daily_new_deaths_per_100k = scatter(np.diff(compact(counties['deaths'], order), axis=1, prepend=0), order) \
+        / population * 100000
+
+    # The 7d rolling averages are the sums of the 7 days up to the date (the dates are every
+    # day), added from the most recent one, over 7; a day without a record counts as 0
+    avg_cases = np.zeros(len(population))
+    avg_deaths = np.zeros(len(population))
+    for prev_col in range(col, max(col - WINDOW, -1), -1):
+        avg_cases += np.where(present[:, prev_col], daily_new_cases_per_100k[:, prev_col], 0.0)
+        avg_deaths += np.where(present[:, prev_col], daily_new_deaths_per_100k[:, prev_col], 0.0)
+    avg_cases /= WINDOW
+    avg_deaths /= WINDOW
+
+    rows = np.nonzero(present[:, col])[0]
+    return pd.DataFrame({
+        'daily_new_cases_per_100k': daily_new_cases_per_100k[rows, col],
+        '7d_rolling_avg_new_cases_per_100k': avg_cases[rows],
+        'daily_new_deaths_per_100k': daily_new_deaths_per_100k[rows, col],
+        '7d_rolling_avg_new_deaths_per_100k': avg_deaths[rows],
+    }, index=pd.Index(counties['county_ids'][rows], name='county_id'))
+
+
+def main():
+    with instrumentation.stage('fetch'):
+        county_df, records = fetch_counties()
+    instrumentation.count('records_written', len(records))
+    with instrumentation.stage('write'):
+        write_counties(county_df, records)
+    instrumentation.count('files_written', 1)
+    commit_fetch('counties')
+    print(f'> Saved {COUNTY_PATH}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch the county cases and deaths of the centers and save them to '
+                                                 f'{COUNTY_PATH}')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    with instrumentation.job('county_data', args):
+        main()
@@ -0,0 +1,152 @@
+import json
+import os
+import sys
+import threading
+import instrumentation
+from dataset import Dataset
+
+# the data file, kept as JSON for external clients
+DATA_PATH = 'data.json'
+
+# the number of files of a saved Dataset (see Dataset.save)
+DATASET_FILES = 3
+
+# the dataset of each path and the stamp of the file it was read from
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def columns_dir(path=DATA_PATH):
+    '''
+    Get the folder of the arrays of a data file, e.g. data.columns for data.json
+    '''
+    return os.path.splitext(path)[0] + '.columns'
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def columns_version(stamp):
+    # The arrays of a version of the JSON file are named after its stamp
+    return '-'.join(str(part) for part in stamp)
+
+
+def write_data(data, path=DATA_PATH):
+    '''
+    Write the data to the JSON file and its arrays
+
+    The JSON file is written compactly and swapped in atomically. The arrays are named after
+    the stamp of the JSON file they were written with, so a JSON file replaced by another
+    writer is never read from stale arrays.
+
+    Args:
+        data (dict): the data, see init_calculate.read_data
+        path (str): the JSON file
+    '''
+    # write to a temporary file and swap it in, so the API never reloads a half written file
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(f'{path}.tmp', path)
+    instrumentation.count('files_written', 1)
+
+    write_columns(data, path)
+
+
+def json_keys(obj):
+    '''
+    Convert the keys of the dictionaries to strings the way JSON does, e.g. integer state ids
+    '''
+    if isinstance(obj, dict):
+        return {key if isinstance(key, str) else json.dumps(key): json_keys(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [json_keys(value) for value in obj]
+    return obj
+
+
+def write_columns(data, path=DATA_PATH):
+    '''
+    Save the data of a JSON file as the arrays of a Dataset, named after the current version of the JSON file
+
+    Args:
+        data (dict): the data of the JSON file
+        path (str): the JSON file
+    '''
+    Dataset.from_dict(json_keys(data)).save(columns_dir(path), columns_version(file_stamp(path)))
+    instrumentation.count('files_written', DATASET_FILES)
+
+
+def parse_data(path=DATA_PATH, raw=None):
+    '''
+    Parse the data from the JSON file, as a dictionary that can be modified
+
+    Only fetch_data --incremental needs one, the other readers use the arrays (see load_data).
+
+    Args:
+        path (str): the JSON file
+        raw (bytes): the content of the JSON file if it has already been read
+
+    Returns:
+        data (dict): the data, see init_calculate.read_data
+    '''
+    if raw is None:
+        with open(path, 'rb') as f:
+            raw = f.read()
+    return json.loads(raw)
+
+
+def load_dataset(path=DATA_PATH, raw=None, stamp=None):
+    '''
+    Open the arrays of the data, saving them first if they are missing or stale
+
+    Args:
+        path (str): the JSON file
+        raw (bytes): the content of the JSON file if it has already been read
+        stamp (list): the stamp of the JSON file, read from the file if None
+
+    Returns:
+        dataset (Dataset): the data, memory-mapped if the arrays could be saved
+    '''
+    stamp = stamp or file_stamp(path)
+    version = columns_version(stamp)
+    dataset = Dataset.open(columns_dir(path), version)
+    if dataset is None:
+        dataset = Dataset.from_dict(parse_data(path, raw))
+        try:
+            dataset.save(columns_dir(path), version)
+            instrumentation.count('files_written', DATASET_FILES)
+            # Map the saved arrays, so the workers share them
+            dataset = Dataset.open(columns_dir(path), version) or dataset
+        except OSError as e:
+            print(f'> Failed to save the arrays of {path}: {e}')
+    return dataset
+
+
+def load_data(path=DATA_PATH, raw=None):
+    '''
+    Load the data once per version of the file
+
+    Every consumer in the process shares the same read-only Dataset until the file changes
+    (use parse_data for a dictionary that can be modified).
+
+    Args:
+        path (str): the JSON file
+        raw (bytes): the content of the JSON file if it has already been read
+
+    Returns:
+        data (Dataset): the data, read the same as the dictionary of init_calculate.read_data
+    '''
+    stamp = file_stamp(path)
+    with _loaded_lock:
+        loaded = _loaded.get(path)
+        if loaded is None or loaded[0] != stamp:
+            _loaded[path] = loaded = (stamp, load_dataset(path, raw, stamp))
+        return loaded[1]
+
+
+if __name__ == '__main__':
+    # Write the arrays of an existing data.json, e.g. after checking it out
+    path = sys.argv[1] if len(sys.argv) > 1 else DATA_PATH
+    write_columns(parse_data(path), path)
+    print(f'> Wrote {columns_dir(path)}')
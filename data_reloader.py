@@ -0,0 +1,114 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+# A value built from a version of the file
+Loaded = namedtuple('Loaded', ['value', 'version', 'stamp'])
+
+
+class DataReloader(object):
+    '''
+    Keep a value built from a file up to date from a background thread
+
+    The file is polled for a new inode, modification time or size. The new value is built
+    off the request path and swapped in with a single reference assignment, so readers
+    holding the old value are never blocked. Each process (e.g. each gunicorn worker)
+    starts its own thread the first time ensure_started() is called in it, which also
+    covers workers forked from a preloaded master.
+
+    Attributes:
+        current (Loaded): the latest value, its version (a digest of the file) and stamp
+        listeners (list): functions called by the thread after a new value is swapped in, and
+            called again at the next check if one of them fails
+    '''
+
+    def __init__(self, path, build, interval=5.0):
+        '''
+        Args:
+            path (str): the file to watch
+            build (function): builds the value from the bytes of the file
+            interval (float): seconds between checks of the file
+        '''
+        self.path = path
+        self.build = build
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+        self.listeners = []
+        self.current = self._load()
+
+    def _stamp(self):
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _load(self):
+        stamp = self._stamp()
+        with open(self.path, 'rb') as f:
+            raw = f.read()
+        version = hashlib.blake2b(raw, digest_size=8).hexdigest()
+        return Loaded(self.build(raw), version, stamp)
+
+    def check(self):
+        '''
+        Reload the value if the file has changed
+
+        Returns:
+            reloaded (bool): whether a new value was swapped in
+        '''
+        if self._stamp() == self.current.stamp:
+            return False
+        loaded = self._load()
+        # Swap the reference, requests already holding the old value keep using it
+        self.current = loaded
+        return True
+
+    def ensure_started(self):
+        '''
+        Start the watcher thread in this process if it is not running yet
+        '''
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                thread = threading.Thread(target=self._run, name='data-reloader', daemon=True)
+                thread.start()
+                self._pid = pid
+
+    def _run(self):
+        # Whether the listeners have to be called, again if one of them failed
+        notify = False
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self.check():
+                    print(f'> Reloaded {self.path} (version {self.current.version})')
+                    notify = True
+            except Exception as e:
+                # The file may be missing, half written or not buildable: keep serving the
+                # current value and try again at the next check
+                print(f'> Failed to reload {self.path}: {type(e).__name__}: {e}', file=sys.stderr, flush=True)
+                traceback.print_exc()
+            if notify:
+                notify = not self._notify()
+
+    def _notify(self):
+        '''
+        Call the listeners, logging their failures
+
+        Returns:
+            ok (bool): whether all the listeners succeeded
+        '''
+        ok = True
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception as e:
+                print(f'> Failed to update from {self.path}: {type(e).__name__}: {e}', file=sys.stderr, flush=True)
+                traceback.print_exc()
+                ok = False
+        return ok
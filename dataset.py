@@ -0,0 +1,220 @@
+'''
+The state/date data of data.json as fixed-dtype arrays
+
+Parsed as JSON, every state and date of data.json is its own dictionary of string keys and
+python integers, several hundred bytes for 6 numbers, and every worker of the API holds its
+own copy. A Dataset keeps the same numbers in one (field x state x date) int64 array, with a
+state axis and a date axis, and still reads like the nested dictionaries:
+    dataset[state_id]['dates'][date]['new_cases']
+
+The arrays are saved next to data.json (see data_file.load_data) and memory-mapped, so the
+workers share one copy of them in the page cache.
+'''
+import json
+import os
+from collections.abc import Mapping
+import numpy as np
+
+# the fields of each state and date, in the order of data.json
+FIELDS = ['cases', 'deaths', 'People_at_least_one_dose', 'People_fully_vaccinated', 'new_cases', 'new_deaths']
+
+
+class Dataset(Mapping):
+    '''
+    The data of data.json, as arrays with dictionary-like accessors
+
+    The dataset is read-only: the records read from it are new dictionaries, changing them
+    does not change the dataset.
+
+    Attributes:
+        state_ids (list): the states, in the order of data.json
+        states (list): the fields of each state other than its dates (state_name, state_abbr,
+            population2020, population2021, centers)
+        dates (list): the sorted dates of all states, the keys of data.json as they are (usually
+            'YYYY-MM-DD', but preprocess writes '0' for a state without covid rows)
+        cube (np.ndarray): (n_fields, n_states, n_dates) int64, the FIELDS of each state and date
+        present (np.ndarray): (n_states, n_dates) bool, whether the state has a record at the date
+    '''
+
+    def __init__(self, state_ids, states, dates, cube, present):
+        self.state_ids = list(state_ids)
+        self.states = states
+        self.dates = list(dates)
+        self.cube = cube
+        self.present = present
+        self._rows = {state_id: row for row, state_id in enumerate(self.state_ids)}
+        self._cols = {date: col for col, date in enumerate(self.dates)}
+
+    @classmethod
+    def from_dict(cls, data):
+        '''
+        Build the dataset from the data.json dictionary
+
+        Args:
+            data (dict): the data, with string keys as read back from data.json
+
+        Returns:
+            dataset (Dataset): the missing fields of a record read as 0
+        '''
+        state_ids = list(data)
+        dates = sorted(set(date for state_data in data.values() for date in state_data['dates']))
+        cols = {date: col for col, date in enumerate(dates)}
+        cube = np.zeros((len(FIELDS), len(state_ids), len(dates)), dtype=np.int64)
+        present = np.zeros((len(state_ids), len(dates)), dtype=bool)
+
+        # Scatter the records of each state into its row
+        for row, state_id in enumerate(state_ids):
+            date_map = data[state_id]['dates']
+            if not date_map:
+                continue
+            state_cols = np.fromiter((cols[date] for date in date_map), dtype=np.intp, count=len(date_map))
+            present[row, state_cols] = True
+            cube[:, row, state_cols] = np.array(
+                [[date_data.get(field, 0) for field in FIELDS] for date_data in date_map.values()], dtype=np.int64).T
+
+        states = [{key: value for key, value in data[state_id].items() if key != 'dates'} for state_id in state_ids]
+        return cls(state_ids, states, dates, cube, present)
+
+    def save(self, directory, version):
+        '''
+        Save the dataset as <version>.cube.npy, <version>.present.npy and <version>.json
+
+        The files are written to temporary files of this process and swapped in, the json last,
+        and the files of the other versions are removed (the workers still using them keep their mappings).
+        '''
+        os.makedirs(directory, exist_ok=True)
+        prefix = os.path.join(directory, version)
+        suffix = f'.{os.getpid()}.tmp'
+        for name, array in (('cube.npy', self.cube), ('present.npy', self.present)):
+            with open(f'{prefix}.{name}{suffix}', 'wb') as f:
+                np.save(f, np.asarray(array))
+        with open(f'{prefix}.json{suffix}', 'w') as f:
+            json.dump({'state_ids': self.state_ids, 'states': self.states, 'dates': self.dates}, f)
+        for name in ('cube.npy', 'present.npy', 'json'):
+            os.replace(f'{prefix}.{name}{suffix}', f'{prefix}.{name}')
+
+        for name in os.listdir(directory):
+            if not name.startswith(f'{version}.') and not name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+
+    @classmethod
+    def open(cls, directory, version):
+        '''
+        Open a dataset saved with save, with its arrays memory-mapped
+
+        Returns:
+            dataset (Dataset): None if the version has not been saved
+        '''
+        prefix = os.path.join(directory, version)
+        try:
+            with open(f'{prefix}.json', 'r') as f:
+                index = json.load(f)
+            # An empty array can't be mapped
+            mmap_mode = 'r' if index['state_ids'] and index['dates'] else None
+            cube = np.load(f'{prefix}.cube.npy', mmap_mode=mmap_mode)
+            present = np.load(f'{prefix}.present.npy', mmap_mode=mmap_mode)
+        except (OSError, ValueError, KeyError):
+            # KeyError: saved by an older version, without the dates
+            return None
+        return cls(index['state_ids'], index['states'], index['dates'], cube, present)
+
+    def column(self, field):
+        '''
+        Get the (state x date) values of a field, 0 where the state has no record
+        '''
+        return self.cube[FIELDS.index(field)]
+
+    def state_dict(self, state_id):
+        '''
+        Get the data of a state as the data.json dictionary
+        '''
+        return dict(self[state_id], dates=dict(self[state_id]['dates'].items()))
+
+    def date_records(self, date):
+        '''
+        Get the record of every state with a record at a date
+
+        Returns:
+            records (dict): state_id -> {field: int}, empty if no state has a record at the date
+        '''
+        col = self._cols.get(date)
+        if col is None:
+            return {}
+        rows = np.nonzero(self.present[:, col])[0]
+        block = np.asarray(self.cube[:, rows, col]).T.tolist()
+        return {self.state_ids[row]: dict(zip(FIELDS, record)) for row, record in zip(rows.tolist(), block)}
+
+    def __getitem__(self, state_id):
+        return StateView(self, self._rows[state_id])
+
+    def __contains__(self, state_id):
+        return state_id in self._rows
+
+    def __iter__(self):
+        return iter(self.state_ids)
+
+    def __len__(self):
+        return len(self.state_ids)
+
+
+class StateView(Mapping):
+    '''
+    The data of a state of a Dataset, read as its data.json dictionary
+    '''
+
+    def __init__(self, dataset, row):
+        self.dataset = dataset
+        self.row = row
+        self._state = dataset.states[row]
+
+    def __getitem__(self, key):
+        if key == 'dates':
+            return DatesView(self.dataset, self.row)
+        return self._state[key]
+
+    def __iter__(self):
+        yield from self._state
+        yield 'dates'
+
+    def __len__(self):
+        return len(self._state) + 1
+
+
+class DatesView(Mapping):
+    '''
+    The records of a state of a Dataset, read as date -> {field: int}
+    '''
+
+    def __init__(self, dataset, row):
+        self.dataset = dataset
+        self.row = row
+
+    def _cols(self):
+        return np.nonzero(self.dataset.present[self.row])[0]
+
+    def __getitem__(self, date):
+        col = self.dataset._cols.get(date)
+        if col is None or not self.dataset.present[self.row, col]:
+            raise KeyError(date)
+        return dict(zip(FIELDS, self.dataset.cube[:, self.row, col].tolist()))
+
+    def __contains__(self, date):
+        col = self.dataset._cols.get(date)
+        return col is not None and bool(self.dataset.present[self.row, col])
+
+    def __iter__(self):
+        dates = self.dataset.dates
+        return (dates[col] for col in self._cols().tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.dataset.present[self.row]))
+
+    def items(self):
+        # Read the records of the state at once instead of one date at a time
+        cols = self._cols()
+        block = np.asarray(self.dataset.cube[:, self.row, cols]).T.tolist()
+        dates = self.dataset.dates
+        return [(dates[col], dict(zip(FIELDS, record))) for col, record in zip(cols.tolist(), block)]
+
+    def values(self):
+        return [record for _, record in self.items()]
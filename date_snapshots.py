@@ -0,0 +1,268 @@
+import bisect
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from response_cache import CachedResponse, dump_json
+
+# the folder of the materialized snapshots, one packed file per version of the data and results
+SNAPSHOT_DIR = 'results/snapshots'
+
+# the number of snapshots kept in memory with their compressed variants
+SNAPSHOT_CACHE_SIZE = int(os.environ.get('SNAPSHOT_CACHE_SIZE', 64))
+
+# the packed files of the other versions are removed once they are this many seconds old, so the
+# workers that have not reloaded yet can still open theirs
+SNAPSHOT_KEEP_SECONDS = float(os.environ.get('SNAPSHOT_KEEP_SECONDS', 300))
+
+
+@contextmanager
+def snapshot_lock(path, exclusive):
+    '''
+    Hold the lock of the folder of the packed files, shared by the processes of the server
+
+    The packed files are built and removed under the exclusive lock, and opened under the shared one,
+    so a process never opens a file that is half built or being removed.
+    '''
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def remove_stale(path, version, keep_seconds=SNAPSHOT_KEEP_SECONDS):
+    '''
+    Remove the packed files of the versions other than `version` older than keep_seconds
+
+    The processes still using them keep their mappings, and a process opening one of them
+    later builds it again.
+    '''
+    with snapshot_lock(path, exclusive=True):
+        now = time.time()
+        for name in os.listdir(path):
+            if name.startswith('.') or name.startswith(f'{version}.') or name.endswith('.tmp'):
+                continue
+            file_path = os.path.join(path, name)
+            try:
+                if now - os.path.getmtime(file_path) > keep_seconds:
+                    os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+
+def snapshot_payload(index, store, date):
+    '''
+    Build the national snapshot of a date
+
+    Returns:
+        payload (dict): state_id -> {'state_name': str, 'data': dict, 'risk_level': int}, the risk level
+            is left out for the states without a result at the date
+    '''
+    payload = {}
+    pos = store._position(date)
+    for state_id, state_date in index.get_date(date).items():
+        payload[state_id] = dict(state_date)
+    if pos is not None:
+        present = store.present[pos]
+        risk_level = store.risk_level[pos]
+        for i, state_id in enumerate(store.state_ids):
+            if present[i] and state_id in payload:
+                payload[state_id]['risk_level'] = int(risk_level[i])
+    return payload
+
+
+def materialize(index, store, blob_path, offsets_path):
+    '''
+    Serialize the snapshot of every date into one packed file
+
+    The bodies are written back to back to blob_path, and their (offset, length) to offsets_path.
+    Both are written to temporary files of this process and swapped in, the offsets last.
+    '''
+    offsets = {}
+    position = 0
+    suffix = f'.{os.getpid()}.tmp'
+    with open(blob_path + suffix, 'wb') as f:
+        for date in index.dates:
+            body = dump_json(snapshot_payload(index, store, date))
+            f.write(body)
+            offsets[date] = (position, len(body))
+            position += len(body)
+    with open(offsets_path + suffix, 'w') as f:
+        json.dump(offsets, f)
+    os.replace(blob_path + suffix, blob_path)
+    os.replace(offsets_path + suffix, offsets_path)
+
+
+class DateSnapshots(object):
+    '''
+    The responses of /date/<date>, the data and the risk level of every state at a date
+
+    The snapshots of every date are serialized once per version of the data and the results
+    into a packed file on disk, shared by the workers. The most recently used ones are
+    kept in memory as ready-to-send responses, and the others are read back from the
+    memory-mapped file when they are requested.
+
+    Attributes:
+        dates (list): the sorted dates with a snapshot
+        version (str): the version of the data and the results
+    '''
+
+    def __init__(self, index, store, version, path=SNAPSHOT_DIR, size=SNAPSHOT_CACHE_SIZE):
+        '''
+        Args:
+            index (DataIndex): the data
+            store (ResultsStore): the scored results
+            version (str): the version of the data and the results, naming the packed file
+            path (str): the folder of the packed files
+            size (int): the number of snapshots kept in memory
+        '''
+        self.dates = index.dates
+        self.version = version
+        self.size = size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self.empty = CachedResponse({})
+
+        blob_path = os.path.join(path, f'{version}.bin')
+        offsets_path = os.path.join(path, f'{version}.json')
+        # The first process to need a version builds it, the others wait for it and open it
+        with snapshot_lock(path, exclusive=False):
+            opened = self._open(blob_path, offsets_path)
+        if not opened:
+            with snapshot_lock(path, exclusive=True):
+                if not self._open(blob_path, offsets_path):
+                    print(f'> Materializing the /date/<date> snapshots ({version})')
+                    materialize(index, store, blob_path, offsets_path)
+                    self._open(blob_path, offsets_path)
+
+    def _open(self, blob_path, offsets_path):
+        '''
+        Map the packed file of the version, under the lock
+
+        Returns:
+            opened (bool): False if the version has not been built
+        '''
+        try:
+            with open(offsets_path, 'r') as f:
+                self.offsets = json.load(f)
+            with open(blob_path, 'rb') as f:
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        except FileNotFoundError:
+            return False
+        return True
+
+    def body(self, date):
+        '''
+        Get the serialized snapshot of a date, None if there is no snapshot
+        '''
+        if date not in self.offsets:
+            return None
+        offset, length = self.offsets[date]
+        return self._blob[offset:offset + length]
+
+    def get(self, date):
+        '''
+        Get the response of a date, or the empty response if there is no snapshot
+        '''
+        with self._lock:
+            cached = self._lru.get(date)
+            if cached is not None:
+                self._lru.move_to_end(date)
+                return cached
+        body = self.body(date)
+        if body is None:
+            return self.empty
+        cached = CachedResponse(body=body)
+        with self._lock:
+            self._lru[date] = cached
+            while len(self._lru) > self.size:
+                self._lru.popitem(last=False)
+        return cached
+
+    def resolve(self, date):
+        '''
+        Resolve 'latest' to the last date, and check that a date is within the dates of the snapshots
+
+        Returns:
+            date (str): the date, None if it is outside the dates of the snapshots
+        '''
+        if not self.dates:
+            return None
+        if date == 'latest':
+            return self.dates[-1]
+        if date < self.dates[0] or date > self.dates[-1]:
+            return None
+        return date
+
+    def iter_range(self, start, end):
+        '''
+        Stream the snapshots of the dates from start to end (inclusive)
+
+        Yields:
+            chunk (bytes): the parts of {date: snapshot, ...}
+        '''
+        lo = bisect.bisect_left(self.dates, start)
+        hi = bisect.bisect_right(self.dates, end)
+        yield b'{'
+        for i, date in enumerate(self.dates[lo:hi]):
+            yield (b',' if i else b'') + json.dumps(date).encode('utf-8') + b':' + self.body(date)[:-1]
+        yield b'}\n'
+
+
+# the data, the results and the snapshots built from them, published together
+Published = namedtuple('Published', ['loaded', 'series', 'snapshots'])
+
+
+class SnapshotPublisher(object):
+    '''
+    Keep the snapshots of the current versions of the data and the results up to date
+
+    The snapshots are built by the reloader threads right after they swap in a new version
+    of the data or the results, and published with the two versions they were built from
+    in a single reference assignment. Requests only read the published reference, so they
+    never wait for a build.
+
+    Attributes:
+        current (Published): the versions of the data and the results, and their snapshots
+    '''
+
+    def __init__(self, reloader, series_reloader, path=SNAPSHOT_DIR):
+        '''
+        Args:
+            reloader (DataReloader): the cached responses of data.json (a ResponseCache)
+            series_reloader (DataReloader): the series of the results store (a SeriesIndex)
+            path (str): the folder of the packed files
+        '''
+        self.reloader = reloader
+        self.series_reloader = series_reloader
+        self.path = path
+        self._lock = threading.Lock()
+        self.current = None
+        self.publish()
+        reloader.listeners.append(self.publish)
+        series_reloader.listeners.append(self.publish)
+
+    def publish(self):
+        '''
+        Build the snapshots of the current versions, if they have not been published yet
+        '''
+        # Both reloader threads may call this at once, the second one finds the snapshots built
+        with self._lock:
+            loaded, series_loaded = self.reloader.current, self.series_reloader.current
+            if self.current is not None and self.current.loaded is loaded and self.current.series is series_loaded:
+                return
+            # The stamp of the store changes whenever the results are written
+            version = hashlib.blake2b(f'{loaded.version}{series_loaded.stamp}'.encode('utf-8'),
+                                      digest_size=8).hexdigest()
+            snapshots = DateSnapshots(loaded.value.index, series_loaded.value.store, version, self.path)
+            self.current = Published(loaded, series_loaded, snapshots)
+        # Only the files of the other versions are removed, once this process no longer uses them
+        remove_stale(self.path, version)
@@ -0,0 +1,239 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from dataset import Dataset
+
+# the raw fields read from data.json for each state and date
+RAW_FIELDS = ['new_cases', 'new_deaths',
+              'People_at_least_one_dose', 'People_fully_vaccinated']
+
+# the features calculated for each state and date
+FEATURES = ['daily_new_cases_per_100k', '7d_rolling_avg_new_cases_per_100k', 'daily_new_deaths_per_100k',
+            '7d_rolling_avg_new_deaths_per_100k', 'daily_percentage_of_people_who_received_at_least_one_dose',
+            'daily_percentage_of_people_who_are_fully_vaccinated']
+
+
+def build_matrix(data):
+    '''
+    Build the (state x date) matrices of the raw fields from the data of data.json
+
+    Args:
+        data (dict or Dataset): the data from the data.json file
+
+    Returns:
+        {
+            'state_ids': [str],                 # the states, in the order of data.json
+            'dates': np.ndarray (n_dates,),     # the sorted union of the dates of all states
+            'population2021': np.ndarray (n_states,),
+            'present': np.ndarray (n_states, n_dates), bool,
+            'new_cases': np.ndarray (n_states, n_dates), float,
+            'new_deaths': ...,
+            'People_at_least_one_dose': ...,
+            'People_fully_vaccinated': ...,
+        }
+    '''
+    if isinstance(data, Dataset):
+        # The dataset is already (state x date), every record has all the fields
+        matrix = {
+            'state_ids': list(data.state_ids),
+            'dates': np.array(data.dates, dtype=str),
+            'population2021': np.array([state['population2021'] for state in data.states], dtype=np.float64),
+            'present': np.array(data.present),
+        }
+        for field in RAW_FIELDS:
+            matrix[field] = data.column(field).astype(np.float64)
+        return matrix
+
+    state_ids = list(data.keys())
+    # Collect the union of the dates, a date only counts for a state if it has new_cases
+    state_dates = [[date for date, date_data in data[state_id]['dates'].items() if 'new_cases' in date_data]
+                   for state_id in state_ids]
+    dates = np.array(sorted(set(date for ds in state_dates for date in ds)), dtype=str)
+    date_pos = {date: i for i, date in enumerate(dates.tolist())}
+
+    matrix = {
+        'state_ids': state_ids,
+        'dates': dates,
+        'population2021': np.array([data[state_id]['population2021'] for state_id in state_ids], dtype=np.float64),
+        'present': np.zeros((len(state_ids), len(dates)), dtype=bool),
+    }
+    for field in RAW_FIELDS:
+        matrix[field] = np.zeros((len(state_ids), len(dates)), dtype=np.float64)
+
+    # Scatter the values of each state into its row
+    for row, state_id in enumerate(state_ids):
+        ds = state_dates[row]
+        cols = np.fromiter((date_pos[date] for date in ds), dtype=np.intp, count=len(ds))
+        matrix['present'][row, cols] = True
+        date_map = data[state_id]['dates']
+        for field in RAW_FIELDS:
+            matrix[field][row, cols] = [date_map[date][field] for date in ds]
+
+    return matrix
+
+
+def _rolling_sum(values, window, offset=0):
+    '''
+    Sum a window of values ending `offset` positions before each position, adding the values
+    from the oldest to the newest (the same order as python's sum, so the results are identical)
+
+    Args:
+        values (np.ndarray): (n_rows, n) the values
+        window (int): the number of values in each window
+        offset (int): 0 to include the current position, 1 to end at the previous position
+
+    Returns:
+        sums (np.ndarray): (n_rows, n - window - offset + 1) the sum for each position
+            from window + offset - 1 onwards
+    '''
+    windows = sliding_window_view(values, window, axis=1)
+    if offset:
+        windows = windows[:, :-offset]
+    sums = windows[:, :, 0].copy()
+    for k in range(1, window):
+        sums += windows[:, :, k]
+    return sums
+
+
+def rolling_features(daily_new_cases_per_100k, daily_new_deaths_per_100k):
+    '''
+    Calculate the 7d rolling averages on rows of consecutive records
+    - For the first 6 records of a row, the 7d rolling average is the daily value
+    - new_cases: the average of the last 7 records (including the current one)
+    - new_deaths: the average of the previous 6 records
+
+    Args:
+        daily_new_cases_per_100k (np.ndarray): (n_states, n) the daily values, left aligned
+        daily_new_deaths_per_100k (np.ndarray): (n_states, n)
+
+    Returns:
+        (7d_rolling_avg_new_cases_per_100k, 7d_rolling_avg_new_deaths_per_100k)
+    '''
+    avg_cases = daily_new_cases_per_100k.copy()
+    avg_deaths = daily_new_deaths_per_100k.copy()
+    if avg_cases.shape[1] > 6:
+        avg_cases[:, 6:] = _rolling_sum(daily_new_cases_per_100k, 7) / 7
+        avg_deaths[:, 6:] = _rolling_sum(daily_new_deaths_per_100k, 6, offset=1) / 6
+    return avg_cases, avg_deaths
+
+
+def compact_order(present):
+    '''
+    Get the order that moves the records of each row to the left, keeping their order
+
+    Args:
+        present (np.ndarray): (n_states, n_dates) whether the state has a record at the date
+
+    Returns:
+        order (np.ndarray): (n_states, n_dates) the column of each compact position
+        counts (np.ndarray): (n_states,) the number of records of each state
+    '''
+    order = np.argsort(~present, axis=1, kind='stable')
+    counts = present.sum(axis=1)
+    return order, counts
+
+
+def compact(values, order):
+    '''
+    Move the records of each row to the left, with the order of compact_order
+    '''
+    return np.take_along_axis(values, order, axis=1)
+
+
+def scatter(values, order):
+    '''
+    Move compacted values back to their columns, the reverse of compact
+    '''
+    out = np.full(values.shape, np.nan)
+    np.put_along_axis(out, order, values, axis=1)
+    return out
+
+
+def case_features(new_cases, new_deaths, population, order):
+    '''
+    Calculate the daily and 7d rolling new cases and new deaths per 100,000 people of rows of records
+
+    The rolling windows run over each row's own records, even if it is missing some dates
+
+    Args:
+        new_cases (np.ndarray): (n_rows, n_dates) the new cases
+        new_deaths (np.ndarray): (n_rows, n_dates) the new deaths
+        population (np.ndarray): (n_rows,) the population of each row
+        order (np.ndarray): (n_rows, n_dates) the order of compact_order
+
+    Returns:
+        {
+            'daily_new_cases_per_100k': np.ndarray (n_rows, n_dates), float,
+            '7d_rolling_avg_new_cases_per_100k': ...,
+            'daily_new_deaths_per_100k': ...,
+            '7d_rolling_avg_new_deaths_per_100k': ...,
+        }
+    '''
+    population = np.asarray(population, dtype=np.float64)[:, None]
+
+    # Calculate the daily new cases and new deaths per 100,000 people
+    print('> Calculating daily new cases and new deaths per 100,000 people...')
+    daily_new_cases_per_100k = compact(new_cases, order) / population * 100000
+    daily_new_deaths_per_100k = compact(new_deaths, order) / population * 100000
+
+    # Calculate the 7d rolling average of new cases and new deaths per 100,000 people
+    print('> Calculating 7d rolling average of new cases and new deaths per 100,000 people...')
+    avg_cases, avg_deaths = rolling_features(daily_new_cases_per_100k, daily_new_deaths_per_100k)
+
+    return {
+        'daily_new_cases_per_100k': scatter(daily_new_cases_per_100k, order),
+        '7d_rolling_avg_new_cases_per_100k': scatter(avg_cases, order),
+        'daily_new_deaths_per_100k': scatter(daily_new_deaths_per_100k, order),
+        '7d_rolling_avg_new_deaths_per_100k': scatter(avg_deaths, order),
+    }
+
+
+def calculate_features(data):
+    '''
+    Calculate the features for each state and date as whole-array operations
+
+    The dates of each state are processed in order of the state's own records, and the
+    last record of each state (today) is left out, the same as the per-date loops did
+
+    Args:
+        data (dict or Dataset): the data from the data.json file
+
+    Returns:
+        {
+            'state_ids': [str],
+            'dates': np.ndarray (n_dates,),
+            'population2021': np.ndarray (n_states,),
+            'present': np.ndarray (n_states, n_dates), bool,
+            'daily_new_cases_per_100k': np.ndarray (n_states, n_dates), float,
+            '7d_rolling_avg_new_cases_per_100k': ...,
+            ...
+        }
+    '''
+    matrix = build_matrix(data)
+    population = matrix['population2021'][:, None]
+    present = matrix['present']
+
+    # Move the records of each state to the left so the rolling windows run over the
+    # state's own records even if it is missing some dates
+    order, counts = compact_order(present)
+    cases_deaths = case_features(matrix['new_cases'], matrix['new_deaths'], matrix['population2021'], order)
+
+    # Calculate the daily percentage of people who received at least one dose and are fully vaccinated
+    print('> Calculating daily percentage of people who received at least one dose and are fully vaccinated...')
+    one_dose = matrix['People_at_least_one_dose'] / population * 100
+    fully_vaccinated = matrix['People_fully_vaccinated'] / population * 100
+
+    # Filter out today: the last record of each state
+    present = present.copy()
+    rows = np.nonzero(counts)[0]
+    present[rows, order[rows, counts[rows] - 1]] = False
+
+    features = {
+        'state_ids': matrix['state_ids'],
+        'dates': matrix['dates'],
+        'population2021': matrix['population2021'],
+        'present': present,
+        **cases_deaths,
+        'daily_percentage_of_people_who_received_at_least_one_dose': one_dose,
+        'daily_percentage_of_people_who_are_fully_vaccinated': fully_vaccinated,
+    }
+    return features
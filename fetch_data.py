@@ -1,58 +1,268 @@
-import psycopg2
+import argparse
+import io
 import requests
 import pandas as pd
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from uszipcode import SearchEngine
+import instrumentation
+from data_file import parse_data, write_data
+from reference_data import load_reference_tables
 
 
-def fetch_data():
+# the upstream sources of the covid data
+COVID_URL = 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-states.csv'
+VACCINATION_URL = 'https://raw.githubusercontent.com/govex/COVID-19/master/data_tables/vaccine_data/us_data/time_series/time_series_covid19_vaccine_us.csv'
+
+# the columns used from each source and their types, the other columns are never parsed
+COVID_COLUMNS = {
+    'date': str,
+    'state': str,
+    'cases': 'float64',
+    'deaths': 'float64',
+}
+VACCINATION_COLUMNS = {
+    'Date': str,
+    'Province_State': str,
+    'People_at_least_one_dose': 'float64',
+    'People_fully_vaccinated': 'float64',
+}
+
+# the number of bytes read from the network and the number of rows parsed at a time
+CHUNK_BYTES = 1 << 16
+CHUNK_ROWS = 50000
+
+# the folder keeping the last body of each source with its ETag and Last-Modified
+FETCH_CACHE_DIR = 'fetch_cache'
+
+# the number of attempts for each source, waiting BACKOFF * 2^attempt seconds in between
+RETRIES = 4
+BACKOFF = 1.0
+
+# the responses worth another attempt
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ChunkStream(io.RawIOBase):
+    '''
+    A read-only file object over an iterator of byte chunks, e.g. an HTTP response body
+
+    Every chunk pulled is also written to `tee` if given, so the body can be cached
+    while it is parsed
+    '''
+
+    def __init__(self, chunks, tee=None):
+        self.chunks = iter(chunks)
+        self.tee = tee
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # Pull chunks until there is something to return or the body is exhausted
+        while not self.buffer:
+            try:
+                self.buffer = next(self.chunks)
+            except StopIteration:
+                return 0
+            if self.tee is not None:
+                self.tee.write(self.buffer)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+def read_csv_stream(chunks, columns, tee=None, transform=None):
+    '''
+    Parse a csv from an iterator of byte chunks, a block of rows at a time, keeping only the given columns
+
+    Args:
+        chunks (iterator): the bytes of the csv
+        columns (dict): the columns to keep and their types
+        tee (file): a file to copy the bytes to, optional
+        transform (function): applied to each block of rows as it is parsed, e.g. to drop rows, optional
+
+    Returns:
+        df (pandas dataframe): the parsed columns
+    '''
+    stream = io.BufferedReader(ChunkStream(chunks, tee), buffer_size=CHUNK_BYTES)
+    reader = pd.read_csv(stream, usecols=list(columns), dtype=columns, chunksize=CHUNK_ROWS)
+    if transform is not None:
+        reader = map(transform, reader)
+    return pd.concat(reader, ignore_index=True)
+
+
+def create_session():
+    '''
+    Create the HTTP session of the sources, the failed requests are retried by fetch_csv
+    '''
+    return requests.Session()
+
+
+def fetch_csv(url, columns, name, session=None, cache_dir=FETCH_CACHE_DIR, transform=None):
+    '''
+    Fetch a csv with a conditional request, streaming and parsing it without buffering the whole body
+
+    The body is cached in cache_dir with its ETag and Last-Modified. If the source answers
+    304 Not Modified, the cached body is parsed instead. A new body and its validators are
+    kept aside until commit_fetch is called, once the data built from them has been saved.
+    Failed connections, bodies cut off and 429/5xx responses are attempted RETRIES times
+    in all, with backoff.
+
+    Args:
+        url (str): the url of the csv
+        columns (dict): the columns to keep and their types
+        name (str): the name of the source in the cache
+        session (requests.Session): the session to use, optional
+        cache_dir (str): the folder of the cache
+        transform (function): applied to each block of rows as it is parsed, optional
+
+    Returns:
+        df (pandas dataframe): the parsed columns
+        changed (bool): False if the source answered 304 Not Modified
+    '''
+    session = session or create_session()
+    os.makedirs(cache_dir, exist_ok=True)
+    body_path = os.path.join(cache_dir, f'{name}.csv')
+    meta_path = os.path.join(cache_dir, f'{name}.json')
+    pending_body_path = os.path.join(cache_dir, f'{name}.pending.csv')
+    pending_meta_path = os.path.join(cache_dir, f'{name}.pending.json')
+
+    # Send the validators of the cached body, if it is from the same url
+    meta = {}
+    if os.path.exists(body_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get('url') != url:
+            meta = {}
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    for attempt in range(RETRIES):
+        try:
+            with session.get(url, headers=headers, stream=True) as response:
+                if response.status_code == 304:
+                    print(f"> {name}: not modified, using the cached copy")
+                    with open(body_path, 'rb') as f:
+                        df = read_csv_stream(iter(lambda: f.read(CHUNK_BYTES), b''), columns, transform=transform)
+                    instrumentation.count('rows_parsed', len(df))
+                    return df, False
+                response.raise_for_status()
+                # Parse the body while copying it to the cache
+                with open(pending_body_path + '.tmp', 'wb') as f:
+                    df = read_csv_stream(response.iter_content(chunk_size=CHUNK_BYTES), columns, tee=f,
+                                         transform=transform)
+                os.replace(pending_body_path + '.tmp', pending_body_path)
+                instrumentation.count('rows_parsed', len(df))
+                with open(pending_meta_path, 'w') as f:
+                    json.dump({
+                        'url': url,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                    }, f)
+                return df, True
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code not in RETRY_STATUSES or attempt == RETRIES - 1:
+                raise
+            print(f"> {name}: {e}, retrying")
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            # The connection failed or the body was cut off
+            if attempt == RETRIES - 1:
+                raise
+            print(f"> {name}: {e}, retrying")
+        # Try again after a while
+        time.sleep(BACKOFF * 2 ** attempt)
+
+
+def commit_fetch(name, cache_dir=FETCH_CACHE_DIR):
+    '''
+    Keep the last body fetched from a source and its validators, once the data built from it has been saved
+
+    Until then the previous body and validators stay in use, so a run failing after the fetch
+    (e.g. when the database is down) downloads the source again next time instead of getting 304.
+
+    Args:
+        name (str): the name of the source in the cache
+        cache_dir (str): the folder of the cache
+    '''
+    # The body first, the validators of the previous body must never describe the new one
+    for ext in ('csv', 'json'):
+        pending_path = os.path.join(cache_dir, f'{name}.pending.{ext}')
+        if os.path.exists(pending_path):
+            os.replace(pending_path, os.path.join(cache_dir, f'{name}.{ext}'))
+
+
+def newer_rows(cutoffs, date_column, state_column):
+    '''
+    Make a transform for read_csv_stream keeping only the rows of the known states newer than their cutoff
+
+    Args:
+        cutoffs (dict): state_name -> 'YYYY-MM-DD', see incremental_cutoffs
+        date_column (str): the column of the dates
+        state_column (str): the column of the state names
+
+    Returns:
+        transform (function): the transform of a block of rows
+    '''
+    def transform(df):
+        cutoff = df[state_column].map(cutoffs)
+        known = cutoff.notna()
+        return df[known & (df[date_column] > cutoff.fillna(''))]
+    return transform
+
+
+def fetch_data(covid_url=COVID_URL, vaccination_url=VACCINATION_URL, skip_unchanged=False, cutoffs=None):
     '''
     Fetch the covid data from the github (cases, deaths, vaccinations)
 
+    Both sources are fetched concurrently with conditional requests.
+
+    Args:
+        covid_url (str): the url of the cases and deaths csv
+        vaccination_url (str): the url of the vaccinations csv
+        skip_unchanged (bool): return None if neither source has changed since the last fetch
+        cutoffs (dict): state_name -> the date up to which the state is already ingested (see
+            incremental_cutoffs), to keep only the newer rows of the known states as they are parsed, optional
+
     Returns:
         covid_df (pandas dataframe): the dataframe of the covid data
     '''
-    # Fetch the cases and deaths data from CDC
-    print("> Fetching covid cases and deaths data from CDC")
-    csv = requests.get(
-        'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-states.csv'
-    )
-    csv.encoding = 'utf-8'
-    # Save the data to csv file
-    print("> Saving data to csv file")
-    with open('oriCSV/covidData.csv', 'w') as f:
-        f.write(csv.text)
-
-    # Fetch the vaccination data from JHU
-    print("> Fetching covid vaccination data from JHU")
-    csv = requests.get(
-        'https://raw.githubusercontent.com/govex/COVID-19/master/data_tables/vaccine_data/us_data/time_series/time_series_covid19_vaccine_us.csv'
-    )
-    csv.encoding = 'utf-8'
-    # Save the data to csv file
-    print("> Saving data to csv file")
-    with open('oriCSV/vaccinationData.csv', 'w') as f:
-        f.write(csv.text)
+    session = create_session()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # Fetch the cases and deaths data from CDC
+        print("> Fetching covid cases and deaths data from CDC")
+        covid = executor.submit(fetch_csv, covid_url, COVID_COLUMNS, 'covid', session,
+                                transform=newer_rows(cutoffs, 'date', 'state') if cutoffs is not None else None)
+        # Fetch the vaccination data from JHU
+        print("> Fetching covid vaccination data from JHU")
+        vaccination = executor.submit(fetch_csv, vaccination_url, VACCINATION_COLUMNS, 'vaccination', session,
+                                      transform=newer_rows(cutoffs, 'Date', 'Province_State')
+                                      if cutoffs is not None else None)
+        covid_df, covid_changed = covid.result()
+        vacc_df, vaccination_changed = vaccination.result()
+
+    if skip_unchanged and not covid_changed and not vaccination_changed:
+        print("> Neither source has changed")
+        return None
 
-    # Merge the two dataframes on date and state
-    print("> Merging dataframes")
-    covid_df = pd.read_csv('oriCSV/covidData.csv')
-    vacc_df = pd.read_csv('oriCSV/vaccinationData.csv')
     vacc_df.rename(
         columns={'Date': 'date', 'Province_State': 'state'}, inplace=True)
 
-    # Delete the two csv files
-    print("> Deleting csv files")
-    os.remove('oriCSV/covidData.csv')
-    os.remove('oriCSV/vaccinationData.csv')
-
+    # Merge the two dataframes on date and state
+    print("> Merging dataframes")
     covid_df = pd.merge(covid_df, vacc_df, on=['date', 'state'], how='outer')
     
     return covid_df
 
 
-def preprocess(covid_df):
+def preprocess(covid_df, conn=None):
     '''
     1. Query the amazon fulfillment centers data from the PostgreSQL database
     2. Query the states data from the PostgreSQL database
@@ -61,6 +271,7 @@ def preprocess(covid_df):
 
     Args:
         covid_df (pandas dataframe): the dataframe of the covid data
+        conn: a DB-API connection, a pooled connection is used if not given
 
     Returns:
         {
@@ -91,138 +302,237 @@ def preprocess(covid_df):
             }
         }
     '''
-    # Connect to an existing database
-    conn = psycopg2.connect(
-        database='d6q3frh2587tv4',
-        user='uyybfpcdrrshxa',
-        password="b8a4132cad49583c6b4de0829feedd52fd28f3bd1ab5c38797add7f75d984036",
-        host='ec2-35-170-146-54.compute-1.amazonaws.com',
-        port='5432'
-    )
-    # Open a cursor to perform database operations
-    curs = conn.cursor()
-    print("> Connected to database")
-
-    # Execute the query: select all centers from yfz.locations
-    print("> Querying data from yfz.locations")
-    curs.execute("SELECT * FROM yfz.locations")
-    rows = curs.fetchall()
-    # Save the data to pandas dataframe
-    center_df = pd.DataFrame(
-        rows, columns=['center_id', 'center_name', 'county_id', 'state_id', 'zip_code'])
-
-    # # Save the center_df to ./centers.csv
-    # print("> Saving data to csv file")
-    # center_df.to_csv('./centers.csv', index=False)
-
-    # Execute the query: select all states from yfz.states
-    print("> Querying data from yfz.states")
-    curs.execute("SELECT * FROM yfz.states")
-    rows = curs.fetchall()
-    # Save the data to pandas dataframe
-    state_df = pd.DataFrame(rows, columns=[
-                            'state_id', 'state_name', 'state_fips', 'state_abbr', 'population2020', 'population2021'])
+    # Load the centers and states from the database, or from the local copy if they have not changed
+    center_df, state_df = load_reference_tables(conn)
 
     # Add the covid data to the states data (merge with covid_df on state_id)
-    covid_df.rename(columns={'state': 'state_name'}, inplace=True)
+    covid_df = covid_df.rename(columns={'state': 'state_name'})
     print("> Adding covid data to states data")
     state_df = pd.merge(state_df, covid_df, on='state_name', how='left')
     state_df = state_df.fillna(0)
     # keep only the columns we need
     state_df = state_df[['state_id', 'state_name', 'state_abbr', 'population2020', 'population2021',
                          'date', 'cases', 'deaths', 'People_at_least_one_dose', 'People_fully_vaccinated']]
+    # keep the first record of each state and date
+    state_df = state_df.drop_duplicates(['state_id', 'date'])
+    state_df = state_df.astype({'date': str, 'cases': 'int64', 'deaths': 'int64',
+                                'People_at_least_one_dose': 'int64', 'People_fully_vaccinated': 'int64'})
 
-    # Merge the two dataframes on state_id
-    print("> Merging dataframes")
-    state_df = pd.merge(state_df, center_df, on='state_id', how='left')
+    # Add a "new_cases" and "new_deaths" to make cases and deaths from cumulative to daily
+    print("> Adding new_cases and new_deaths")
+    by_date = state_df.sort_values('date', kind='stable').groupby('state_id', sort=False)
+    # the first date of each state keeps its cumulative value
+    state_df['new_cases'] = by_date['cases'].diff().fillna(state_df['cases']).astype('int64')
+    state_df['new_deaths'] = by_date['deaths'].diff().fillna(state_df['deaths']).astype('int64')
 
-    # Save state_df to csv file
-    print("> Saving data to csv file")
-    state_df.to_csv('oriCSV/stateData.csv', index=False)
+    # Join the centers once per state, instead of once per date row
+    print("> Merging dataframes")
+    center_df = pd.merge(state_df[['state_id']].drop_duplicates(), center_df, on='state_id', how='left')
+    center_df = center_df[center_df['center_id'].notna()]
 
     # Process the data to output a json containing the (1) covid data for each state and (2) the amazon fulfillment centers in each state
     print("> Processing data to output a json")
     # Create a dictionary to store the data
     data = {}
-    # Iterate through each row in the state_df
-    for index, row in state_df.iterrows():
-        # Get the state_id
-        state_id = row['state_id']
-        # If the state_id is not in the data dictionary, add it
-        if state_id not in data:
-            data[state_id] = {
-                'state_name': row['state_name'],
-                'state_abbr': row['state_abbr'],
-                'population2020': int(row['population2020']),
-                'population2021': int(row['population2021']),
-                'centers': {},
-                'dates': {},
-            }
-        # Get the date
-        date = row['date']
-        # If the date is not in the data dictionary, add it
-        if date not in data[state_id]['dates']:
+    centers_by_state = center_df.groupby('state_id', sort=False)
+    dates_by_state = state_df.groupby('state_id', sort=False)
+    for state_id in state_df['state_id'].unique().tolist():
+        group = dates_by_state.get_group(state_id)
+        first = group.iloc[0]
+        data[state_id] = {
+            'state_name': first['state_name'],
+            'state_abbr': first['state_abbr'],
+            'population2020': int(first['population2020']),
+            'population2021': int(first['population2021']),
+            'centers': {},
+            'dates': {},
+        }
+        # Add the centers of the state
+        if state_id in centers_by_state.groups:
+            centers = centers_by_state.get_group(state_id)
+            for center_id, center_name, county_id, zip_code in zip(
+                    centers['center_id'].tolist(), centers['center_name'].tolist(),
+                    centers['county_id'].tolist(), centers['zip_code'].tolist()):
+                data[state_id]['centers'][str(int(center_id))] = {
+                    'center_name': center_name,
+                    'county_id': str(int(county_id)),
+                    'zip_code': zip_code,
+                }
+        # Add the dates of the state from the columns of the group
+        columns = [group[column].tolist() for column in
+                   ['date', 'cases', 'deaths', 'People_at_least_one_dose', 'People_fully_vaccinated', 'new_cases', 'new_deaths']]
+        for date, cases, deaths, one_dose, fully_vaccinated, new_cases, new_deaths in zip(*columns):
             data[state_id]['dates'][date] = {
-                'cases': int(row['cases']),
-                'deaths': int(row['deaths']),
-                'People_at_least_one_dose': int(row['People_at_least_one_dose']),
-                'People_fully_vaccinated': int(row['People_fully_vaccinated']),
+                'cases': cases,
+                'deaths': deaths,
+                'People_at_least_one_dose': one_dose,
+                'People_fully_vaccinated': fully_vaccinated,
+                'new_cases': new_cases,
+                'new_deaths': new_deaths,
             }
-        # Add the center to the state if center_id is not nan
-        if not pd.isna(row['center_id']):
-            data[state_id]['centers'][str(int(row['center_id']))] = {
-                'center_name': row['center_name'],
-                'county_id': str(int(row['county_id'])),
-                'zip_code': row['zip_code'],
-            }
-    
-    # Close the cursor
-    curs.close()
-    # Close the connection
-    conn.close()
 
-    # Add a "new_cases" and "new_deaths" to make cases and deaths from cumulative to daily
+    return data
+
+
+def incremental_cutoffs(data, overlap_days=1):
+    '''
+    Get the date of each state up to which its rows are already ingested
+
+    The last `overlap_days` dates of each state are not counted, they are ingested again
+    (see preprocess_incremental).
+
+    Args:
+        data (dict): the data from the existing data.json file
+        overlap_days (int): the number of already ingested dates to ingest again
+
+    Returns:
+        cutoffs (dict): state_name -> 'YYYY-MM-DD', '' for a state without dates
+    '''
+    cutoffs = {}
+    for state_data in data.values():
+        dates = state_data['dates']
+        cutoff = ''
+        if dates:
+            # The dates are stored in order, so the last ingested date is the last key
+            last_date = next(reversed(dates))
+            cutoff = (pd.Timestamp(last_date) - pd.Timedelta(days=overlap_days)).strftime('%Y-%m-%d')
+        cutoffs[state_data['state_name']] = cutoff
+    return cutoffs
+
+
+def preprocess_incremental(covid_df, data, overlap_days=1):
+    '''
+    Append only the new dates of covid_df to the existing data, instead of rebuilding it
+
+    The last ingested date of each state and its cumulative cases and deaths are read from
+    the data itself, so only the rows newer than that are processed. The last
+    `overlap_days` dates of each state are ingested again, to pick up vaccination figures
+    that are published a day late.
+
+    Args:
+        covid_df (pandas dataframe): the dataframe of the covid data
+        data (dict): the data from the existing data.json file, updated in place
+        overlap_days (int): the number of already ingested dates to ingest again
+
+    Returns:
+        appended (int): the number of state-date records written
+    '''
+    # Find the cutoff date and the last cumulative values of each state
+    print("> Reading the last ingested date of each state")
+    name_cutoffs = incremental_cutoffs(data, overlap_days)
+    name_to_id = {}
+    cutoffs = {}
+    previous_cases = {}
+    previous_deaths = {}
+    for state_id, state_data in data.items():
+        name_to_id[state_data['state_name']] = state_id
+        dates = state_data['dates']
+        if not dates:
+            continue
+        cutoff = name_cutoffs[state_data['state_name']]
+        # Drop the overlapping dates, they are ingested again below
+        while dates and next(reversed(dates)) > cutoff:
+            dates.popitem()
+        cutoffs[state_id] = cutoff
+        if dates:
+            last = dates[next(reversed(dates))]
+            previous_cases[state_id] = last['cases']
+            previous_deaths[state_id] = last['deaths']
+
+    # Keep only the rows newer than the cutoff of their state
+    print("> Filtering the new rows")
+    covid_df = covid_df[['date', 'state', 'cases', 'deaths', 'People_at_least_one_dose', 'People_fully_vaccinated']]
+    covid_df = covid_df.assign(state_id=covid_df['state'].map(name_to_id))
+    covid_df = covid_df[covid_df['state_id'].notna()]
+    cutoff = covid_df['state_id'].map(cutoffs).fillna('')
+    covid_df = covid_df[covid_df['date'] > cutoff]
+    covid_df = covid_df.drop_duplicates(['state_id', 'date']).sort_values(['state_id', 'date'], kind='stable')
+    covid_df = covid_df.fillna(0)
+
+    # Make cases and deaths from cumulative to daily, starting from the stored values
     print("> Adding new_cases and new_deaths")
-    for state_id in data:
-        dates = list(data[state_id]['dates'].keys())
-        dates.sort()
-        for i in range(0, len(dates)):
-            if i == 0:
-                data[state_id]['dates'][dates[i]]['new_cases'] = data[state_id]['dates'][dates[i]]['cases']
-                data[state_id]['dates'][dates[i]]['new_deaths'] = data[state_id]['dates'][dates[i]]['deaths']
-            else:
-                data[state_id]['dates'][dates[i]]['new_cases'] = data[state_id]['dates'][dates[i]]['cases'] - data[state_id]['dates'][dates[i-1]]['cases']
-                data[state_id]['dates'][dates[i]]['new_deaths'] = data[state_id]['dates'][dates[i]]['deaths'] - data[state_id]['dates'][dates[i-1]]['deaths']
+    for column in ['cases', 'deaths', 'People_at_least_one_dose', 'People_fully_vaccinated']:
+        covid_df[column] = covid_df[column].astype('int64')
+    grouped = covid_df.groupby('state_id', sort=False)
+    # The first new row of a state continues from the last stored date (or from 0)
+    prev_cases = grouped['cases'].shift(1).fillna(covid_df['state_id'].map(previous_cases)).fillna(0)
+    prev_deaths = grouped['deaths'].shift(1).fillna(covid_df['state_id'].map(previous_deaths)).fillna(0)
+    covid_df['new_cases'] = covid_df['cases'] - prev_cases.astype('int64')
+    covid_df['new_deaths'] = covid_df['deaths'] - prev_deaths.astype('int64')
 
-    return data
+    # Append the new dates
+    print("> Appending the new dates")
+    for row in covid_df.itertuples(index=False):
+        data[row.state_id]['dates'][row.date] = {
+            'cases': int(row.cases),
+            'deaths': int(row.deaths),
+            'People_at_least_one_dose': int(row.People_at_least_one_dose),
+            'People_fully_vaccinated': int(row.People_fully_vaccinated),
+            'new_cases': int(row.new_cases),
+            'new_deaths': int(row.new_deaths),
+        }
+
+    return len(covid_df)
 
 
+def main(incremental=False, force=False):
+    # only the new dates can be appended if there is an existing data.json
+    if incremental and not os.path.exists('data.json'):
+        print('No data.json to update, running a full rebuild')
+        incremental = False
 
-def main():
-    # create a folder if it doesn't exist
-    if not os.path.exists('oriCSV'):
-        os.makedirs('oriCSV')
+    # the rows already in data.json are dropped as the sources are parsed
+    cutoffs = None
+    if incremental:
+        with instrumentation.stage('read_data'):
+            data = parse_data()
+        cutoffs = incremental_cutoffs(data)
 
     # fetch covid data
     print('Fetching covid data...')
-    covid_df = fetch_data()
+    with instrumentation.stage('fetch'):
+        covid_df = fetch_data(skip_unchanged=not force and os.path.exists('data.json'), cutoffs=cutoffs)
     print()
 
-    # preprocess the data
-    print('Preprocessing data...')
-    data = preprocess(covid_df)
-    print()
+    # nothing to do if the upstream data has not changed since the last run
+    if covid_df is None:
+        print('The upstream data has not changed, data.json is up to date')
+        instrumentation.count('files_written', 0)
+        return
+
+    if incremental:
+        # append the new dates to the existing data
+        print('Appending new dates...')
+        with instrumentation.stage('append'):
+            appended = preprocess_incremental(covid_df, data)
+        instrumentation.count('records_written', appended)
+        print(f'> Appended {appended} records')
+        print()
+    else:
+        # preprocess the data
+        print('Preprocessing data...')
+        with instrumentation.stage('preprocess'):
+            data = preprocess(covid_df)
+        instrumentation.count('records_written', sum(len(state_data['dates']) for state_data in data.values()))
+        print()
 
     # save the data to json file
     print('Saving data to json file...')
-    with open('data.json', 'w') as f:
-        json.dump(data, f, indent = 4)
+    with instrumentation.stage('write'):
+        write_data(data)
+    # data.json is up to date with the fetched sources, the next run can skip them if they are unchanged
+    for name in ('covid', 'vaccination'):
+        commit_fetch(name)
     print('Done!')
 
-    # remove the csv file and folder
-    os.remove('oriCSV/stateData.csv')
-    os.rmdir('oriCSV')
-
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Fetch the covid data and save it to data.json')
+    parser.add_argument('--incremental', action='store_true',
+                        help='append only the dates newer than the ones in data.json')
+    parser.add_argument('--force', action='store_true',
+                        help='process the data even if neither source has changed')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    with instrumentation.job('fetch_data', args):
+        main(incremental=args.incremental, force=args.force)
@@ -0,0 +1,263 @@
+'''
+Find the fulfillment centers near a point or a zip code, offline
+
+The centers are geocoded once from their zip codes with uszipcode, and saved with the
+coordinates of every zip code next to centers.csv:
+    python geo_index.py
+The API then loads the two csv files and never touches the uszipcode database.
+'''
+import heapq
+import math
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# the centers with their coordinates, and the coordinates of every zip code
+CENTERS_GEO_PATH = 'centers_geo.csv'
+ZIPCODES_GEO_PATH = 'zipcodes_geo.csv'
+
+# the mean radius of the earth
+EARTH_RADIUS_MILES = 3958.8
+
+# the number of centers in a leaf of the KD-tree, scanned at once
+LEAF_SIZE = 32
+
+
+def unit_vectors(lat, lng):
+    '''
+    Get the points of the unit sphere at some coordinates
+
+    The straight-line (chord) distance between two of them grows with the great-circle
+    distance, so a KD-tree on the points answers great-circle queries exactly.
+
+    Returns:
+        points (np.ndarray): (n, 3) float64
+    '''
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)])
+
+
+def unit_vector(lat, lng):
+    # The same as unit_vectors for one point, without the overhead of numpy on scalars
+    lat, lng = math.radians(lat), math.radians(lng)
+    return np.array([math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat)])
+
+
+def chord_for_miles(miles):
+    return 2 * np.sin(min(miles / EARTH_RADIUS_MILES, np.pi) / 2)
+
+
+def miles_for_chord(chord):
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.minimum(chord / 2, 1))
+
+
+def format_zipcode(zipcode):
+    # The zip codes of centers.csv are numbers, without their leading zeros
+    return str(int(zipcode)).zfill(5)
+
+
+class GeoIndex(object):
+    '''
+    A KD-tree of the centers on the unit sphere, with the coordinates of the zip codes
+
+    The tree splits the widest axis at the median until a node has at most LEAF_SIZE
+    centers. The centers are stored in the order of the leaves, so a leaf is a slice of
+    the points and is scanned with one vectorized distance.
+
+    Attributes:
+        centers (list): {'center_id', 'center_name', 'state_id', 'zip_code'} of each center, in tree order
+        points (np.ndarray): (n, 3) the unit vectors of the centers, in tree order
+        zipcodes (dict): zip code -> (lat, lng)
+    '''
+
+    def __init__(self, centers_df, zipcodes=None, leaf_size=LEAF_SIZE):
+        '''
+        Args:
+            centers_df (pandas dataframe): center_id, center_name, state_id, zip_code, lat, lng
+            zipcodes (dict): zip code -> (lat, lng), for the queries by zip code
+            leaf_size (int): the number of centers in a leaf
+        '''
+        centers_df = centers_df.dropna(subset=['lat', 'lng'])
+        points = unit_vectors(centers_df['lat'], centers_df['lng'])
+        self.leaf_size = leaf_size
+        self._start, self._end, self._left, self._right, self._box_min, self._box_max = [], [], [], [], [], []
+        order = np.arange(len(points))
+        if len(points):
+            self._build(points, order, 0, len(points))
+        self.box_min = np.array(self._box_min).reshape(-1, 3)
+        self.box_max = np.array(self._box_max).reshape(-1, 3)
+
+        # Store the centers in the order of the leaves
+        self.points = points[order]
+        rows = centers_df.iloc[order]
+        self.centers = [
+            {'center_id': str(int(center_id)), 'center_name': center_name, 'state_id': str(int(state_id)),
+             'zip_code': format_zipcode(zip_code)}
+            for center_id, center_name, state_id, zip_code in zip(rows['center_id'], rows['center_name'],
+                                                                 rows['state_id'], rows['zip_code'])
+        ]
+
+        # The zip codes of the centers can always be looked up
+        self.zipcodes = dict(zipcodes or {})
+        for center, lat, lng in zip(self.centers, rows['lat'], rows['lng']):
+            self.zipcodes.setdefault(center['zip_code'], (float(lat), float(lng)))
+
+    def _build(self, points, order, start, end):
+        node = len(self._start)
+        block = points[order[start:end]]
+        box_min, box_max = block.min(axis=0), block.max(axis=0)
+        self._start.append(start)
+        self._end.append(end)
+        self._left.append(-1)
+        self._right.append(-1)
+        self._box_min.append(box_min)
+        self._box_max.append(box_max)
+        if end - start > self.leaf_size:
+            # Split the widest axis at the median
+            axis = int(np.argmax(box_max - box_min))
+            mid = (start + end) // 2
+            order[start:end] = order[start:end][np.argpartition(block[:, axis], mid - start)]
+            self._left[node] = self._build(points, order, start, mid)
+            self._right[node] = self._build(points, order, mid, end)
+        return node
+
+    def _box_distance2(self, point):
+        # The squared distance from the point to the bounding box of every node, 0 inside it
+        gap = np.maximum(self.box_min - point, 0) + np.maximum(point - self.box_max, 0)
+        return np.einsum('ij,ij->i', gap, gap).tolist()
+
+    def _leaf_distance2(self, node, point):
+        start, end = self._start[node], self._end[node]
+        diff = self.points[start:end] - point
+        return start, np.einsum('ij,ij->i', diff, diff)
+
+    def _results(self, positions, distance2):
+        miles = miles_for_chord(np.sqrt(distance2))
+        return [dict(self.centers[position], distance_miles=round(float(distance), 2))
+                for position, distance in zip(positions.tolist(), miles)]
+
+    def locate(self, zipcode):
+        '''
+        Get the coordinates of a zip code, None if it is unknown
+        '''
+        try:
+            return self.zipcodes.get(format_zipcode(zipcode))
+        except ValueError:
+            return None
+
+    def within(self, lat, lng, miles):
+        '''
+        Get the centers within a great-circle distance of a point, nearest first
+
+        Returns:
+            centers (list): the centers with their distance_miles
+        '''
+        if not self.centers:
+            return []
+        point = unit_vector(lat, lng)
+        radius2 = chord_for_miles(miles) ** 2
+        box2 = self._box_distance2(point)
+        positions, distance2 = [], []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if box2[node] > radius2:
+                continue
+            if self._left[node] < 0:
+                start, leaf2 = self._leaf_distance2(node, point)
+                hits = np.nonzero(leaf2 <= radius2)[0]
+                positions.append(start + hits)
+                distance2.append(leaf2[hits])
+            else:
+                stack += [self._left[node], self._right[node]]
+        if not positions:
+            return []
+        positions, distance2 = np.concatenate(positions), np.concatenate(distance2)
+        nearest = np.argsort(distance2, kind='stable')
+        return self._results(positions[nearest], distance2[nearest])
+
+    def nearest(self, lat, lng, k):
+        '''
+        Get the k centers nearest to a point, nearest first
+
+        Returns:
+            centers (list): the centers with their distance_miles
+        '''
+        if not self.centers or k <= 0:
+            return []
+        point = unit_vector(lat, lng)
+        box2 = self._box_distance2(point)
+        positions = np.zeros(0, dtype=np.int64)
+        distance2 = np.zeros(0)
+        # Visit the nodes from the nearest box, until the next box is further than the k-th center
+        heap = [(box2[0], 0)]
+        while heap:
+            node_box2, node = heapq.heappop(heap)
+            if len(distance2) == k and node_box2 > distance2[-1]:
+                break
+            if self._left[node] < 0:
+                start, leaf2 = self._leaf_distance2(node, point)
+                positions = np.concatenate([positions, start + np.arange(len(leaf2))])
+                distance2 = np.concatenate([distance2, leaf2])
+                keep = np.argsort(distance2, kind='stable')[:k]
+                positions, distance2 = positions[keep], distance2[keep]
+            else:
+                for child in (self._left[node], self._right[node]):
+                    heapq.heappush(heap, (box2[child], child))
+        return self._results(positions, distance2)
+
+
+def load_geo(centers_path=CENTERS_GEO_PATH, zipcodes_path=ZIPCODES_GEO_PATH):
+    '''
+    Load the geocoded centers and zip codes
+
+    Returns:
+        geo (GeoIndex): the index, None if the centers have not been geocoded
+    '''
+    if not os.path.exists(centers_path):
+        print(f'> Warning: no {centers_path}, /centers/within and /centers/nearest answer 503 until the centers '
+              'are geocoded with python geo_index.py', file=sys.stderr, flush=True)
+        return None
+    centers_df = pd.read_csv(centers_path)
+    zipcodes = {}
+    if os.path.exists(zipcodes_path):
+        zipcodes_df = pd.read_csv(zipcodes_path, dtype={'zipcode': str})
+        zipcodes = dict(zip(zipcodes_df['zipcode'], zip(zipcodes_df['lat'].tolist(), zipcodes_df['lng'].tolist())))
+    else:
+        print(f'> Warning: no {zipcodes_path}, only the zip codes of the centers can be queried until it is '
+              'saved with python geo_index.py', file=sys.stderr, flush=True)
+    return GeoIndex(centers_df, zipcodes)
+
+
+def geocode(centers_path='centers.csv', out=CENTERS_GEO_PATH, zipcodes_out=ZIPCODES_GEO_PATH):
+    '''
+    Geocode the centers from their zip codes, and save the coordinates of every zip code
+
+    The uszipcode database is downloaded the first time (about 10 MB).
+    '''
+    from uszipcode import SearchEngine
+    from uszipcode.model import SimpleZipcode
+
+    print('> Reading the zip codes...')
+    search = SearchEngine()
+    rows = search.ses.query(SimpleZipcode.zipcode, SimpleZipcode.lat, SimpleZipcode.lng) \
+        .filter(SimpleZipcode.lat.isnot(None), SimpleZipcode.lng.isnot(None)).all()
+    zipcodes_df = pd.DataFrame(rows, columns=['zipcode', 'lat', 'lng']).sort_values('zipcode')
+    zipcodes_df.to_csv(zipcodes_out, index=False)
+
+    print('> Geocoding the centers...')
+    centers_df = pd.read_csv(centers_path)
+    centers_df['zip_code'] = centers_df['zip_code'].map(format_zipcode)
+    centers_df['state_id'] = centers_df['state_id'].astype('Int64')
+    centers_df = centers_df.merge(zipcodes_df, how='left', left_on='zip_code', right_on='zipcode').drop(columns='zipcode')
+    missing = centers_df[centers_df['lat'].isna()]
+    if len(missing):
+        print(f'> No coordinates for the zip codes of {len(missing)} centers: {missing["center_id"].tolist()}')
+    centers_df.to_csv(out, index=False)
+    print(f'> Saved {out} and {zipcodes_out}')
+
+
+if __name__ == "__main__":
+    geocode()
@@ -0,0 +1,9 @@
+'''
+The gunicorn settings of the API, read by gunicorn from the current folder
+'''
+from results_store import open_store
+
+
+def on_starting(server):
+    # Build the results store from the csv files once, in the master, before any worker loads the app
+    open_store()
@@ -0,0 +1,224 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# the folder of the profiles saved with --profile, next to the results
+PROFILE_DIR = 'results/profiles'
+
+# the run of the current process, see start_run
+_run = None
+
+
+def rss_bytes():
+    '''
+    Get the resident set size of this process in bytes
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Not Linux, fall back to the peak so far (kilobytes on Linux, bytes on macOS)
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class RssSampler(object):
+    '''
+    Sample the RSS of this process from a background thread, to find the peak of a stage
+    '''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = rss_bytes()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+
+class Run(object):
+    '''
+    The timings, peak memory and counters of one run of a job
+
+    Each stage and the end of the run are logged as one JSON line. At the end of the run the
+    figures can also be written as a Prometheus textfile, for the node_exporter textfile collector.
+
+    Attributes:
+        job (str): the name of the job, e.g. fetch_data
+        stages (dict): stage -> {'seconds': float, 'peak_rss_bytes': int}
+        counters (dict): counter -> int, e.g. rows_parsed
+    '''
+
+    def __init__(self, job, profile=(), textfile=None, log=None):
+        '''
+        Args:
+            job (str): the name of the job
+            profile (list): the stages to run under cProfile, 'all' for every stage
+            textfile (str): the Prometheus textfile to write at the end of the run
+            log (file): where to write the JSON lines, stderr if None
+        '''
+        self.job = job
+        self.profile = set(profile or ())
+        self.textfile = textfile
+        self.log = log
+        self.stages = {}
+        self.counters = {}
+        self._counters_lock = threading.Lock()
+        self.start = time.time()
+        self._sampler = RssSampler().__enter__()
+
+    def emit(self, event, **fields):
+        record = dict(time=round(time.time(), 3), job=self.job, event=event, **fields)
+        print(json.dumps(record), file=self.log or sys.stderr, flush=True)
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Time a stage and sample its peak RSS, under cProfile if the stage is profiled
+        '''
+        profiler = cProfile.Profile() if name in self.profile or 'all' in self.profile else None
+        with RssSampler() as sampler:
+            start = time.perf_counter()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                seconds = time.perf_counter() - start
+        self.stages[name] = {'seconds': round(seconds, 4), 'peak_rss_bytes': sampler.peak}
+        self.emit('stage', stage=name, **self.stages[name])
+        if profiler is not None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f'{self.job}-{name}-{time.strftime("%Y%m%d-%H%M%S")}.prof')
+            profiler.dump_stats(path)
+            self.emit('profile', stage=name, path=path)
+
+    def count(self, name, n=1):
+        # The counters may be updated from several threads, e.g. the concurrent fetches
+        with self._counters_lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def finish(self, status='ok'):
+        '''
+        Log the totals of the run and write the Prometheus textfile
+        '''
+        self._sampler.__exit__(None, None, None)
+        seconds = round(time.time() - self.start, 4)
+        self.emit('run', status=status, seconds=seconds, peak_rss_bytes=self._sampler.peak, counters=self.counters)
+        if self.textfile:
+            self.write_textfile(status, seconds)
+
+    def write_textfile(self, status, seconds):
+        job = f'job="{self.job}"'
+        lines = [
+            '# HELP pipeline_run_seconds Wall time of the last run of the job',
+            '# TYPE pipeline_run_seconds gauge',
+            f'pipeline_run_seconds{{{job}}} {seconds}',
+            '# HELP pipeline_run_peak_rss_bytes Peak resident memory of the last run of the job',
+            '# TYPE pipeline_run_peak_rss_bytes gauge',
+            f'pipeline_run_peak_rss_bytes{{{job}}} {self._sampler.peak}',
+            '# HELP pipeline_run_success Whether the last run of the job succeeded',
+            '# TYPE pipeline_run_success gauge',
+            f'pipeline_run_success{{{job}}} {int(status == "ok")}',
+            '# HELP pipeline_run_timestamp_seconds When the last run of the job finished',
+            '# TYPE pipeline_run_timestamp_seconds gauge',
+            f'pipeline_run_timestamp_seconds{{{job}}} {round(time.time(), 3)}',
+            '# HELP pipeline_stage_seconds Wall time of each stage of the last run',
+            '# TYPE pipeline_stage_seconds gauge',
+        ]
+        lines += [f'pipeline_stage_seconds{{{job},stage="{name}"}} {stage["seconds"]}'
+                  for name, stage in self.stages.items()]
+        lines += [
+            '# HELP pipeline_stage_peak_rss_bytes Peak resident memory of each stage of the last run',
+            '# TYPE pipeline_stage_peak_rss_bytes gauge',
+        ]
+        lines += [f'pipeline_stage_peak_rss_bytes{{{job},stage="{name}"}} {stage["peak_rss_bytes"]}'
+                  for name, stage in self.stages.items()]
+        lines += [
+            '# HELP pipeline_count Counters of the last run, e.g. rows parsed and files written',
+            '# TYPE pipeline_count gauge',
+        ]
+        lines += [f'pipeline_count{{{job},name="{name}"}} {value}' for name, value in self.counters.items()]
+
+        # Write to a temporary file and swap it in, so the collector never reads a half written file
+        directory = os.path.dirname(os.path.abspath(self.textfile))
+        os.makedirs(directory, exist_ok=True)
+        with open(f'{self.textfile}.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f'{self.textfile}.tmp', self.textfile)
+
+
+def add_arguments(parser):
+    '''
+    Add the --profile and --metrics-textfile options to a job's argument parser
+    '''
+    parser.add_argument('--profile', nargs='*', metavar='STAGE',
+                        help=f'run the stages (all of them if none is given) under cProfile, saved to {PROFILE_DIR}')
+    parser.add_argument('--metrics-textfile', metavar='PATH',
+                        help='write the metrics of the run as a Prometheus textfile')
+
+
+def start_run(job, args=None):
+    '''
+    Start the run of a job in this process, with the options of add_arguments
+
+    Returns:
+        run (Run): the run, also used by stage() and count()
+    '''
+    global _run
+    profile = None if args is None else args.profile
+    if profile is not None and not profile:
+        profile = ['all']
+    _run = Run(job, profile=profile, textfile=None if args is None else args.metrics_textfile)
+    return _run
+
+
+def stage(name):
+    '''
+    Time a stage of the current run, nothing if no run was started
+    '''
+    if _run is None:
+        return nullcontext()
+    return _run.stage(name)
+
+
+def count(name, n=1):
+    '''
+    Add to a counter of the current run, nothing if no run was started
+    '''
+    if _run is not None:
+        _run.count(name, n)
+
+
+@contextmanager
+def job(name, args=None):
+    '''
+    Run a job: start the run, and log it as failed if it raises
+    '''
+    run = start_run(name, args)
+    try:
+        yield run
+    except BaseException:
+        run.finish('error')
+        raise
+    run.finish()
@@ -0,0 +1,185 @@
+import io
+import os
+import threading
+from contextlib import contextmanager
+import pandas as pd
+
+# the folder keeping a local copy of each reference table and its version
+REFERENCE_CACHE_DIR = 'reference_cache'
+
+# the reference tables and the names of their columns, in the order of the table
+REFERENCE_TABLES = {
+    'locations': {
+        'table': 'yfz.locations',
+        'columns': ['center_id', 'center_name', 'county_id', 'state_id', 'zip_code'],
+    },
+    'states': {
+        'table': 'yfz.states',
+        'columns': ['state_id', 'state_name', 'state_fips', 'state_abbr', 'population2020', 'population2021'],
+    },
+    # only read for the county-level risk of the centers, see county_data.py
+    'counties': {
+        'table': 'yfz.counties',
+        'columns': ['county_id', 'county_name', 'county_fips', 'state_id', 'population2021'],
+    },
+}
+
+# the number of rows fetched at a time when COPY is not available
+FETCH_ROWS = 10000
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''
+    Get the connection pool, creating it on first use
+
+    The credentials come from the environment: DATABASE_URL if set, otherwise the
+    standard libpq variables (PGHOST, PGPORT, PGDATABASE, PGUSER, PGPASSWORD).
+    DB_POOL_MIN and DB_POOL_MAX size the pool.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from psycopg2.pool import ThreadedConnectionPool
+            _pool = ThreadedConnectionPool(int(os.environ.get('DB_POOL_MIN', 1)),
+                                           int(os.environ.get('DB_POOL_MAX', 4)),
+                                           dsn=os.environ.get('DATABASE_URL', ''))
+    return _pool
+
+
+@contextmanager
+def connection():
+    '''
+    Borrow a connection from the pool and give it back afterwards
+    '''
+    db_pool = get_pool()
+    conn = db_pool.getconn()
+    try:
+        yield conn
+    finally:
+        db_pool.putconn(conn)
+
+
+def is_postgres(conn):
+    return type(conn).__module__.startswith('psycopg2')
+
+
+def read_table(conn, table, columns):
+    '''
+    Read a whole table into a dataframe
+
+    On PostgreSQL the rows are streamed with COPY ... TO STDOUT straight into pandas,
+    otherwise (e.g. a SQLite stand-in) they are fetched a block at a time
+
+    Args:
+        conn: a DB-API connection
+        table (str): the name of the table
+        columns (list): the names of the columns, in the order of the table
+
+    Returns:
+        df (pandas dataframe): the rows of the table
+    '''
+    curs = conn.cursor()
+    try:
+        if is_postgres(conn):
+            buffer = io.StringIO()
+            curs.copy_expert(f'COPY (SELECT * FROM {table}) TO STDOUT WITH CSV', buffer)
+            buffer.seek(0)
+            return pd.read_csv(buffer, names=columns, header=None)
+        curs.execute(f'SELECT * FROM {table}')
+        chunks = []
+        while True:
+            rows = curs.fetchmany(FETCH_ROWS)
+            if not rows:
+                break
+            chunks.append(pd.DataFrame(rows, columns=columns))
+        if not chunks:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(chunks, ignore_index=True)
+    finally:
+        curs.close()
+
+
+def table_version(conn, table):
+    '''
+    Get a cheap marker of the changes to a table, or None if there is no reliable one
+
+    On PostgreSQL the marker is the number of rows inserted, updated and deleted since the
+    statistics were last reset, read from pg_stat_user_tables without touching the table (a
+    reset of the statistics changes the marker too, and only costs one more read). The
+    stand-ins, and the tables missing from pg_stat_user_tables, have no such counters: the
+    number of rows would miss an UPDATE, so they get no marker and are read every time.
+    '''
+    if not is_postgres(conn):
+        return None
+    curs = conn.cursor()
+    try:
+        schema, name = table.split('.')
+        curs.execute('SELECT n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables '
+                     'WHERE schemaname = %s AND relname = %s', (schema, name))
+        row = curs.fetchone()
+        if row is None:
+            return None
+        return 'stat:' + '-'.join(str(count) for count in row)
+    finally:
+        curs.close()
+
+
+def load_reference_table(name, conn, cache_dir=REFERENCE_CACHE_DIR):
+    '''
+    Load a reference table from the local cache, reading it from the database only if it has changed
+
+    A table without a version (see table_version) is read from the database every time
+
+    Args:
+        name (str): the name of the table in REFERENCE_TABLES
+        conn: a DB-API connection
+        cache_dir (str): the folder of the cache
+
+    Returns:
+        df (pandas dataframe): the rows of the table
+    '''
+    table = REFERENCE_TABLES[name]
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path = os.path.join(cache_dir, f'{name}.pkl')
+    version_path = os.path.join(cache_dir, f'{name}.version')
+
+    # Compare the version of the table with the cached copy
+    version = table_version(conn, table['table'])
+    if version is None:
+        print(f"> Querying data from {table['table']}, it has no version to cache it with")
+        return read_table(conn, table['table'], table['columns'])
+    if os.path.exists(data_path) and os.path.exists(version_path):
+        with open(version_path, 'r') as f:
+            cached_version = f.read()
+        if version == cached_version:
+            print(f"> {table['table']} has not changed, using the cached copy")
+            return pd.read_pickle(data_path)
+
+    print(f"> Querying data from {table['table']}")
+    df = read_table(conn, table['table'], table['columns'])
+    df.to_pickle(data_path)
+    with open(version_path, 'w') as f:
+        f.write(version)
+    return df
+
+
+def load_reference_tables(conn=None, cache_dir=REFERENCE_CACHE_DIR):
+    '''
+    Load the centers and the states reference tables
+
+    Args:
+        conn: a DB-API connection, a pooled connection is used if not given
+
+    Returns:
+        center_df (pandas dataframe): the rows of yfz.locations
+        state_df (pandas dataframe): the rows of yfz.states
+    '''
+    if conn is None:
+        with connection() as conn:
+            return load_reference_tables(conn, cache_dir)
+    center_df = load_reference_table('locations', conn, cache_dir)
+    state_df = load_reference_table('states', conn, cache_dir)
+    return center_df, state_df
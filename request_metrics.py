@@ -0,0 +1,338 @@
+'''
+Request metrics of the API: latency histograms, response bytes and status counts per route
+
+Each worker process records its requests in memory and flushes them to its own file in
+METRICS_DIR every few seconds. /metrics sums the files of every worker of the same server
+(the workers of one gunicorn master share a parent pid), so any worker can answer it with
+the totals of all of them, in the Prometheus text format. The files of workers that have
+exited are kept, so the counters never go down while the server runs.
+
+Requests slower than a threshold (SLOW_REQUEST_MS, or per route with SLOW_REQUEST_ROUTES)
+are logged as one JSON line on stderr.
+'''
+import bisect
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# the folder of the per-worker files
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'afc-api-metrics'))
+
+# the upper bounds of the latency histogram in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# the label of the requests that matched no route
+UNMATCHED = 'unmatched'
+
+# the label of the static files
+STATIC = 'static'
+
+
+def route_label(route, status):
+    '''
+    Get the label of a request from its route and status
+
+    The static files are served from the root of both servers, so every unknown url matches
+    them: their 404s are labelled UNMATCHED, which keeps the scans of random urls apart from
+    the static files and the number of series bounded.
+
+    Args:
+        route (str): the route matched by the app, None if it matched none
+        status (str): the status code, e.g. 404
+    '''
+    if route is None or (route == STATIC and status == '404'):
+        return UNMATCHED
+    return route
+
+
+def parse_thresholds(text):
+    '''
+    Parse per-route slow request thresholds
+
+    Args:
+        text (str): e.g. '/data=5000,/date/<start>/<end>=2000', in milliseconds
+
+    Returns:
+        thresholds (dict): route -> seconds
+    '''
+    thresholds = {}
+    for part in (text or '').split(','):
+        route, _, ms = part.strip().rpartition('=')
+        if route:
+            thresholds[route] = float(ms) / 1000
+    return thresholds
+
+
+class RequestMetrics(object):
+    '''
+    The request metrics of this worker, and the totals of every worker of the server
+
+    A series is one (method, route, status) and holds the number of requests, the total
+    seconds, the total response bytes and the count of each latency bucket.
+    '''
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=5.0, slow_ms=1000, slow_routes=None, log=None):
+        '''
+        Args:
+            directory (str): the folder of the per-worker files
+            flush_interval (float): seconds between flushes of this worker's file
+            slow_ms (float): log the requests slower than this, in milliseconds
+            slow_routes (dict): route -> seconds, thresholds overriding slow_ms
+            log (file): where to write the slow requests, stderr if None
+        '''
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.slow = slow_ms / 1000
+        self.slow_routes = slow_routes or {}
+        self.log = log
+        self._series = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._path = None
+
+    def ensure_started(self):
+        '''
+        Start the flush thread in this process if it is not running yet
+        '''
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                # A forked worker starts from zero, the requests so far belong to the parent
+                self._series = {}
+                self._path = os.path.join(self.directory, f'{pid}-{time.time_ns()}.json')
+                thread = threading.Thread(target=self._run, name='metrics-flusher', daemon=True)
+                thread.start()
+                self._pid = pid
+
+    def observe(self, method, route, status, seconds, nbytes, path=None):
+        '''
+        Record a request
+
+        Args:
+            method (str): e.g. GET
+            route (str): the route rule, e.g. /center/<center_id>
+            status (str): the status code, e.g. 200
+            seconds (float): the time until the last byte of the response
+            nbytes (int): the size of the response body
+            path (str): the path of the request, for the slow request log
+        '''
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        key = (method, route, status)
+        with self._lock:
+            values = self._series.get(key)
+            if values is None:
+                values = self._series[key] = [0, 0.0, 0] + [0] * (len(LATENCY_BUCKETS) + 1)
+            values[0] += 1
+            values[1] += seconds
+            values[2] += nbytes
+            values[3 + bucket] += 1
+
+        if seconds >= self.slow_routes.get(route, self.slow):
+            record = dict(time=round(time.time(), 3), event='slow_request', pid=os.getpid(), method=method,
+                          route=route, path=path, status=status, ms=round(seconds * 1000, 1), bytes=nbytes)
+            print(json.dumps(record), file=self.log or sys.stderr, flush=True)
+
+    def flush(self):
+        '''
+        Write the series of this worker to its file
+        '''
+        if self._path is None:
+            return
+        with self._lock:
+            series = [[*key, *values] for key, values in self._series.items()]
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file and swap it in, so the other workers never read a half written file
+        with open(f'{self._path}.tmp', 'w') as f:
+            json.dump({'ppid': os.getppid(), 'series': series}, f)
+        os.replace(f'{self._path}.tmp', self._path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f'> Failed to write the request metrics: {e}')
+
+    def collect(self):
+        '''
+        Sum the series of every worker of this server
+
+        Returns:
+            series (dict): (method, route, status) -> [count, seconds, bytes, bucket counts...]
+            workers (int): the number of worker files summed
+        '''
+        self.flush()
+        ppid = os.getppid()
+        totals = {}
+        workers = 0
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'r') as f:
+                    worker = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if worker['ppid'] != ppid:
+                # Another server, remove its files once it is gone
+                if not pid_exists(worker['ppid']):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                continue
+            workers += 1
+            for method, route, status, *values in worker['series']:
+                total = totals.setdefault((method, route, status), [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+        return totals, workers
+
+    def render(self):
+        '''
+        Render the totals of every worker in the Prometheus text format
+        '''
+        series, workers = self.collect()
+        lines = [
+            '# HELP api_workers_reporting Number of worker processes included in the metrics',
+            '# TYPE api_workers_reporting gauge',
+            f'api_workers_reporting {workers}',
+            '# HELP api_requests_total Requests by route, method and status',
+            '# TYPE api_requests_total counter',
+        ]
+        lines += [f'api_requests_total{{method="{method}",route="{route}",status="{status}"}} {values[0]}'
+                  for (method, route, status), values in sorted(series.items())]
+        lines += [
+            '# HELP api_response_bytes_total Bytes of the response bodies by route, method and status',
+            '# TYPE api_response_bytes_total counter',
+        ]
+        lines += [f'api_response_bytes_total{{method="{method}",route="{route}",status="{status}"}} {values[2]}'
+                  for (method, route, status), values in sorted(series.items())]
+
+        # The latency histogram is by route and method, over every status
+        histograms = {}
+        for (method, route, status), values in series.items():
+            total = histograms.setdefault((method, route), [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+        lines += [
+            '# HELP api_request_duration_seconds Time until the last byte of the response, by route and method',
+            '# TYPE api_request_duration_seconds histogram',
+        ]
+        for (method, route), values in sorted(histograms.items()):
+            labels = f'method="{method}",route="{route}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values[3:]):
+                cumulative += count
+                lines.append(f'api_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'api_request_duration_seconds_sum{{{labels}}} {round(values[1], 6)}')
+            lines.append(f'api_request_duration_seconds_count{{{labels}}} {values[0]}')
+        return '\n'.join(lines) + '\n'
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MeteredBody(object):
+    '''
+    The body of a WSGI response, counting its bytes and recording the request once it is closed
+    '''
+
+    def __init__(self, body, metrics, environ, status, start):
+        self.body = body
+        self.metrics = metrics
+        self.environ = environ
+        self.status = status
+        self.start = start
+        self.nbytes = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.nbytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            environ = self.environ
+            self.metrics.observe(environ['REQUEST_METHOD'], route_label(environ.get('metrics.route'), self.status[0]),
+                                 self.status[0], time.perf_counter() - self.start, self.nbytes, environ.get('PATH_INFO'))
+
+
+class WsgiMetrics(object):
+    '''
+    WSGI middleware recording every request of an app in RequestMetrics
+
+    The route is read from environ['metrics.route'], which the app sets once it has matched it.
+    '''
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        self.metrics.ensure_started()
+        start = time.perf_counter()
+        status = ['500']
+
+        def metered_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line[:3]
+            return start_response(status_line, headers, exc_info)
+
+        return MeteredBody(self.app(environ, metered_start_response), self.metrics, environ, status, start)
+
+
+class AsgiMetrics(object):
+    '''
+    ASGI middleware recording every HTTP request of an app in RequestMetrics
+
+    Args:
+        app: the ASGI app
+        metrics (RequestMetrics): where to record the requests
+        routes (dict): endpoint -> route label, the endpoint being set in the scope by the router
+    '''
+
+    def __init__(self, app, metrics, routes):
+        self.app = app
+        self.metrics = metrics
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        self.metrics.ensure_started()
+        start = time.perf_counter()
+        status = ['500']
+        nbytes = [0]
+
+        async def metered_send(message):
+            if message['type'] == 'http.response.start':
+                status[0] = str(message['status'])
+            elif message['type'] == 'http.response.body':
+                nbytes[0] += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, metered_send)
+        finally:
+            # The app returns once the last byte is sent, streamed responses included
+            route = route_label(self.routes.get(scope.get('endpoint')), status[0])
+            self.metrics.observe(scope['method'], route, status[0], time.perf_counter() - start, nbytes[0],
+                                 scope.get('path'))
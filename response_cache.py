@@ -0,0 +1,199 @@
+import gzip
+import hashlib
+import json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# brotli quality for the cached responses, 11 is too slow for the multi-megabyte /data
+BROTLI_QUALITY = 5
+
+
+def dump_json(payload):
+    '''
+    Serialize a payload the same way Flask's JSON provider does for a returned dict
+    (sorted keys, compact separators and a trailing newline)
+    '''
+    return (json.dumps(payload, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def parse_accept_encoding(header):
+    '''
+    Parse an Accept-Encoding header
+
+    Returns:
+        encodings (set): the accepted content codings (q > 0)
+    '''
+    encodings = set()
+    for part in (header or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            encodings.add(coding)
+    return encodings
+
+
+class CachedResponse(object):
+    '''
+    A JSON response serialized once, with its gzip and brotli variants and strong ETags
+    '''
+
+    def __init__(self, payload=None, body=None):
+        if body is None:
+            body = dump_json(payload)
+        self.body = body
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        # Each representation gets its own strong ETag since their bytes differ
+        self.variants = {
+            'identity': (body, f'"{digest}"'),
+            'gzip': (gzip.compress(body, mtime=0), f'"{digest}-gz"'),
+        }
+        if brotli is not None:
+            self.variants['br'] = (brotli.compress(body, quality=BROTLI_QUALITY,
+                                                   mode=brotli.MODE_TEXT), f'"{digest}-br"')
+        self.etags = {etag for _, etag in self.variants.values()}
+
+    def select(self, accept_encoding):
+        '''
+        Pick the smallest accepted representation
+
+        Args:
+            accept_encoding (str): the Accept-Encoding request header
+
+        Returns:
+            (body, content_encoding, etag), content_encoding is None for identity
+        '''
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and (encoding in accepted or '*' in accepted):
+                body, etag = self.variants[encoding]
+                return body, encoding, etag
+        body, etag = self.variants['identity']
+        return body, None, etag
+
+    def not_modified(self, if_none_match):
+        '''
+        Check an If-None-Match request header against the ETags of the response
+        '''
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            # If-None-Match uses the weak comparison
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag in self.etags:
+                return True
+        return False
+
+
+class ResponseCache(object):
+    '''
+    The pre-serialized responses of /data and /state/<state_id>
+
+    Attributes:
+        index (DataIndex): the data the responses were built from
+        data (CachedResponse): the response of /data
+        states (dict): state_id -> CachedResponse
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        print('> Serializing /state/<state_id>')
+        self.states = {state_id: CachedResponse(index.data.state_dict(state_id)) for state_id in index.data}
+        print('> Serializing /data')
+        # /data is the bodies of the states under their state_id, in the order of the sorted keys
+        self.data = CachedResponse(body=b'{' + b','.join(
+            dump_json(state_id)[:-1] + b':' + self.states[state_id].body[:-1] for state_id in sorted(self.states)) + b'}\n')
+        # The response for unknown states and centers
+        self.empty = CachedResponse({})
+
+    def get_state(self, state_id):
+        return self.states.get(state_id, self.empty)
+
+    def get_center(self, center_id):
+        state_id = self.index.center_to_state.get(center_id)
+        return self.states.get(state_id, self.empty)
+
+    def iter_batch(self, snapshots, center_ids=(), state_ids=(), dates=()):
+        '''
+        Stream the response of a batch query, resolving all the ids in one pass
+
+        Each state is sent once, however many of the centers are in it, and the
+        states and dates are copied from the cached bodies of their routes.
+
+        Args:
+            snapshots (DateSnapshots): the responses of /date/<date>
+            center_ids (list): the centers to look up
+            state_ids (list): the states to include
+            dates (list): the dates to include
+
+        Yields:
+            chunk (bytes): the parts of {"centers": {center_id: state_id or null},
+                "dates": {date: ...}, "states": {state_id: ...}}, unknown states and dates are left out
+        '''
+        centers = {center_id: self.index.center_to_state.get(center_id) for center_id in center_ids}
+        batch_states = {state_id for state_id in state_ids if state_id in self.states}
+        batch_states.update(state_id for state_id in centers.values() if state_id is not None)
+        batch_dates = {date for date in dates if date in snapshots.offsets}
+
+        # The bodies end with a newline, only the last one is kept
+        yield b'{"centers":' + dump_json(centers)[:-1]
+        bodies = [('dates', batch_dates, snapshots.body),
+                  ('states', batch_states, lambda state_id: self.states[state_id].body)]
+        for key, ids, body in bodies:
+            yield f',"{key}":{{'.encode('utf-8')
+            for i, id_ in enumerate(sorted(ids)):
+                yield (b',' if i else b'') + json.dumps(id_).encode('utf-8') + b':' + body(id_)[:-1]
+            yield b'}'
+        yield b'}\n'
+
+    def iter_ndjson(self, per='state', start=None, end=None, fields=None):
+        '''
+        Stream /data as newline-delimited JSON, one state or one state-date record per line
+
+        The lines are serialized one at a time, so the whole document is never built in memory.
+
+        Args:
+            per (str): 'state' for {"state_id": ..., <state fields>, "dates": {...}} lines,
+                'date' for {"state_id": ..., "date": ..., <date fields>} lines
+            start (str): the first date to include (YYYY-MM-DD), no limit if None
+            end (str): the last date to include (YYYY-MM-DD), no limit if None
+            fields (list): the date fields to include (e.g. new_cases), all of them if None
+
+        Yields:
+            line (bytes): a JSON document followed by a newline
+        '''
+        unfiltered = start is None and end is None and fields is None
+        for state_id, state_data in self.index.data.items():
+            if per == 'state' and unfiltered:
+                # The state is already serialized for /state/<state_id>
+                yield b'{"state_id":' + json.dumps(state_id).encode('utf-8') + b',' + self.states[state_id].body[1:]
+                continue
+
+            dates = {}
+            for date, date_data in state_data['dates'].items():
+                if (start is not None and date < start) or (end is not None and date > end):
+                    continue
+                if fields is not None:
+                    date_data = {field: date_data[field] for field in fields if field in date_data}
+                if per == 'date':
+                    yield dump_json(dict(date_data, state_id=state_id, date=date))
+                else:
+                    dates[date] = date_data
+            if per == 'state':
+                yield dump_json(dict(state_data, state_id=state_id, dates=dates))
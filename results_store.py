@@ -0,0 +1,330 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+import instrumentation
+
+# the folder of the columnar store
+STORE_DIR = 'results/store'
+
+# the columns of the csv files in the results folder
+COLUMNS = ['state_id', 'state_name', 'state_abbr', 'risk_level', 'population2021', 'daily_new_cases_per_100k', '7d_rolling_avg_new_cases_per_100k', 'daily_new_deaths_per_100k',
+           '7d_rolling_avg_new_deaths_per_100k', 'daily_percentage_of_people_who_received_at_least_one_dose', 'daily_percentage_of_people_who_are_fully_vaccinated']
+
+# the float columns, stored in the features cube
+FEATURES = COLUMNS[5:]
+
+# the state information, stored in index.json
+STATE_COLUMNS = ['state_id', 'state_name', 'state_abbr', 'population2021']
+
+
+class ResultsStore(object):
+    '''
+    A single date-partitioned columnar store of the risk results, replacing one csv per date
+
+    The store is a folder with
+    - index.json: the sorted dates and the states
+    - features.npy: (n_dates, n_states, n_features) float64, the features
+    - risk_level.npy: (n_dates, n_states) int8, the risk levels
+    - present.npy: (n_dates, n_states) bool, whether the state has a result at the date
+    The arrays are memory-mapped, so reading a date or a range only touches those rows.
+
+    Attributes:
+        dates (np.ndarray): the sorted dates
+        states (list): the state information, a dict of STATE_COLUMNS for each state
+        state_ids (list): the state_id of each state
+    '''
+
+    def __init__(self, path=STORE_DIR):
+        self.path = path
+        self._load()
+
+    def _load(self):
+        index_path = os.path.join(self.path, 'index.json')
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            self.dates = np.array(index['dates'], dtype=str)
+            self.states = index['states']
+            self.features = np.load(os.path.join(self.path, 'features.npy'), mmap_mode='r')
+            self.risk_level = np.load(os.path.join(self.path, 'risk_level.npy'), mmap_mode='r')
+            self.present = np.load(os.path.join(self.path, 'present.npy'), mmap_mode='r')
+        else:
+            self.dates = np.array([], dtype=str)
+            self.states = []
+            self.features = np.zeros((0, 0, len(FEATURES)))
+            self.risk_level = np.zeros((0, 0), dtype=np.int8)
+            self.present = np.zeros((0, 0), dtype=bool)
+        self.state_ids = [state['state_id'] for state in self.states]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __contains__(self, date):
+        return self._position(date) is not None
+
+    def _position(self, date):
+        pos = np.searchsorted(self.dates, date)
+        if pos < len(self.dates) and self.dates[pos] == date:
+            return int(pos)
+        return None
+
+    def _slice(self, start=None, end=None):
+        lo = 0 if start is None else int(np.searchsorted(self.dates, start, side='left'))
+        hi = len(self.dates) if end is None else int(np.searchsorted(self.dates, end, side='right'))
+        return lo, hi
+
+    def latest_date(self):
+        '''
+        Get the last date in the store, or None if it is empty
+        '''
+        return str(self.dates[-1]) if len(self.dates) else None
+
+    def read_date(self, date):
+        '''
+        Read the results of a date
+
+        Returns:
+            df (pandas dataframe): the same columns as results/<date>.csv
+        '''
+        pos = self._position(date)
+        if pos is None:
+            raise KeyError(date)
+        return self._frame(pos, pos + 1)
+
+    def read_range(self, start=None, end=None):
+        '''
+        Read the results of the dates from start to end (inclusive)
+
+        Returns:
+            df (pandas dataframe): a 'date' column and the same columns as the csv files
+        '''
+        lo, hi = self._slice(start, end)
+        return self._frame(lo, hi, with_date=True)
+
+    def lookback(self, date, days):
+        '''
+        Read the features of the `days` dates before a date
+
+        Returns:
+            features (np.ndarray): (days, n_states, n_features), the most recent date first
+            present (np.ndarray): (days, n_states), whether the state has a result at the date
+
+        Raises:
+            KeyError: if any of the dates is not in the store
+        '''
+        prev_dates = [(pd.Timestamp(date) - pd.Timedelta(days=i)).strftime('%Y-%m-%d') for i in range(1, days + 1)]
+        positions = []
+        for prev_date in prev_dates:
+            pos = self._position(prev_date)
+            if pos is None:
+                raise KeyError(prev_date)
+            positions.append(pos)
+        return np.asarray(self.features[positions]), np.asarray(self.present[positions])
+
+    def _frame(self, lo, hi, with_date=False):
+        present = np.asarray(self.present[lo:hi])
+        date_pos, state_pos = np.nonzero(present)
+        # Take the state information of each row
+        df = pd.DataFrame({column: [state[column] for state in self.states] for column in STATE_COLUMNS})
+        df = df.iloc[state_pos].reset_index(drop=True)
+        df['risk_level'] = np.asarray(self.risk_level[lo:hi])[date_pos, state_pos].astype(np.int64)
+        features = np.asarray(self.features[lo:hi])[date_pos, state_pos]
+        for i, feature in enumerate(FEATURES):
+            df[feature] = features[:, i]
+        df = df[COLUMNS]
+        if with_date:
+            df.insert(0, 'date', self.dates[lo:hi][date_pos])
+        return df
+
+    def write(self, frames):
+        '''
+        Add or replace the results of some dates, swapping in the new arrays atomically
+
+        Args:
+            frames (dict): date -> dataframe with the columns of the csv files
+        '''
+        if not frames:
+            return
+        # The union of the dates and the states
+        dates = np.array(sorted(set(self.dates.tolist()) | set(frames)), dtype=str)
+        states = {state['state_id']: state for state in self.states}
+        for df in frames.values():
+            for row in df[STATE_COLUMNS].itertuples(index=False):
+                states[str(row.state_id)] = {
+                    'state_id': str(row.state_id),
+                    'state_name': row.state_name,
+                    'state_abbr': row.state_abbr,
+                    'population2021': int(row.population2021),
+                }
+        state_ids = list(states)
+        state_pos = {state_id: i for i, state_id in enumerate(state_ids)}
+
+        features = np.full((len(dates), len(state_ids), len(FEATURES)), np.nan)
+        risk_level = np.zeros((len(dates), len(state_ids)), dtype=np.int8)
+        present = np.zeros((len(dates), len(state_ids)), dtype=bool)
+
+        # Copy the existing results
+        if len(self.dates):
+            rows = np.searchsorted(dates, self.dates)
+            cols = np.array([state_pos[state_id] for state_id in self.state_ids], dtype=np.intp)
+            features[np.ix_(rows, cols)] = self.features
+            risk_level[np.ix_(rows, cols)] = self.risk_level
+            present[np.ix_(rows, cols)] = self.present
+
+        # Add the new results
+        for date, df in frames.items():
+            row = np.searchsorted(dates, date)
+            cols = np.array([state_pos[str(state_id)] for state_id in df['state_id']], dtype=np.intp)
+            present[row] = False
+            present[row, cols] = True
+            risk_level[row, cols] = df['risk_level'].to_numpy()
+            features[row, cols] = df[FEATURES].to_numpy(dtype=np.float64)
+
+        # Write to temporary files of this process and swap them in, the index last,
+        # readers keep their mapping of the old files
+        os.makedirs(self.path, exist_ok=True)
+        suffix = f'.{os.getpid()}.tmp'
+        for name, array in [('features', features), ('risk_level', risk_level), ('present', present)]:
+            with open(os.path.join(self.path, f'{name}.npy{suffix}'), 'wb') as f:
+                np.save(f, array)
+        with open(os.path.join(self.path, f'index.json{suffix}'), 'w') as f:
+            json.dump({'dates': dates.tolist(), 'states': list(states.values())}, f)
+        for name in ['features.npy', 'risk_level.npy', 'present.npy', 'index.json']:
+            os.replace(os.path.join(self.path, name + suffix), os.path.join(self.path, name))
+
+        self._load()
+
+    def export_csv(self, date, path):
+        '''
+        Write the results of a date as a csv file, the same as results/<date>.csv
+        '''
+        self.read_date(date).to_csv(path, index=False)
+
+    def export_centers_csv(self, date, path, centers_path='centers.csv'):
+        '''
+        Write the risk level of each center at a date, the same as results/centers/<date>.csv
+        '''
+        df = self.read_date(date).set_index('state_id')
+        centers_df = pd.read_csv(centers_path)
+        state_ids = centers_df['state_id'].apply(lambda x: str(int(x)))
+        centers_df['risk_level'] = df.loc[state_ids, 'risk_level'].to_numpy()
+        centers_df['state_abbr'] = df.loc[state_ids, 'state_abbr'].to_numpy()
+        for column in ['7d_rolling_avg_new_cases_per_100k', '7d_rolling_avg_new_deaths_per_100k',
+                       'daily_percentage_of_people_who_received_at_least_one_dose', 'daily_percentage_of_people_who_are_fully_vaccinated']:
+            centers_df[column] = df.loc[state_ids, column].to_numpy()
+        centers_df.to_csv(path, index=False)
+
+
+def results_frame(states, dates, features, risk_level):
+    '''
+    Build one dataframe with a row for each date and state, dates first
+
+    Args:
+        states (list): the state information, a dict of STATE_COLUMNS for each state
+        dates (list): the dates
+        features (dict): feature -> (n_states, n_dates) values
+        risk_level (np.ndarray): (n_states, n_dates) the risk levels
+
+    Returns:
+        df (pandas dataframe): the columns of the csv files, len(states) rows for each date
+    '''
+    df = pd.DataFrame({
+        column: np.tile([state[column] for state in states], len(dates))
+        for column in STATE_COLUMNS
+    })
+    df['risk_level'] = np.asarray(risk_level).T.ravel()
+    for feature in FEATURES:
+        df[feature] = np.asarray(features[feature]).T.ravel()
+    return df[COLUMNS]
+
+
+def split_frame(df, dates):
+    '''
+    Split a dataframe from results_frame into a dataframe for each date
+    '''
+    n = len(df) // len(dates) if len(dates) else 0
+    return {date: df.iloc[i * n:(i + 1) * n] for i, date in enumerate(dates)}
+
+
+def write_csvs(df, dates, results_dir='results'):
+    '''
+    Write a dataframe from results_frame as a <YYYY-MM-DD>.csv file for each date
+
+    The whole dataframe is formatted once and the text is split into the files
+    '''
+    if not len(dates):
+        return
+    n = len(df) // len(dates)
+    lines = df.to_csv(index=False).splitlines(keepends=True)
+    header, lines = lines[0], lines[1:]
+    for i, date in enumerate(dates):
+        with open(os.path.join(results_dir, f'{date}.csv'), 'w', newline='') as f:
+            f.write(header)
+            f.writelines(lines[i * n:(i + 1) * n])
+    instrumentation.count('files_written', len(dates))
+
+
+def convert_csvs(results_dir='results', path=STORE_DIR):
+    '''
+    Build the store from the <YYYY-MM-DD>.csv files in the results folder
+
+    Returns:
+        store (ResultsStore): the store with every date of the csv files
+    '''
+    frames = {}
+    for name in sorted(os.listdir(results_dir)):
+        if not name.endswith('.csv'):
+            continue
+        # round_trip parsing gives back exactly the floats that were written
+        df = pd.read_csv(os.path.join(results_dir, name), dtype={'state_id': str}, float_precision='round_trip')
+        frames[name[:-4]] = df
+    print(f'> Converting {len(frames)} csv files')
+    store = ResultsStore(path)
+    store.write(frames)
+    return store
+
+
+def open_store(path=STORE_DIR, results_dir='results'):
+    '''
+    Open the store, building it from the csv files in the results folder the first time
+
+    Returns:
+        store (ResultsStore): the store
+    '''
+    store = ResultsStore(path)
+    if not len(store) and os.path.isdir(results_dir):
+        store = convert_csvs(results_dir, path)
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert between the results csv files and the columnar store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert', help='build the store from the csv files')
+    convert.add_argument('--results', default='results', help='the folder of the csv files')
+    export = subparsers.add_parser('export', help='write csv files from the store')
+    export.add_argument('--start', help='the first date to export (YYYY-MM-DD)')
+    export.add_argument('--end', help='the last date to export (YYYY-MM-DD)')
+    export.add_argument('--out', default='results', help='the folder to write the csv files to')
+    export.add_argument('--centers', action='store_true', help='also write <out>/centers/<date>.csv')
+    parser.add_argument('--store', default=STORE_DIR, help='the folder of the store')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        store = convert_csvs(args.results, args.store)
+        print(f'Converted {len(store)} dates to {args.store}')
+    else:
+        store = ResultsStore(args.store)
+        lo, hi = store._slice(args.start, args.end)
+        for date in store.dates[lo:hi]:
+            store.export_csv(date, os.path.join(args.out, f'{date}.csv'))
+            if args.centers:
+                os.makedirs(os.path.join(args.out, 'centers'), exist_ok=True)
+                store.export_centers_csv(date, os.path.join(args.out, 'centers', f'{date}.csv'))
+        print(f'Exported {hi - lo} dates to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
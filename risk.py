@@ -0,0 +1,97 @@
+import numpy as np
+
+# Thresholds for each metric: a value below bins[i] gets levels[i], a value at or above
+# the last bin gets the last level
+RISK_THRESHOLDS = {
+    '7d_rolling_avg_new_cases_per_100k': {
+        'bins': [3, 10, 20],
+        'levels': [1, 2, 3, 4],
+    },
+    '7d_rolling_avg_new_deaths_per_100k': {
+        'bins': [0.1, 0.3, 0.6],
+        'levels': [1, 2, 3, 4],
+    },
+    'daily_percentage_of_people_who_received_at_least_one_dose': {
+        'bins': [40, 60, 90],
+        'levels': [2, 1.5, 1, 0.5],
+    },
+    'daily_percentage_of_people_who_are_fully_vaccinated': {
+        'bins': [20, 40, 60],
+        'levels': [2, 1.5, 1, 0.5],
+    },
+}
+
+# The metrics added up for each component of the risk level
+RISK_COMPONENTS = {
+    'cases': ['7d_rolling_avg_new_cases_per_100k'],
+    'deaths': ['7d_rolling_avg_new_deaths_per_100k'],
+    'vaccination': ['daily_percentage_of_people_who_received_at_least_one_dose',
+                    'daily_percentage_of_people_who_are_fully_vaccinated'],
+}
+
+# weights for each component
+RISK_WEIGHTS = {
+    'cases': 0.6,
+    'deaths': 0.2,
+    'vaccination': 0.2,
+}
+
+
+def metric_level(values, thresholds):
+    '''
+    Look up the level of a metric for an array of values
+
+    Args:
+        values (array-like): the values of the metric, any shape
+        thresholds (dict): {'bins': [...], 'levels': [...]}
+
+    Returns:
+        levels (np.ndarray): the level for each value
+    '''
+    levels = np.asarray(thresholds['levels'], dtype=np.float64)
+    # NaN sorts after every bin, the same as failing every `<` test
+    return levels[np.digitize(np.asarray(values, dtype=np.float64), thresholds['bins'])]
+
+
+def score(features, thresholds=RISK_THRESHOLDS, components=RISK_COMPONENTS, weights=RISK_WEIGHTS):
+    '''
+    Calculate the risk level for a batch of states and dates at once
+
+    Args:
+        features: a mapping from feature name to values of any shape, e.g. a DataFrame
+            or the (state x date) matrices of features.calculate_features
+        thresholds (dict): the thresholds for each metric
+        components (dict): the metrics of each component
+        weights (dict): the weight of each component
+
+    Returns:
+        risk_level (np.ndarray): the risk level (1-4) for each value, same shape as the features
+    '''
+    risk_level = None
+    for component, metrics in components.items():
+        # Add up the levels of the metrics of the component
+        level = metric_level(features[metrics[0]], thresholds[metrics[0]])
+        for metric in metrics[1:]:
+            level = level + metric_level(features[metric], thresholds[metric])
+        # Add the weighted level to the risk level
+        weighted = weights[component] * level
+        risk_level = weighted if risk_level is None else risk_level + weighted
+
+    return risk_level.astype(np.int64)
+
+
+def score_centers(center_state_ids, state_ids, risk_level):
+    '''
+    Give every center the risk level of its state, for all dates at once
+
+    Args:
+        center_state_ids (array-like): the state_id of each center
+        state_ids (list): the state_id of each row of risk_level
+        risk_level (np.ndarray): (n_states, ...) the risk levels of the states
+
+    Returns:
+        center_risk_level (np.ndarray): (n_centers, ...) the risk levels of the centers
+    '''
+    rows = {str(state_id): row for row, state_id in enumerate(state_ids)}
+    center_rows = np.array([rows[str(int(state_id))] for state_id in center_state_ids], dtype=np.intp)
+    return np.asarray(risk_level)[center_rows]
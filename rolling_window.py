@@ -0,0 +1,168 @@
+import datetime
+import os
+import numpy as np
+from results_store import STORE_DIR
+
+# the number of days of the rolling averages
+WINDOW = 7
+
+# the checkpoint of the rolling window, kept next to the results store
+ROLLING_PATH = os.path.join(STORE_DIR, 'rolling.npz')
+
+
+def shift_date(date, days):
+    return (datetime.date.fromisoformat(date) + datetime.timedelta(days=days)).isoformat()
+
+
+def daily_values(data, state_ids, date):
+    '''
+    Get the daily new cases and new deaths per 100,000 people of each state at a date
+
+    Returns:
+        cases (np.ndarray): (n_states,) the daily new cases per 100k, 0 if the state has no record
+        deaths (np.ndarray): (n_states,) the daily new deaths per 100k, 0 if the state has no record
+        present (np.ndarray): (n_states,) whether the state has a record at the date
+    '''
+    cases = np.zeros(len(state_ids))
+    deaths = np.zeros(len(state_ids))
+    present = np.zeros(len(state_ids), dtype=bool)
+    for i, state_id in enumerate(state_ids):
+        record = data[state_id]['dates'].get(date)
+        if record is None:
+            continue
+        population = data[state_id]['population2021']
+        cases[i] = record['new_cases'] / population * 100000
+        deaths[i] = record['new_deaths'] / population * 100000
+        present[i] = True
+    return cases, deaths, present
+
+
+class RollingWindow(object):
+    '''
+    The daily new cases and new deaths per 100k of each state over the last 7 days
+
+    The values are kept in a ring buffer with one slot per day (the ordinal of the date
+    modulo 7), so adding a day only overwrites the slot of the day that left the window.
+
+    Attributes:
+        state_ids (list): the state ids, in the order of the rows
+        last_date (str): the last date added (YYYY-MM-DD)
+        cases (np.ndarray): (n_states, 7) the daily new cases per 100k of each slot
+        deaths (np.ndarray): (n_states, 7) the daily new deaths per 100k of each slot
+        present (np.ndarray): (n_states, 7) whether the state has a record at the day of the slot
+    '''
+
+    def __init__(self, state_ids, last_date, cases=None, deaths=None, present=None):
+        self.state_ids = list(state_ids)
+        self.last_date = last_date
+        shape = (len(self.state_ids), WINDOW)
+        self.cases = np.zeros(shape) if cases is None else cases
+        self.deaths = np.zeros(shape) if deaths is None else deaths
+        self.present = np.zeros(shape, dtype=bool) if present is None else present
+
+    @staticmethod
+    def _slot(date):
+        return datetime.date.fromisoformat(date).toordinal() % WINDOW
+
+    @classmethod
+    def rebuild(cls, data, date):
+        '''
+        Build the window of the 6 days before a date from the data of data.json
+        '''
+        state_ids = list(data)
+        window = cls(state_ids, shift_date(date, -1))
+        for i in range(WINDOW - 1, 0, -1):
+            prev_date = shift_date(date, -i)
+            window.push(prev_date, *daily_values(data, state_ids, prev_date))
+        return window
+
+    @classmethod
+    def load(cls, path=ROLLING_PATH):
+        '''
+        Load the checkpoint of the window
+
+        Returns:
+            window (RollingWindow): the window, None if there is no readable checkpoint
+        '''
+        try:
+            with np.load(path) as f:
+                return cls(f['state_ids'].tolist(), str(f['last_date']),
+                           f['cases'], f['deaths'], f['present'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, path=ROLLING_PATH):
+        '''
+        Write the checkpoint of the window, replacing the previous one atomically
+        '''
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, state_ids=np.array(self.state_ids), last_date=np.array(self.last_date),
+                     cases=self.cases, deaths=self.deaths, present=self.present)
+        os.replace(tmp_path, path)
+
+    def is_fresh(self, data, date):
+        '''
+        Check that the window can be moved to a date
+
+        The window must have the same states as the data, end the day before the date (or at the date
+        when a day is calculated again), and agree with the data on the day before the date.
+        '''
+        if self.state_ids != list(data):
+            return False
+        prev_date = shift_date(date, -1)
+        if self.last_date not in (prev_date, date):
+            return False
+        cases, deaths, present = daily_values(data, self.state_ids, prev_date)
+        slot = self._slot(prev_date)
+        return (np.array_equal(self.present[:, slot], present)
+                and np.array_equal(self.cases[:, slot], cases)
+                and np.array_equal(self.deaths[:, slot], deaths))
+
+    def push(self, date, cases, deaths, present=True):
+        '''
+        Add the values of a day, dropping the day 7 days before it
+        '''
+        slot = self._slot(date)
+        self.cases[:, slot] = cases
+        self.deaths[:, slot] = deaths
+        self.present[:, slot] = present
+        self.last_date = date
+
+    def averages(self):
+        '''
+        Get the 7d rolling averages at the last date
+
+        Returns:
+            avg_cases (np.ndarray): (n_states,) the 7d rolling average of new cases per 100k
+            avg_deaths (np.ndarray): (n_states,) the 7d rolling average of new deaths per 100k
+        '''
+        # Add the days from the most recent one, as the previous results were added
+        slot = self._slot(self.last_date)
+        avg_cases = np.where(self.present[:, slot], self.cases[:, slot], 0.0)
+        avg_deaths = np.where(self.present[:, slot], self.deaths[:, slot], 0.0)
+        for i in range(1, WINDOW):
+            prev_slot = (slot - i) % WINDOW
+            avg_cases += np.where(self.present[:, prev_slot], self.cases[:, prev_slot], 0.0)
+            avg_deaths += np.where(self.present[:, prev_slot], self.deaths[:, prev_slot], 0.0)
+        return avg_cases / WINDOW, avg_deaths / WINDOW
+
+
+def load_window(data, date, path=ROLLING_PATH):
+    '''
+    Load the rolling window to move to a date, rebuilding it from the data if it is missing or stale
+
+    Args:
+        data (dict or Dataset): the data from the data.json file
+        date (str): the date to calculate (YYYY-MM-DD)
+        path (str): the checkpoint of the window
+
+    Returns:
+        window (RollingWindow): the window, ending the day before the date or at the date
+    '''
+    window = RollingWindow.load(path)
+    if window is None or not window.is_fresh(data, date):
+        print('> Rebuilding the rolling window from data.json')
+        window = RollingWindow.rebuild(data, date)
+    return window
@@ -0,0 +1,83 @@
+'''
+Micro-benchmark of the API route lookups: the linear scans the routes used to do
+against the DataIndex lookups they use now
+
+Usage (from the repository root):
+    python scripts/bench_api.py [path/to/data.json] [--number N]
+'''
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from api_index import DataIndex
+
+
+def scan_center(data, center_id):
+    # The scan /center/<center_id> used to do
+    for state_id, state_data in data.items():
+        for c_id, c_data in state_data['centers'].items():
+            if c_id == center_id:
+                return data[state_id]
+    return {}
+
+
+def scan_date(data, date):
+    # The scan /date/<date> used to do
+    new_dict = {}
+    for state_id, state_data in data.items():
+        for d_id, d_data in state_data['dates'].items():
+            if d_id == date:
+                new_dict[state_id] = {
+                    "state_name": state_data['state_name'],
+                    "data": d_data
+                }
+    return new_dict
+
+
+def scan_state(data, state_id):
+    # The scan /state/<state_id> used to do
+    for s_id, s_data in data.items():
+        if s_id == state_id:
+            return data[state_id]
+    return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data', nargs='?', default='data.json', help='the data.json file to load')
+    parser.add_argument('--number', type=int, default=200, help='the number of calls to time per route')
+    args = parser.parse_args()
+
+    with open(args.data, 'r') as f:
+        data = json.load(f)
+
+    build_time = timeit.timeit(lambda: DataIndex(data), number=1)
+    index = DataIndex(data)
+
+    # Use the last state, center and a date in the middle, the worst cases for the scans
+    state_id = list(data.keys())[-1]
+    center_id = list(index.center_to_state.keys())[-1]
+    date = index.dates[len(index.dates) // 2]
+
+    routes = [
+        ('/data', lambda: data, lambda: index.data),
+        (f'/center/{center_id}', lambda: scan_center(data, center_id), lambda: index.get_center(center_id)),
+        (f'/date/{date}', lambda: scan_date(data, date), lambda: index.get_date(date)),
+        (f'/state/{state_id}', lambda: scan_state(data, state_id), lambda: index.get_state(state_id)),
+    ]
+
+    print(f'Index built in {build_time * 1000:.1f} ms')
+    print(f'{"route":<24} {"before (us)":>12} {"after (us)":>12} {"speedup":>10}')
+    for route, before, after in routes:
+        # Check the lookups agree before timing them
+        assert before() == after(), route
+        before_us = timeit.timeit(before, number=args.number) / args.number * 1e6
+        after_us = timeit.timeit(after, number=args.number) / args.number * 1e6
+        print(f'{route:<24} {before_us:>12.2f} {after_us:>12.2f} {before_us / after_us:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+'''
+Load test of the API under mixed traffic: the sync Flask deployment (app.py on sync
+gunicorn workers, as in the Procfile) against the ASGI one (asgi.py on uvicorn workers)
+
+A few clients download /data slowly while the others do the cheap lookups, so the
+lookups show how much the slow downloads hold them up. The p50/p99 latency of each
+kind of request and the requests per second are printed for each server.
+
+Usage (from the repository root):
+    python scripts/load_test.py [--workers 2] [--clients 32] [--duration 20]
+    python scripts/load_test.py --url http://127.0.0.1:8000   # a server that is already running
+'''
+import argparse
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data_file import load_data
+
+# the servers to compare: name -> the gunicorn arguments
+SERVERS = {
+    'sync': ['app:app'],
+    'asgi': ['-k', 'uvicorn.workers.UvicornWorker', 'asgi:app'],
+}
+
+# the share of each kind of request in the traffic
+TRAFFIC = [
+    ('/data', 0.05),
+    ('/state', 0.35),
+    ('/center', 0.30),
+    ('/date', 0.20),
+    ('/center/series', 0.10),
+]
+
+
+def make_paths(data):
+    '''
+    Get the ids to request from the data
+
+    Returns:
+        paths (dict): the kind of request -> the list of paths to pick from
+    '''
+    state_ids = list(data)
+    center_ids = [center_id for state_data in data.values() for center_id in state_data['centers']]
+    dates = sorted({date for state_data in data.values() for date in state_data['dates']})[7:-1]
+    return {
+        '/data': ['/data'],
+        '/state': [f'/state/{state_id}' for state_id in state_ids],
+        '/center': [f'/center/{center_id}' for center_id in center_ids],
+        '/date': [f'/date/{date}' for date in dates],
+        '/center/series': [f'/center/{center_id}/series?start={dates[len(dates) // 2]}' for center_id in center_ids],
+    }
+
+
+def request_once(session, url, slow_kbps):
+    '''
+    Send a request and read the whole response, at most slow_kbps kB/s if given
+    '''
+    with session.get(url, stream=True, headers={'Accept-Encoding': 'gzip'}) as response:
+        for chunk in response.raw.stream(16384, decode_content=False):
+            if slow_kbps:
+                time.sleep(len(chunk) / 1024 / slow_kbps)
+        return response.status_code
+
+
+def client(base_url, paths, deadline, latencies, slow_kbps, seed):
+    rng = random.Random(seed)
+    session = requests.Session()
+    kinds = [kind for kind, _ in TRAFFIC]
+    weights = [weight for _, weight in TRAFFIC]
+    while time.time() < deadline:
+        kind = rng.choices(kinds, weights)[0]
+        start = time.perf_counter()
+        try:
+            request_once(session, base_url + rng.choice(paths[kind]), slow_kbps if kind == '/data' else None)
+        except requests.RequestException:
+            latencies.setdefault('errors', []).append(0.0)
+            continue
+        latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+
+def run_load(base_url, paths, clients, duration, slow_kbps):
+    '''
+    Run the clients against a server for a duration
+
+    Returns:
+        latencies (dict): the kind of request -> the latencies in seconds
+    '''
+    deadline = time.time() + duration
+    per_client = [{} for _ in range(clients)]
+    threads = [threading.Thread(target=client, args=(base_url, paths, deadline, per_client[i], slow_kbps, i))
+               for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = {}
+    for client_latencies in per_client:
+        for kind, values in client_latencies.items():
+            latencies.setdefault(kind, []).extend(values)
+    return latencies
+
+
+def report(name, latencies, duration):
+    total = sum(len(values) for kind, values in latencies.items() if kind != 'errors')
+    print(f'{name}: {total / duration:.1f} requests/s, {len(latencies.get("errors", []))} errors')
+    print(f'  {"request":<16}{"count":>8}{"p50 ms":>10}{"p99 ms":>10}')
+    for kind, _ in TRAFFIC:
+        values = np.array(latencies.get(kind, [])) * 1000
+        if len(values):
+            print(f'  {kind:<16}{len(values):>8}{np.percentile(values, 50):>10.1f}{np.percentile(values, 99):>10.1f}')
+
+
+def wait_ready(base_url, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(base_url + '/state/0', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f'{base_url} did not start in {timeout}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='test a running server instead of starting the sync and ASGI servers')
+    parser.add_argument('--data', default='data.json', help='the data.json the server uses, to pick the ids')
+    parser.add_argument('--workers', type=int, default=2, help='the gunicorn workers of each server')
+    parser.add_argument('--clients', type=int, default=32, help='the number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=20, help='the seconds to run each test')
+    parser.add_argument('--slow-kbps', type=float, default=2048, help='the download speed of the /data clients')
+    parser.add_argument('--port', type=int, default=8137, help='the local port of the servers')
+    args = parser.parse_args()
+
+    paths = make_paths(load_data(args.data))
+
+    if args.url:
+        wait_ready(args.url)
+        report(args.url, run_load(args.url, paths, args.clients, args.duration, args.slow_kbps), args.duration)
+        return
+
+    for name, server_args in SERVERS.items():
+        base_url = f'http://127.0.0.1:{args.port}'
+        server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{args.port}',
+                                   '--workers', str(args.workers), '--log-level', 'warning'] + server_args,
+                                  stdout=subprocess.DEVNULL)
+        try:
+            wait_ready(base_url)
+            print(f'> Testing the {name} server...')
+            report(name, run_load(base_url, paths, args.clients, args.duration, args.slow_kbps), args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
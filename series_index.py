@@ -0,0 +1,71 @@
+import numpy as np
+from results_store import FEATURES
+
+# the fields of a series, the risk level and the features of the results
+SERIES_FIELDS = ['risk_level'] + FEATURES
+
+
+class SeriesIndex(object):
+    '''
+    The risk level and the features of each state over time, built once from the results store
+
+    A center has the risk level of its state, so the series of a center is the series of
+    its state. Each state keeps the sorted dates it has results for and one contiguous
+    array per field, so a date range is two binary searches and a slice of each requested field.
+
+    Attributes:
+        store (ResultsStore): the results the series were built from
+        series (dict): state_id -> (dates, values), the sorted dates and field -> np.ndarray
+    '''
+
+    def __init__(self, store):
+        '''
+        Args:
+            store (ResultsStore): the scored results
+        '''
+        self.store = store
+        features = np.asarray(store.features)
+        risk_level = np.asarray(store.risk_level)
+        present = np.asarray(store.present)
+        self.series = {}
+        for i, state_id in enumerate(store.state_ids):
+            rows = np.nonzero(present[:, i])[0]
+            values = {'risk_level': risk_level[rows, i].astype(np.int64)}
+            for j, feature in enumerate(FEATURES):
+                values[feature] = np.ascontiguousarray(features[rows, i, j])
+            self.series[state_id] = (store.dates[rows], values)
+
+    def get_series(self, state_id, start=None, end=None, fields=SERIES_FIELDS):
+        '''
+        Get the series of a state from start to end (inclusive)
+
+        Args:
+            state_id (str): the state
+            start (str): the first date (YYYY-MM-DD), the first date of the state if None
+            end (str): the last date (YYYY-MM-DD), the last date of the state if None
+            fields (list): the fields to include, from SERIES_FIELDS
+
+        Returns:
+            series (dict): {'dates': list, field: list, ...}, None if the state has no results
+        '''
+        if state_id not in self.series:
+            return None
+        dates, values = self.series[state_id]
+        lo = 0 if start is None else int(np.searchsorted(dates, start, side='left'))
+        hi = len(dates) if end is None else int(np.searchsorted(dates, end, side='right'))
+        series = {'dates': dates[lo:hi].tolist()}
+        for field in fields:
+            series[field] = values[field][lo:hi].tolist()
+        return series
+
+    def latest(self, state_id):
+        '''
+        Get the last risk level of a state
+
+        Returns:
+            latest (tuple): (date, risk_level), None if the state has no results
+        '''
+        if state_id not in self.series or not len(self.series[state_id][0]):
+            return None
+        dates, values = self.series[state_id]
+        return str(dates[-1]), int(values['risk_level'][-1])
@@ -0,0 +1,165 @@
+'''
+The county records of us-counties.csv, and their features against the daily job's features of the states
+'''
+import numpy as np
+import pandas as pd
+import pytest
+import risk
+from calculate_risk_daily import calculate_risk_by_date
+from county_data import EPOCH, compact_chunk, county_features, fips_lookup, load_counties, write_counties
+from data_file import write_data
+from rolling_window import RollingWindow, shift_date
+
+DATES = np.array([shift_date('2021-03-01', day) for day in range(20)])
+
+
+@pytest.fixture(scope='module')
+def counties():
+    rng = np.random.default_rng(0)
+    n_counties = 6
+    present = rng.random((n_counties, len(DATES))) > 0.2
+    present[0] = True
+    present[1, :12] = False
+    return {
+        'county_ids': np.arange(1001, 1001 + n_counties),
+        'population2021': rng.integers(10000, 1000000, n_counties),
+        'dates': DATES,
+        'present': present,
+        'cases': np.cumsum(rng.integers(0, 500, (n_counties, len(DATES))), axis=1).astype(np.int32),
+        'deaths': np.cumsum(rng.integers(0, 20, (n_counties, len(DATES))), axis=1).astype(np.int32),
+    }
+
+
+def as_data(counties):
+    '''
+    The counties as the data.json dictionary the daily job reads, with the new cases and new
+    deaths over each county's own records
+    '''
+    data = {}
+    for row, county_id in enumerate(counties['county_ids'].tolist()):
+        cols = np.nonzero(counties['present'][row])[0]
+        new_cases = np.diff(counties['cases'][row, cols], prepend=0)
+        new_deaths = np.diff(counties['deaths'][row, cols], prepend=0)
+        data[str(county_id)] = {
+            'population2021': int(counties['population2021'][row]),
+            'dates': {DATES[col]: {'new_cases': int(cases), 'new_deaths': int(deaths)}
+                      for col, cases, deaths in zip(cols, new_cases, new_deaths)},
+        }
+    return data
+
+
+@pytest.mark.parametrize('date', [DATES[3], DATES[10], DATES[-1]])
+def test_same_as_daily_job(counties, date):
+    data = as_data(counties)
+    window = RollingWindow.rebuild(data, date)
+    cases, deaths, present = [], [], []
+    for state_id in window.state_ids:
+        record = data[state_id]['dates'].get(date)
+        population = data[state_id]['population2021']
+        cases.append(record['new_cases'] / population * 100000 if record else 0.0)
+        deaths.append(record['new_deaths'] / population * 100000 if record else 0.0)
+        present.append(record is not None)
+    window.push(date, cases, deaths, present)
+    avg_cases, avg_deaths = window.averages()
+
+    df = county_features(counties, date)
+    rows = np.nonzero(present)[0]
+    assert df.index.tolist() == counties['county_ids'][rows].tolist()
+    assert df['daily_new_cases_per_100k'].tolist() == np.array(cases)[rows].tolist()
+    assert df['daily_new_deaths_per_100k'].tolist() == np.array(deaths)[rows].tolist()
+    assert df['7d_rolling_avg_new_cases_per_100k'].tolist() == avg_cases[rows].tolist()
+    assert df['7d_rolling_avg_new_deaths_per_100k'].tolist() == avg_deaths[rows].tolist()
+
+
+def test_missing_date(counties):
+    df = county_features(counties, '2020-01-01')
+    assert df.empty
+    assert list(df.columns) == ['daily_new_cases_per_100k', '7d_rolling_avg_new_cases_per_100k',
+                                'daily_new_deaths_per_100k', '7d_rolling_avg_new_deaths_per_100k']
+
+
+@pytest.fixture
+def county_df():
+    return pd.DataFrame({
+        'county_id': [11, 12, 13],
+        'county_name': ['Durham', 'Wake', 'Kings'],
+        'county_fips': [37063, 37183, 36047],
+        'state_id': [1, 1, 2],
+        'population2021': [300000, 1100000, 2600000],
+    })
+
+
+def test_compact_chunk(county_df):
+    chunk = pd.DataFrame({
+        'date': ['2021-03-01', '2021-03-01', '2021-03-01', '2021-03-01', '2021-03-02'],
+        # New York City has no fips code, 1001 has no center
+        'fips': [37063.0, np.nan, 1001.0, 37183.0, 37063.0],
+        'cases': [10.0, 500.0, 7.0, 20.0, 12.0],
+        'deaths': [1.0, 9.0, 0.0, np.nan, 1.0],
+    })
+    records = compact_chunk(chunk, fips_lookup(county_df))
+    assert records['row'].tolist() == [0, 1, 0]
+    assert (EPOCH + records['day'].to_numpy()).astype(str).tolist() == ['2021-03-01', '2021-03-01', '2021-03-02']
+    assert records['cases'].tolist() == [10, 20, 12]
+    # A missing number of deaths reads as 0
+    assert records['deaths'].tolist() == [1, 0, 1]
+    assert all(dtype == np.int32 for dtype in records.dtypes)
+
+
+def test_missing_county_on_a_date(county_df, tmp_path):
+    # Wake has no record on 03-02 and Kings none at all
+    chunk = pd.DataFrame({
+        'date': ['2021-03-01', '2021-03-01', '2021-03-02', '2021-03-03', '2021-03-03', '2021-03-03'],
+        'fips': [37063.0, 37183.0, 37063.0, 37063.0, 37183.0, np.nan],
+        'cases': [10.0, 20.0, 12.0, 15.0, 26.0, 900.0],
+        'deaths': [1.0, 2.0, 1.0, 2.0, 4.0, 10.0],
+    })
+    path = str(tmp_path / 'counties.npz')
+    write_counties(county_df, compact_chunk(chunk, fips_lookup(county_df)), path)
+    counties = load_counties(path)
+    assert counties['dates'].tolist() == ['2021-03-01', '2021-03-02', '2021-03-03']
+
+    df = county_features(counties, '2021-03-02')
+    assert df.index.tolist() == [11]
+    df = county_features(counties, '2021-03-03')
+    assert df.index.tolist() == [11, 12]
+    # Wake's new cases count from its last record, on 03-01
+    assert df.loc[12, 'daily_new_cases_per_100k'] == 6 / 1100000 * 100000
+    # and the 7d average counts 03-02 as 0
+    assert df.loc[12, '7d_rolling_avg_new_cases_per_100k'] == (6 / 1100000 * 100000 + 20 / 1100000 * 100000) / 7
+
+
+def test_score_centers_by_county(county_df, tmp_path, monkeypatch):
+    # Two states over 8 days, Durham and Wake in state 1, Kings in state 2
+    monkeypatch.chdir(tmp_path)
+    dates = [shift_date('2021-03-01', day) for day in range(8)]
+
+    def state(name, population, step):
+        return {'state_name': name, 'state_abbr': name[:2].upper(), 'population2020': population,
+                'population2021': population, 'centers': {},
+                'dates': {date: {'cases': step * (i + 1), 'deaths': i, 'People_at_least_one_dose': population // 2,
+                                 'People_fully_vaccinated': population // 3, 'new_cases': step, 'new_deaths': 1}
+                          for i, date in enumerate(dates)}}
+
+    write_data({'1': state('Carolina', 10000000, 100), '2': state('York', 20000000, 500)})
+    pd.DataFrame({'center_id': [1, 2, 3], 'center_name': ['#A', '#B', '#C'], 'county_id': [11, 12, 13],
+                  'state_id': [1.0, 1.0, 2.0], 'zip_code': [27701, 27601, 11201]}).to_csv('centers.csv', index=False)
+    # Durham has many more cases than its state, Wake has no record on the last date and Kings none at all
+    chunk = pd.DataFrame({
+        'date': dates + dates[:-1],
+        'fips': [37063.0] * 8 + [37183.0] * 7,
+        'cases': [3000.0 * (i + 1) for i in range(8)] + [10.0 * (i + 1) for i in range(7)],
+        'deaths': [float(i) for i in range(8)] + [0.0] * 7,
+    })
+    write_counties(county_df, compact_chunk(chunk, fips_lookup(county_df)), 'counties.npz')
+
+    df, centers_df, _ = calculate_risk_by_date(dates[-1], load_counties('counties.npz'))
+    assert centers_df['risk_resolution'].tolist() == ['county', 'state', 'state']
+    county = county_features(load_counties('counties.npz'), dates[-1]).loc[11]
+    assert centers_df.loc[0, '7d_rolling_avg_new_cases_per_100k'] == county['7d_rolling_avg_new_cases_per_100k']
+    # The centers without a county record keep the features and the risk level of their state
+    states = df.set_index('state_id')
+    assert centers_df.loc[1, '7d_rolling_avg_new_cases_per_100k'] == states.loc['1', '7d_rolling_avg_new_cases_per_100k']
+    assert centers_df['risk_level'].tolist()[1:] == [states.loc['1', 'risk_level'], states.loc['2', 'risk_level']]
+    assert centers_df.loc[0, 'risk_level'] == risk.score(centers_df.iloc[[0]])[0]
+    assert centers_df.loc[0, 'risk_level'] > states.loc['1', 'risk_level']
@@ -0,0 +1,66 @@
+'''
+The background reloads of DataReloader, when the new file can't be built
+'''
+import os
+import time
+import pytest
+from data_reloader import DataReloader
+
+INTERVAL = 0.02
+
+
+def build(raw):
+    if raw.startswith(b'bad'):
+        raise RuntimeError('not buildable')
+    return raw.decode('utf-8')
+
+
+def write(path, text):
+    # A new inode each time, as the jobs replace the files
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            pytest.fail('timed out')
+        time.sleep(INTERVAL)
+
+
+def test_keeps_value_and_polling(tmp_path, capsys):
+    path = str(tmp_path / 'data.json')
+    write(path, 'one')
+    reloader = DataReloader(path, build, interval=INTERVAL)
+    reloader.ensure_started()
+
+    # The file can't be built, the current value is kept and the error logged
+    write(path, 'bad')
+    wait_for(lambda: 'Failed to reload' in capsys.readouterr().err)
+    assert reloader.current.value == 'one'
+
+    # The thread is still polling, and picks up the next good file
+    write(path, 'two')
+    wait_for(lambda: reloader.current.value == 'two')
+
+
+def test_listener_called_again_after_failure(tmp_path):
+    path = str(tmp_path / 'data.json')
+    write(path, 'one')
+    reloader = DataReloader(path, build, interval=INTERVAL)
+    calls = []
+
+    def listener():
+        calls.append(reloader.current.value)
+        if len(calls) == 1:
+            raise RuntimeError('failed once')
+
+    reloader.listeners.append(listener)
+    reloader.ensure_started()
+    write(path, 'two')
+    wait_for(lambda: len(calls) >= 2)
+    time.sleep(INTERVAL * 5)
+    assert calls == ['two', 'two']
@@ -0,0 +1,56 @@
+'''
+The arrays of data.json read back as the data.json dictionary
+'''
+import json
+import pytest
+from data_file import load_dataset, write_data
+from dataset import Dataset
+
+RECORD = {'cases': 0, 'deaths': 0, 'People_at_least_one_dose': 0, 'People_fully_vaccinated': 0,
+          'new_cases': 0, 'new_deaths': 0}
+
+
+@pytest.fixture
+def data():
+    def record(cases, deaths):
+        return dict(RECORD, cases=cases, deaths=deaths, new_cases=cases, new_deaths=deaths)
+
+    return {
+        '1': {'state_name': 'A', 'state_abbr': 'AA', 'population2020': 10, 'population2021': 11,
+              'centers': {'5': {'center_name': '#C5', 'county_id': '3', 'zip_code': 12345}},
+              'dates': {'2021-03-01': record(1, 0), '2021-03-02': record(3, 1), '2021-03-04': record(4, 1)}},
+        # preprocess writes the key '0' for a state without covid rows
+        '2': {'state_name': 'B', 'state_abbr': 'BB', 'population2020': 20, 'population2021': 21,
+              'centers': {}, 'dates': {'0': dict(RECORD)}},
+        '3': {'state_name': 'C', 'state_abbr': 'CC', 'population2020': 30, 'population2021': 31,
+              'centers': {}, 'dates': {'2021-03-02': record(7, 2)}},
+    }
+
+
+def test_round_trip(data, tmp_path):
+    path = str(tmp_path / 'data.json')
+    write_data(data, path)
+    with open(path, 'r') as f:
+        expected = json.load(f)
+
+    dataset = load_dataset(path)
+    assert isinstance(dataset, Dataset)
+    assert dataset.dates == ['0', '2021-03-01', '2021-03-02', '2021-03-04']
+    assert {state_id: dataset.state_dict(state_id) for state_id in dataset} == expected
+    assert list(dataset['2']['dates']) == ['0']
+    assert dataset.date_records('0') == {'2': RECORD}
+    assert dataset.date_records('2021-03-02') == {'1': expected['1']['dates']['2021-03-02'],
+                                                  '3': expected['3']['dates']['2021-03-02']}
+    assert dataset.date_records('2021-03-03') == {}
+
+
+def test_from_dict_same_as_saved(data, tmp_path):
+    dataset = Dataset.from_dict(data)
+    dataset.save(str(tmp_path), 'v1')
+    opened = Dataset.open(str(tmp_path), 'v1')
+    assert opened.dates == dataset.dates
+    assert {state_id: opened.state_dict(state_id) for state_id in opened} == data
+
+
+def test_open_missing(tmp_path):
+    assert Dataset.open(str(tmp_path), 'v1') is None
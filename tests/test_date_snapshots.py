@@ -0,0 +1,137 @@
+'''
+The /date/<date> snapshots: their lookups, and the packed files shared by the workers
+'''
+import json
+import os
+import threading
+import time
+import pandas as pd
+import pytest
+import date_snapshots
+from api_index import DataIndex
+from date_snapshots import DateSnapshots, remove_stale
+from results_store import COLUMNS, FEATURES, ResultsStore
+
+DATES = ['2021-03-01', '2021-03-02', '2021-03-04']
+
+
+@pytest.fixture
+def index():
+    def record(cases):
+        return {'cases': cases, 'deaths': 0, 'People_at_least_one_dose': 0, 'People_fully_vaccinated': 0,
+                'new_cases': cases, 'new_deaths': 0}
+
+    return DataIndex({
+        '1': {'state_name': 'A', 'state_abbr': 'AA', 'population2020': 10, 'population2021': 11, 'centers': {},
+              'dates': {date: record(i + 1) for i, date in enumerate(DATES)}},
+        '2': {'state_name': 'B', 'state_abbr': 'BB', 'population2020': 20, 'population2021': 21, 'centers': {},
+              'dates': {DATES[1]: record(5)}},
+    })
+
+
+@pytest.fixture
+def store(tmp_path):
+    # Results for the first two dates, state 2 only has one on the second
+    def frame(state_ids, risk_level):
+        df = pd.DataFrame({'state_id': state_ids, 'state_name': ['A', 'B'][:len(state_ids)],
+                           'state_abbr': ['AA', 'BB'][:len(state_ids)], 'risk_level': risk_level,
+                           'population2021': [11, 21][:len(state_ids)]})
+        for feature in FEATURES:
+            df[feature] = 1.5
+        return df[COLUMNS]
+
+    store = ResultsStore(str(tmp_path / 'store'))
+    store.write({DATES[0]: frame(['1'], [2]), DATES[1]: frame(['1', '2'], [3, 4])})
+    return store
+
+
+@pytest.fixture
+def snapshots(index, store, tmp_path):
+    return DateSnapshots(index, store, 'v1', str(tmp_path / 'snapshots'), size=2)
+
+
+def expected(date):
+    return {
+        DATES[0]: {'1': {'state_name': 'A', 'data': {'cases': 1, 'deaths': 0, 'People_at_least_one_dose': 0,
+                                                      'People_fully_vaccinated': 0, 'new_cases': 1, 'new_deaths': 0},
+                         'risk_level': 2}},
+        DATES[1]: {'1': {'state_name': 'A', 'data': {'cases': 2, 'deaths': 0, 'People_at_least_one_dose': 0,
+                                                      'People_fully_vaccinated': 0, 'new_cases': 2, 'new_deaths': 0},
+                         'risk_level': 3},
+                   '2': {'state_name': 'B', 'data': {'cases': 5, 'deaths': 0, 'People_at_least_one_dose': 0,
+                                                      'People_fully_vaccinated': 0, 'new_cases': 5, 'new_deaths': 0},
+                         'risk_level': 4}},
+        # No results yet, the risk level is left out
+        DATES[2]: {'1': {'state_name': 'A', 'data': {'cases': 3, 'deaths': 0, 'People_at_least_one_dose': 0,
+                                                      'People_fully_vaccinated': 0, 'new_cases': 3, 'new_deaths': 0}}},
+    }[date]
+
+
+def test_resolve(snapshots):
+    assert snapshots.resolve('latest') == DATES[-1]
+    assert snapshots.resolve(DATES[0]) == DATES[0]
+    # A date within the range without data still resolves, to an empty snapshot
+    assert snapshots.resolve('2021-03-03') == '2021-03-03'
+    assert snapshots.resolve('2021-02-28') is None
+    assert snapshots.resolve('2021-03-05') is None
+
+
+def test_resolve_no_dates(store, tmp_path):
+    snapshots = DateSnapshots(DataIndex({}), store, 'v0', str(tmp_path / 'snapshots'))
+    assert snapshots.resolve('latest') is None
+    assert snapshots.resolve(DATES[0]) is None
+
+
+def test_get(snapshots):
+    for date in DATES:
+        assert json.loads(snapshots.get(date).body) == expected(date)
+    assert snapshots.get('2021-03-03') is snapshots.empty
+    # The most recently used snapshots are kept in memory
+    assert snapshots.get(DATES[2]) is snapshots.get(DATES[2])
+
+
+def test_iter_range(snapshots):
+    assert json.loads(b''.join(snapshots.iter_range(DATES[0], DATES[-1]))) == {date: expected(date) for date in DATES}
+    assert json.loads(b''.join(snapshots.iter_range('2021-03-02', '2021-03-03'))) == {DATES[1]: expected(DATES[1])}
+    assert json.loads(b''.join(snapshots.iter_range('2021-04-01', '2021-04-02'))) == {}
+
+
+def test_built_once(index, store, tmp_path, monkeypatch):
+    # The processes of the server build a version once, the others open it
+    calls = []
+    materialize = date_snapshots.materialize
+
+    def counted(*args):
+        calls.append(args)
+        time.sleep(0.1)
+        materialize(*args)
+
+    monkeypatch.setattr(date_snapshots, 'materialize', counted)
+    path = str(tmp_path / 'snapshots')
+    opened = []
+    threads = [threading.Thread(target=lambda: opened.append(DateSnapshots(index, store, 'v1', path)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert [json.loads(snapshots.get(DATES[1]).body) for snapshots in opened] == [expected(DATES[1])] * 4
+
+
+def test_remove_stale(index, store, tmp_path):
+    path = str(tmp_path / 'snapshots')
+    old = DateSnapshots(index, store, 'v1', path)
+    DateSnapshots(index, store, 'v2', path)
+    DateSnapshots(index, store, 'v3', path)
+    for name in ('v1.bin', 'v1.json'):
+        os.utime(os.path.join(path, name), (time.time() - 3600, time.time() - 3600))
+
+    # Only the other versions older than keep_seconds are removed
+    remove_stale(path, 'v3', keep_seconds=60)
+    assert sorted(name for name in os.listdir(path) if not name.startswith('.')) == \
+        ['v2.bin', 'v2.json', 'v3.bin', 'v3.json']
+    # A process already using a removed version keeps its mapping
+    assert json.loads(old.get(DATES[0]).body) == expected(DATES[0])
+    # And a process opening it builds it again
+    assert json.loads(DateSnapshots(index, store, 'v1', path).get(DATES[0]).body) == expected(DATES[0])
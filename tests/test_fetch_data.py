@@ -0,0 +1,147 @@
+'''
+The conditional, retried and concurrent fetch of the two sources, against a local HTTP stand-in
+'''
+import json
+import pytest
+import requests
+import fetch_data
+import instrumentation
+import reference_data
+from standins import StandinPool, reference_db, serve_files
+from synthetic import make_sources
+
+COVID_PATH = '/us-states.csv'
+VACCINATION_PATH = '/vaccinations.csv'
+
+
+@pytest.fixture(scope='module')
+def files():
+    sources = make_sources(n_states=4, n_dates=40, n_centers=8)
+    return {COVID_PATH: sources['covid_csv'], VACCINATION_PATH: sources['vaccination_csv']}
+
+
+@pytest.fixture(autouse=True)
+def fetch_cache(tmp_path, monkeypatch):
+    # The cache is a folder of the current directory, and the retries don't wait
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fetch_data, 'BACKOFF', 0)
+
+
+def fetch(base_url):
+    return fetch_data.fetch_data(f'{base_url}{COVID_PATH}', f'{base_url}{VACCINATION_PATH}', skip_unchanged=True)
+
+
+def commit():
+    for name in ('covid', 'vaccination'):
+        fetch_data.commit_fetch(name)
+
+
+def test_not_modified_skips(files):
+    etags = {COVID_PATH: '"covid-1"', VACCINATION_PATH: '"vaccination-1"'}
+    log = []
+    with serve_files(files, etags=etags, log=log) as base_url:
+        assert fetch(base_url) is not None
+        commit()
+        assert fetch(base_url) is None
+    assert sorted(status for _, status, _, _ in log) == [200, 200, 304, 304]
+
+
+def test_not_modified_needs_a_saved_run(files):
+    # Without commit_fetch (data.json was never written), the sources are downloaded again
+    etags = {COVID_PATH: '"covid-1"', VACCINATION_PATH: '"vaccination-1"'}
+    with serve_files(files, etags=etags) as base_url:
+        first = fetch(base_url)
+        second = fetch(base_url)
+    assert second is not None
+    assert second.equals(first)
+
+
+def test_one_source_changed(files):
+    etags = {COVID_PATH: '"covid-1"', VACCINATION_PATH: '"vaccination-1"'}
+    with serve_files(files, etags=etags) as base_url:
+        first = fetch(base_url)
+        commit()
+    # The vaccinations are parsed from the cached body
+    with serve_files(files, etags=dict(etags, **{COVID_PATH: '"covid-2"'})) as base_url:
+        second = fetch(base_url)
+    assert second is not None
+    assert second.equals(first)
+
+
+def test_retry_on_503(files):
+    log = []
+    with serve_files(files, failures={COVID_PATH: 2}, log=log) as base_url:
+        assert fetch(base_url) is not None
+    assert [status for path, status, _, _ in log if path == COVID_PATH] == [503, 503, 200]
+
+
+def test_retry_gives_up(files):
+    log = []
+    with serve_files(files, failures={COVID_PATH: 100}, log=log) as base_url:
+        with pytest.raises(requests.exceptions.HTTPError):
+            fetch(base_url)
+    # One layer of retries: RETRIES attempts in all
+    assert len([path for path, _, _, _ in log if path == COVID_PATH]) == fetch_data.RETRIES
+
+
+def test_sources_fetched_concurrently(files):
+    log = []
+    with serve_files(files, delay=0.5, log=log) as base_url:
+        fetch(base_url)
+    (_, _, start_a, end_a), (_, _, start_b, end_b) = log
+    assert start_a < end_b and start_b < end_a
+
+
+def drop_last_dates(data, n):
+    # The data of an earlier run, the last n dates of each state are not ingested yet
+    for state_data in data.values():
+        for date in list(state_data['dates'])[-n:]:
+            del state_data['dates'][date]
+    return data
+
+
+def test_incremental_drops_rows_while_parsing(files):
+    sources = make_sources(n_states=4, n_dates=40, n_centers=8)
+    conn = reference_db(sources['states'], sources['locations'])
+    with serve_files(files) as base_url:
+        # As read back from data.json
+        data = json.loads(json.dumps(fetch_data.preprocess(
+            fetch_data.fetch_data(f'{base_url}{COVID_PATH}', f'{base_url}{VACCINATION_PATH}'), conn)))
+        expected = json.loads(json.dumps(data))
+        full_df = fetch_data.fetch_data(f'{base_url}{COVID_PATH}', f'{base_url}{VACCINATION_PATH}')
+        cutoffs = fetch_data.incremental_cutoffs(drop_last_dates(data, 5))
+        new_df = fetch_data.fetch_data(f'{base_url}{COVID_PATH}', f'{base_url}{VACCINATION_PATH}', cutoffs=cutoffs)
+
+    # Only the 5 new dates and the overlapping one are parsed
+    assert len(new_df) == 6 * len(data)
+    assert len(full_df) > len(new_df)
+    # And the appended data is the same as from the whole sources
+    from_full = json.loads(json.dumps(data))
+    fetch_data.preprocess_incremental(full_df, from_full)
+    fetch_data.preprocess_incremental(new_df, data)
+    assert data == from_full == expected
+
+
+def test_main_counts_the_files_written(files, monkeypatch):
+    # The job reads the sources from the stand-in and the reference tables from SQLite
+    sources = make_sources(n_states=4, n_dates=40, n_centers=8)
+    conn = reference_db(sources['states'], sources['locations'])
+    monkeypatch.setattr(reference_data, '_pool', StandinPool(conn))
+    monkeypatch.setattr(instrumentation, '_run', None)
+    fetch = fetch_data.fetch_data
+    etags = {COVID_PATH: '"covid-1"', VACCINATION_PATH: '"vaccination-1"'}
+
+    def files_written(**kwargs):
+        with instrumentation.job('fetch_data') as run:
+            fetch_data.main(**kwargs)
+        return run.counters['files_written']
+
+    with serve_files(files, etags=etags) as base_url:
+        monkeypatch.setattr(fetch_data, 'fetch_data', lambda **kwargs: fetch(
+            f'{base_url}{COVID_PATH}', f'{base_url}{VACCINATION_PATH}', **kwargs))
+        # data.json and the 3 files of its arrays
+        assert files_written() == 4
+        # Neither source has changed
+        assert files_written() == 0
+        assert files_written(incremental=True) == 0
+        assert files_written(incremental=True, force=True) == 4
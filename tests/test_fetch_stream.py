@@ -0,0 +1,65 @@
+'''
+The streamed, chunked parse of the upstream csv files, against a local HTTP stand-in
+'''
+import io
+import pandas as pd
+import pytest
+import fetch_data
+from fetch_data import COVID_COLUMNS, VACCINATION_COLUMNS
+from standins import serve_files
+from synthetic import make_sources
+
+# quoted fields, missing values and an unused column, split at every few bytes
+EDGE_CSV = (b'date,state,fips,cases,deaths\n'
+            b'2021-01-01,"Washington, D.C.",11,10,\n'
+            b'2021-01-01,Texas,48,,3\n'
+            b'2021-01-02,"Washington, D.C.",11,12,1\n'
+            b'2021-01-02,Texas,48,25,4\n')
+
+
+@pytest.fixture(scope='module')
+def sources():
+    return make_sources(n_states=6, n_dates=80, n_centers=12)
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Many network chunks and blocks of rows, so rows are split across both
+    monkeypatch.setattr(fetch_data, 'CHUNK_BYTES', 97)
+    monkeypatch.setattr(fetch_data, 'CHUNK_ROWS', 13)
+
+
+def read_whole(body, columns):
+    # The parse of the whole body at once, as the sources were read before streaming
+    return pd.read_csv(io.BytesIO(body), usecols=list(columns), dtype=columns)
+
+
+@pytest.mark.parametrize('source, columns', [('covid_csv', COVID_COLUMNS), ('vaccination_csv', VACCINATION_COLUMNS)])
+def test_fetch_matches_whole_parse(tmp_path, sources, small_chunks, source, columns):
+    body = sources[source]
+    with serve_files({'/source.csv': body}) as base_url:
+        df, changed = fetch_data.fetch_csv(f'{base_url}/source.csv', columns, 'source', cache_dir=str(tmp_path))
+    assert changed
+    pd.testing.assert_frame_equal(df, read_whole(body, columns))
+
+
+def test_fetch_caches_the_body(tmp_path, sources, small_chunks):
+    body = sources['covid_csv']
+    with serve_files({'/source.csv': body}) as base_url:
+        fetch_data.fetch_csv(f'{base_url}/source.csv', COVID_COLUMNS, 'source', cache_dir=str(tmp_path))
+    fetch_data.commit_fetch('source', str(tmp_path))
+    assert (tmp_path / 'source.csv').read_bytes() == body
+
+
+def test_stream_edge_cases(small_chunks):
+    chunks = [EDGE_CSV[i:i + 7] for i in range(0, len(EDGE_CSV), 7)]
+    pd.testing.assert_frame_equal(fetch_data.read_csv_stream(chunks, COVID_COLUMNS), read_whole(EDGE_CSV, COVID_COLUMNS))
+
+
+def test_stream_transform(sources, small_chunks):
+    body = sources['covid_csv']
+    chunks = [body[i:i + 1000] for i in range(0, len(body), 1000)]
+    df = fetch_data.read_csv_stream(chunks, COVID_COLUMNS, transform=lambda block: block[block['date'] > '2020-02-15'])
+    expected = read_whole(body, COVID_COLUMNS)
+    expected = expected[expected['date'] > '2020-02-15'].reset_index(drop=True)
+    pd.testing.assert_frame_equal(df, expected)
@@ -0,0 +1,84 @@
+'''
+The KD-tree of the centers against a brute-force great-circle search
+'''
+import numpy as np
+import pytest
+from geo_index import EARTH_RADIUS_MILES, GeoIndex, load_geo
+from synthetic import make_centers_geo, make_sources
+
+# the query points: inside the centers' area, at its edge and far from it
+POINTS = [(35.99, -78.9), (40.7, -74.0), (25.0, -124.0), (49.0, -67.0), (64.8, -147.7), (-33.9, 151.2)]
+
+
+@pytest.fixture(scope='module')
+def centers_df():
+    return make_centers_geo(make_sources(n_states=10, n_dates=2, n_centers=300)['locations'])
+
+
+@pytest.fixture(scope='module')
+def geo(centers_df):
+    # Small leaves, so the queries go through several levels of the tree
+    return GeoIndex(centers_df, leaf_size=8)
+
+
+def haversine(centers_df, lat, lng):
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2, lng2 = np.radians(centers_df['lat'].to_numpy()), np.radians(centers_df['lng'].to_numpy())
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+
+def brute_force(centers_df, lat, lng):
+    # The center ids and distances of every center, nearest first
+    miles = haversine(centers_df, lat, lng)
+    order = np.argsort(miles, kind='stable')
+    return centers_df['center_id'].to_numpy()[order].astype(int).astype(str).tolist(), miles[order]
+
+
+@pytest.mark.parametrize('point', POINTS)
+@pytest.mark.parametrize('radius', [0, 50, 300, 2000, 30000])
+def test_within(geo, centers_df, point, radius):
+    ids, miles = brute_force(centers_df, *point)
+    found = geo.within(*point, radius)
+    assert sorted(center['center_id'] for center in found) == sorted(
+        center_id for center_id, distance in zip(ids, miles) if distance <= radius + 1e-6)
+    distances = [center['distance_miles'] for center in found]
+    assert distances == sorted(distances)
+    assert np.allclose(distances, np.round(miles[:len(found)], 2), atol=0.011)
+
+
+def test_within_radius_0_at_a_center(geo, centers_df):
+    center = centers_df.iloc[17]
+    found = geo.within(center['lat'], center['lng'], 0)
+    assert [center['center_id'] for center in found] == [str(int(centers_df.iloc[17]['center_id']))]
+    assert found[0]['distance_miles'] == 0
+
+
+@pytest.mark.parametrize('point', POINTS)
+@pytest.mark.parametrize('k', [1, 5, 40, 299, 300, 1000])
+def test_nearest(geo, centers_df, point, k):
+    ids, miles = brute_force(centers_df, *point)
+    found = geo.nearest(*point, k)
+    # k larger than the number of centers gives every center
+    assert len(found) == min(k, len(centers_df))
+    assert np.allclose([center['distance_miles'] for center in found], np.round(miles[:len(found)], 2), atol=0.011)
+    # The same centers, up to ties at the k-th distance
+    assert set(center['center_id'] for center in found[:-1]) <= set(ids[:len(found)])
+
+
+def test_empty(centers_df):
+    geo = GeoIndex(centers_df.iloc[:0])
+    assert geo.within(35.99, -78.9, 100) == []
+    assert geo.nearest(35.99, -78.9, 5) == []
+
+
+def test_missing_files_warn(tmp_path, centers_df, capsys):
+    assert load_geo(str(tmp_path / 'centers_geo.csv'), str(tmp_path / 'zipcodes_geo.csv')) is None
+    assert 'no ' in capsys.readouterr().err
+
+    centers_df.to_csv(tmp_path / 'centers_geo.csv', index=False)
+    geo = load_geo(str(tmp_path / 'centers_geo.csv'), str(tmp_path / 'zipcodes_geo.csv'))
+    assert geo is not None
+    assert 'zipcodes_geo.csv' in capsys.readouterr().err
+    # The zip codes of the centers can still be queried
+    assert geo.locate(centers_df.iloc[0]['zip_code']) is not None
@@ -0,0 +1,101 @@
+'''
+The pooled and cached reads of the reference tables, against a SQLite stand-in of the database
+'''
+import threading
+import pytest
+import reference_data
+from standins import StandinPool, reference_db
+from synthetic import make_sources
+
+
+@pytest.fixture(scope='module')
+def sources():
+    return make_sources(n_states=4, n_dates=10, n_centers=8)
+
+
+@pytest.fixture
+def conn(sources):
+    return reference_db(sources['states'], sources['locations'])
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    # Count the reads of each table from the database
+    reads = []
+    read_table = reference_data.read_table
+
+    def counted(conn, table, columns):
+        reads.append(table)
+        return read_table(conn, table, columns)
+
+    monkeypatch.setattr(reference_data, 'read_table', counted)
+    return reads
+
+
+def assert_same_rows(df, expected):
+    assert df.values.tolist() == expected.values.tolist()
+
+
+def test_pooled_fetch(conn, sources, tmp_path, monkeypatch):
+    pool = StandinPool(conn)
+    monkeypatch.setattr(reference_data, '_pool', pool)
+    center_df, state_df = reference_data.load_reference_tables(cache_dir=str(tmp_path))
+    assert_same_rows(center_df, sources['locations'][reference_data.REFERENCE_TABLES['locations']['columns']])
+    assert_same_rows(state_df, sources['states'][reference_data.REFERENCE_TABLES['states']['columns']])
+    # The connection is given back to the pool
+    assert pool.borrowed == pool.returned == 1
+
+
+def test_pooled_fetch_threads(conn, tmp_path, monkeypatch):
+    pool = StandinPool(conn)
+    monkeypatch.setattr(reference_data, '_pool', pool)
+    errors = []
+
+    def load(index):
+        try:
+            reference_data.load_reference_tables(cache_dir=str(tmp_path / str(index)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=load, args=(index,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert pool.borrowed == pool.returned == 4
+
+
+def test_version_cache(conn, tmp_path, reads, monkeypatch):
+    # The version of the table on PostgreSQL, set by the test
+    versions = ['stat:10-0-0']
+    monkeypatch.setattr(reference_data, 'table_version', lambda conn, table: versions[-1])
+    cache_dir = str(tmp_path)
+    first = reference_data.load_reference_table('states', conn, cache_dir)
+    second = reference_data.load_reference_table('states', conn, cache_dir)
+    assert reads == ['yfz.states']
+    assert second.equals(first)
+
+    # An updated row changes the version, and the table is read again
+    conn.execute("UPDATE yfz.states SET state_name = 'Renamed' WHERE rowid = 1")
+    versions.append('stat:10-1-0')
+    third = reference_data.load_reference_table('states', conn, cache_dir)
+    assert reads == ['yfz.states', 'yfz.states']
+    assert third['state_name'].tolist()[0] == 'Renamed'
+
+
+def test_no_version_no_cache(conn, tmp_path, reads):
+    # The stand-in has no version, an UPDATE that keeps the number of rows is still seen
+    statements = []
+    conn.set_trace_callback(statements.append)
+    assert reference_data.table_version(conn, 'yfz.states') is None
+    conn.set_trace_callback(None)
+    assert statements == []
+
+    cache_dir = str(tmp_path)
+    first = reference_data.load_reference_table('states', conn, cache_dir)
+    conn.execute("UPDATE yfz.states SET state_name = 'Renamed' WHERE rowid = 1")
+    second = reference_data.load_reference_table('states', conn, cache_dir)
+    assert reads == ['yfz.states', 'yfz.states']
+    assert len(second) == len(first)
+    assert second['state_name'].tolist()[0] == 'Renamed'
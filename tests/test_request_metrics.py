@@ -0,0 +1,96 @@
+'''
+The request metrics: the series of each worker, their sums over the workers and the text format
+'''
+import io
+import json
+import pytest
+from request_metrics import LATENCY_BUCKETS, STATIC, UNMATCHED, RequestMetrics, WsgiMetrics, route_label
+
+
+@pytest.fixture
+def workers(tmp_path):
+    # Two workers of the same server, the flush threads never run during the test
+    directory = str(tmp_path / 'metrics')
+    workers = [RequestMetrics(directory, flush_interval=3600, log=io.StringIO()) for _ in range(2)]
+    for metrics in workers:
+        metrics.ensure_started()
+    return workers
+
+
+def test_collect_sums_the_workers(workers):
+    first, second = workers
+    first.observe('GET', '/data', '200', 0.002, 100)
+    first.observe('GET', '/data', '200', 0.2, 300)
+    second.observe('GET', '/data', '200', 0.002, 50)
+    second.observe('GET', '/state/<state_id>', '404', 0.0001, 2)
+    second.flush()
+
+    series, n_workers = first.collect()
+    assert n_workers == 2
+    count, seconds, nbytes, *buckets = series[('GET', '/data', '200')]
+    assert (count, nbytes) == (3, 450)
+    assert seconds == pytest.approx(0.204)
+    assert len(buckets) == len(LATENCY_BUCKETS) + 1
+    assert buckets[LATENCY_BUCKETS.index(0.0025)] == 2
+    assert buckets[LATENCY_BUCKETS.index(0.25)] == 1
+    assert series[('GET', '/state/<state_id>', '404')][:3] == [1, 0.0001, 2]
+
+
+def test_render(workers):
+    first, second = workers
+    first.observe('GET', '/data', '200', 0.002, 100)
+    second.observe('GET', '/data', '304', 0.0004, 0)
+    second.flush()
+
+    lines = first.render().splitlines()
+    assert 'api_workers_reporting 2' in lines
+    assert 'api_requests_total{method="GET",route="/data",status="200"} 1' in lines
+    assert 'api_requests_total{method="GET",route="/data",status="304"} 1' in lines
+    assert 'api_response_bytes_total{method="GET",route="/data",status="200"} 100' in lines
+    # The histogram is over every status, and cumulative
+    assert 'api_request_duration_seconds_bucket{method="GET",route="/data",le="0.0005"} 1' in lines
+    assert 'api_request_duration_seconds_bucket{method="GET",route="/data",le="0.0025"} 2' in lines
+    assert 'api_request_duration_seconds_bucket{method="GET",route="/data",le="+Inf"} 2' in lines
+    assert 'api_request_duration_seconds_count{method="GET",route="/data"} 2' in lines
+    assert 'api_request_duration_seconds_sum{method="GET",route="/data"} 0.0024' in lines
+
+
+def test_slow_requests_logged(tmp_path):
+    log = io.StringIO()
+    metrics = RequestMetrics(str(tmp_path), slow_ms=100, slow_routes={'/data': 1.0}, log=log)
+    metrics.observe('GET', '/data', '200', 0.5, 10, '/data')
+    metrics.observe('GET', '/state/<state_id>', '200', 0.5, 10, '/state/1')
+    records = [json.loads(line) for line in log.getvalue().splitlines()]
+    assert [(record['event'], record['path'], record['ms']) for record in records] == [('slow_request', '/state/1', 500.0)]
+
+
+def test_route_label():
+    assert route_label('/data', '200') == '/data'
+    assert route_label(STATIC, '200') == STATIC
+    assert route_label(STATIC, '304') == STATIC
+    # The unknown urls match the static files, and are answered 404
+    assert route_label(STATIC, '404') == UNMATCHED
+    assert route_label('/state/<state_id>', '404') == '/state/<state_id>'
+    assert route_label(None, '404') == UNMATCHED
+
+
+def test_wsgi_labels(workers):
+    metrics = workers[0]
+
+    def app(environ, start_response):
+        routes = {'/data': '/data', '/index.html': STATIC, '/wp-login.php': STATIC}
+        if environ['PATH_INFO'] in routes:
+            environ['metrics.route'] = routes[environ['PATH_INFO']]
+        status = '404 NOT FOUND' if environ['PATH_INFO'] in ('/wp-login.php', '/nothing') else '200 OK'
+        start_response(status, [])
+        return [b'abc']
+
+    wsgi = WsgiMetrics(app, metrics)
+    for path in ('/data', '/index.html', '/wp-login.php', '/nothing'):
+        body = wsgi({'REQUEST_METHOD': 'GET', 'PATH_INFO': path}, lambda status, headers, exc_info=None: None)
+        assert b''.join(body) == b'abc'
+        body.close()
+
+    series, _ = metrics.collect()
+    assert sorted((route, status, values[0]) for (_, route, status), values in series.items()) == [
+        ('/data', '200', 1), (STATIC, '200', 1), (UNMATCHED, '404', 2)]